@@ -0,0 +1,209 @@
+"""
+Contention benchmarks for Lock, Semaphore, ShardedSemaphore and get_failed_cluster_checks.
+
+Runs against the in-process fake consul of the tests, so it needs no
+containers. Reports handoffs per second, p50/p99 acquire latency and consul
+requests per operation, and compares them with a baseline file:
+
+    python benchmarks/benchmark.py                    # run and compare with baseline.json
+    python benchmarks/benchmark.py --update-baseline  # store the results as new baseline
+    python benchmarks/benchmark.py --processes        # contenders in processes instead of threads
+
+Requests per operation do not depend on the machine and are always checked.
+Timings are only checked with --check-timing.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "tests"))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+import consul  # noqa: E402
+
+from consul_lib import Lock, Semaphore, SessionPool, ShardedSemaphore, get_failed_cluster_checks  # noqa: E402
+from fakeconsul import FakeConsul  # noqa: E402
+
+BASELINE = os.path.join(HERE, "baseline.json")
+NODES = ["consul1", "consul2", "consul3", "consul4"]
+
+
+def _percentile(values, percentile):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def _contend(address, kind, options, operations):
+    """ One contender: acquires and releases operations times. Returns the acquire latencies. """
+    con = consul.Consul(host=address[0], port=address[1])
+    options = dict(options)
+    pool = SessionPool(con, size=1) if options.pop("pool", False) else None
+    if pool is not None:
+        options["pool"] = pool
+    latencies = []
+    for _ in range(operations):
+        if kind == "lock":
+            primitive = Lock(con, "benchmark/lock", **options)
+        elif kind == "sharded":
+            primitive = ShardedSemaphore(con, "benchmark/sharded", **options)
+        else:
+            primitive = Semaphore(con, "benchmark/semaphore", **options)
+        start = time.monotonic()
+        assert primitive.acquire()
+        latencies.append(time.monotonic() - start)
+        primitive.release()
+    if pool is not None:
+        pool.close()
+    return latencies
+
+
+def _run_contenders(cluster, kind, options, contenders, operations, processes):
+    addresses = [(cluster.host, cluster.port(NODES[i % len(NODES)])) for i in range(contenders)]
+    args = [(address, kind, options, operations) for address in addresses]
+    if processes:
+        with multiprocessing.get_context("spawn").Pool(contenders) as pool:
+            return [x for result in pool.starmap(_contend, args) for x in result]
+    results = []
+    threads = [threading.Thread(target=lambda a: results.extend(_contend(*a)), args=(a,)) for a in args]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def contention(kind, options, *, contenders, operations, processes=False):
+    cluster = FakeConsul(nodes=NODES).start()
+    try:
+        start = time.monotonic()
+        latencies = _run_contenders(cluster, kind, options, contenders, operations, processes)
+        duration = time.monotonic() - start
+        total = contenders * operations
+        return {
+            "operations": total,
+            "handoffs_per_second": total / duration,
+            "p50_acquire": _percentile(latencies, 50),
+            "p99_acquire": _percentile(latencies, 99),
+            "requests_per_operation": cluster.total_requests() / total,
+        }
+    finally:
+        cluster.stop()
+
+
+def cluster_checks(strategy, *, services, operations):
+    cluster = FakeConsul(nodes=NODES).start()
+    try:
+        cons = [consul.Consul(host=cluster.host, port=cluster.port(node)) for node in NODES]
+        names = ["service%d" % i for i in range(services)]
+        for con in cons:
+            for name in names:
+                con.agent.service.register(name, check=consul.Check.ttl("60s"))
+        cluster.reset_counters()
+        latencies = []
+        for _ in range(operations):
+            start = time.monotonic()
+            get_failed_cluster_checks(cons[0], names, strategy=strategy)
+            latencies.append(time.monotonic() - start)
+        return {
+            "operations": operations,
+            "p50_latency": _percentile(latencies, 50),
+            "p99_latency": _percentile(latencies, 99),
+            "requests_per_operation": cluster.total_requests() / operations,
+        }
+    finally:
+        cluster.stop()
+
+
+def scenarios(processes=False):
+    """ name -> function running the scenario. """
+    return {
+        "lock": lambda: contention("lock", {}, contenders=8, operations=10, processes=processes),
+        "lock_pooled": lambda: contention("lock", {"pool": True}, contenders=8, operations=10, processes=processes),
+        "lock_fair": lambda: contention("lock", {"fair": True}, contenders=8, operations=10, processes=processes),
+        "semaphore": lambda: contention("semaphore", {"size": 2}, contenders=8, operations=10,
+                                        processes=processes),
+        "semaphore_fair": lambda: contention("semaphore", {"size": 2, "fair": True}, contenders=8, operations=10,
+                                             processes=processes),
+        "semaphore_large": lambda: contention("semaphore", {"size": 16}, contenders=32, operations=5,
+                                              processes=processes),
+        "semaphore_sharded": lambda: contention("sharded", {"size": 16, "shards": 4}, contenders=32, operations=5,
+                                                processes=processes),
+        "checks_concurrent": lambda: cluster_checks("concurrent", services=20, operations=20),
+        "checks_bulk": lambda: cluster_checks("bulk", services=20, operations=20),
+    }
+
+
+# Regressions beyond these factors fail the comparison.
+TOLERANCE = {
+    "requests_per_operation": 1.25,
+    "handoffs_per_second": 0.5,
+    "p50_acquire": 2.0,
+    "p99_acquire": 2.0,
+    "p50_latency": 2.0,
+    "p99_latency": 2.0,
+}
+TIMINGS = ("handoffs_per_second", "p50_acquire", "p99_acquire", "p50_latency", "p99_latency")
+
+
+def compare(results, baseline, check_timing=False):
+    """ Returns a list of regressions. """
+    regressions = []
+    for name, result in sorted(results.items()):
+        for metric, value in sorted(result.items()):
+            reference = baseline.get(name, {}).get(metric)
+            if metric not in TOLERANCE or reference is None or value is None:
+                continue
+            if metric in TIMINGS and not check_timing:
+                continue
+            factor = TOLERANCE[metric]
+            worse = value < reference * factor if factor < 1 else value > reference * factor
+            if worse:
+                regressions.append("%s %s: %.4f, baseline %.4f" % (name, metric, value, reference))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", nargs="*", help="scenarios to run, default: all")
+    parser.add_argument("--processes", action="store_true", help="run contenders in processes")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--check-timing", action="store_true", help="fail on slower timings, too")
+    args = parser.parse_args(argv)
+
+    available = scenarios(args.processes)
+    results = {}
+    for name in args.scenario or sorted(available):
+        results[name] = available[name]()
+        print("%-18s %s" % (name, " ".join("%s=%.4g" % x for x in sorted(results[name].items()))))
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline %s" % args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.check_timing)
+    for regression in regressions:
+        print("REGRESSION %s" % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,10 @@
+from .client import MultiConsul, PooledConsul  # noqa
 from .lock import Lock  # noqa
-from .semaphore import Semaphore  # noqa
-from .services import get_local_checks, get_failed_cluster_checks  # noqa
+from .session import HostSession  # noqa
+from .semaphore import Semaphore, ShardedSemaphore  # noqa
+from .multilock import MultiLock  # noqa
+from .rwlock import RWLock  # noqa
+from .services import get_local_checks, get_failed_cluster_checks, get_failed_datacenter_checks, HealthWatcher  # noqa
+from .election import LeaderElection, LeaderObserver  # noqa
+from .cleanup import shutdown  # noqa
+from .pool import SessionPool  # noqa
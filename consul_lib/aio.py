@@ -0,0 +1,393 @@
+"""
+asyncio versions of Lock, Semaphore and LockMonitor.
+
+All classes expect a consul.aio.Consul (python-consul with aiohttp), or any
+other client whose methods return awaitables. Sessions are renewed by a task
+instead of a thread, so thousands of waiters can share one event loop.
+"""
+import asyncio
+import json
+import logging
+import socket
+from pathlib import Path
+
+from .semaphore import _admits, _give_back, _prune, _queue_up, _take
+from .session import _entries, _lock_key
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncSessionRenewer:
+    """ Renews a session from an asyncio task until finish() is called. """
+
+    # Delay before retrying a failed renewal.
+    retry_interval = 5
+
+    def __init__(self, session, con, *, ttl=None):
+        self._session = session
+        self._con = con
+        self._ttl = ttl
+        self._task = None
+
+    @property
+    def interval(self):
+        if self._ttl:
+            return self._ttl * 2 / 3
+        return 5
+
+    async def _run(self):
+        interval = self.interval
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._con.session.renew(self._session)
+                interval = self.interval
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                LOG.warning("Unable to renew session.")
+                interval = min(self.retry_interval, self.interval)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def is_alive(self):
+        return self._task is not None and not self._task.done()
+
+    def finish(self):
+        if self._task:
+            self._task.cancel()
+
+    async def join(self, timeout=None):
+        if not self._task:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            pass
+
+
+class AsyncLock:
+
+    def __init__(self, con, prefix, *, session=None, payload='{"state": "done"}'):
+        """
+        asyncio version of consul_lib.Lock.
+
+        :param con: python-consul consul.aio.Consul.
+        :param prefix: prefix to use to. E.g. services/my-service.
+        :param session: create a new Lock object, but reuse session.
+        :param payload: content of the lock during time of lock. Could be anything human readable.
+        """
+        self._con = con
+        self._prefix = Path(prefix)
+        self._path = self._prefix / ".lock"
+        self._payload = payload
+        self._ttl = 60
+        self.session = session
+        self.session_renewer = None
+        self.locked = False
+
+    @property
+    def acquired(self):
+        """ Awaitable, e.g. `await lock.acquired`. """
+        return self._acquired()
+
+    async def _acquired(self):
+        _, consul_data = await self._con.kv.get(str(self._path))
+        return bool(consul_data and "Session" in consul_data and consul_data["Session"] == self.session)
+
+    def _holds(self, entries):
+        data = entries.get(str(self._path))
+        return bool(data and data.get("Session") == self.session)
+
+    def reset_session(self):
+        self.session = None
+
+    async def acquire(self, *, blocking=True, wait=None):
+        """
+        :param blocking: Wait for someone else or release the Lock. Default True.
+        :param wait: Maximum duration to wait for a key change (e.g. 10s)
+        """
+        if not self.session:
+            LOG.debug("Starting session.")
+            self.session = await self._con.session.create(ttl=self._ttl)
+            if self.session_renewer and self.session_renewer.is_alive():
+                self.session_renewer._session = self.session
+            else:
+                LOG.debug("Starting session_renewer.")
+                self.session_renewer = AsyncSessionRenewer(self.session, self._con, ttl=self._ttl)
+                self.session_renewer.start()
+        while not await self._con.kv.put(str(self._path), self._payload, acquire=self.session):
+            idx, data = await self._con.kv.get(str(self._path))
+            if blocking and data and "Session" not in data:
+                # Released before we got the index, or in lock-delay after the
+                # holder's session was invalidated. Retry soon, since there might
+                # be no further change of the key to wait for.
+                await self._con.kv.get(str(self._path), index=idx, wait="1s")
+            elif blocking:
+                LOG.debug("Waiting for lock on %s.", self._path)
+                _, data = await self._con.kv.get(str(self._path), index=idx, wait=wait)
+                if wait and data and int(data["ModifyIndex"]) == int(idx):
+                    LOG.debug("No state change within %s", wait)
+                    return False
+            else:
+                LOG.debug("Could not aquire lock on %s.", self._path)
+                return False
+        self.locked = True
+        return True
+
+    async def release(self, *, keep_session=None, blocking=True):
+        """
+        :param keep_session: Release the Lock, but still keep the session.
+                             Default None. always: just keep. "exit" is not
+                             supported, since there is no event loop at exit.
+        """
+        if keep_session not in (None, "always"):
+            raise ValueError("keep_session must be None or 'always'")
+        LOG.debug("Releasing lock %s.", self._path)
+        await self._con.kv.put(str(self._path), None, release=self.session)
+        if keep_session != "always":
+            await self.close(blocking=blocking)
+        self.locked = False
+
+    async def close(self, blocking=True, timeout=None):
+        if self.session:
+            LOG.debug("Closing session %s.", self.session)
+            try:
+                await self._con.session.destroy(self.session)
+            except Exception:
+                LOG.debug("Unable to destroy session. Consul not available.")
+            self.session = None
+        self.locked = False
+        if self.session_renewer:
+            self.session_renewer.finish()
+            if blocking:
+                await self.session_renewer.join(timeout)
+
+    async def __aenter__(self):
+        if await self.acquire():
+            return self
+        return None
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.release()
+        return False
+
+
+class AsyncSemaphore:
+
+    def __init__(self, con, prefix, size, *, session=None):
+        """
+        asyncio version of consul_lib.Semaphore.
+
+        Unlike Semaphore, the session is created on the first acquire(),
+        because __init__ can not wait for consul.
+
+        :param con: python-consul consul.aio.Consul.
+        :param prefix: prefix to use to. E.g. services/my-service.
+        :param size: number of holders allowed at the same time.
+        :param session: reuse this session.
+        """
+        self._con = con
+        self.prefix = Path(prefix)
+        self.size = size
+        self.lock_path = str(self.prefix / ".lock")
+        self.session = session
+        self.session_renewer = None
+        self.locked = False
+
+    async def _ensure_session(self):
+        if not self.session:
+            self.session = await self._con.session.create(ttl=60)
+        if not self.session_renewer:
+            self.session_renewer = AsyncSessionRenewer(self.session, self._con, ttl=60)
+            self.session_renewer.start()
+
+    def _holds(self, entries):
+        contender = entries.get(str(self.prefix / self.session)) if self.session else None
+        data = entries.get(self.lock_path)
+        if not contender or contender.get("Session") != self.session or not data:
+            return False
+        value = json.loads(data["Value"].decode())
+        return self.session in value.get("Holders", [])
+
+    async def _cleanup_holders(self, value):
+        _, contender = await self._con.kv.get(str(self.prefix), recurse=True)
+        if contender:
+            LOG.debug("Cleaning up broken clients.")
+            abandoned = [x for x in contender if not x["Key"].endswith(".lock") and "Session" not in x]
+            alive = [x["Key"].split("/")[-1] for x in contender if not x["Key"].endswith(".lock") and "Session" in x]
+            for broken in abandoned:
+                await self._con.kv.delete(broken["Key"])
+            # Also the waiters and weights of Semaphore(...).acquire(permits=n).
+            _prune(value, alive)
+        return value
+
+    async def _read(self, idx):
+        """ Waits for a change of .lock after idx. Returns its index and value without gone holders. """
+        idx, data = await self._con.kv.get(self.lock_path, index=idx or None, wait="30s")
+        if data:
+            value = json.loads(data["Value"].decode())
+        else:
+            value = {"Limit": self.size,
+                     "Holders": []}
+            idx = 0
+        value["Limit"] = self.size
+        return idx, await self._cleanup_holders(value)
+
+    async def acquire(self, *, blocking=True, permits=1):
+        """
+        Returns True, or False if the Semaphore could not be acquired.
+
+        :param blocking: Wait for someone else or release the Lock. Default True.
+        :param permits: number of permits to take at once, see Semaphore.acquire.
+        """
+        if not 1 <= permits <= self.size:
+            raise ValueError("permits must be between 1 and size")
+        await self._ensure_session()
+        res = await self._con.kv.put(str(self.prefix / self.session), socket.gethostname(), acquire=self.session)
+        if not res:
+            return False
+
+        acquired = False
+        idx = None
+        while not acquired:
+            LOG.debug("Trying to obtain lock")
+            if not blocking:
+                idx = None
+            idx, value = await self._read(idx)
+
+            if self.session in value["Holders"]:
+                self.locked = True
+                return True
+            admitted = _admits(value, self.session, permits)
+            if admitted:
+                _take(value, self.session, permits)
+            if admitted or _queue_up(value, self.session, permits, blocking):
+                if await self._con.kv.put(self.lock_path, json.dumps(value), cas=idx):
+                    acquired = admitted
+                # Read again instead of waiting for the own change.
+                idx = None
+            if not blocking:
+                break
+        self.locked = acquired
+        return acquired
+
+    async def acquired(self):
+        if not self.session:
+            return False
+        _, data = await self._con.kv.get(self.lock_path)
+        if not data:
+            return False
+        value = json.loads(data["Value"].decode())
+        return "Holders" in value and self.session in value["Holders"]
+
+    async def release(self, *, keep_session=None, blocking=True, permits=None):
+        """
+        :param keep_session: "always" keeps the session. Default None closes it.
+        :param permits: give back only this many permits and keep holding the rest. Default: all.
+        """
+        if keep_session not in (None, "always"):
+            raise ValueError("keep_session must be None or 'always'")
+        released = False
+        idx = None
+        while not released:
+            LOG.debug("Waiting to release lock")
+            idx, data = await self._con.kv.get(self.lock_path, index=idx)
+            if not data:
+                released = True
+                break
+            value = json.loads(data["Value"].decode())
+            if self.session not in value["Holders"]:
+                released = True
+                break
+            partial = _give_back(value, self.session, permits)
+            if await self._con.kv.put(self.lock_path, json.dumps(value), cas=idx):
+                if partial:
+                    return True
+                released = True
+            if not blocking:
+                break
+        if released:
+            self.locked = False
+        if keep_session != "always":
+            await self.close(blocking)
+        return released
+
+    async def close(self, blocking=True):
+        if self.session:
+            LOG.debug("Closing session %s.", self.session)
+            await self._con.kv.delete(str(self.prefix / self.session))
+            await self._con.session.destroy(self.session)
+            self.session = None
+        self.locked = False
+        if self.session_renewer:
+            self.session_renewer.finish()
+            if blocking:
+                await self.session_renewer.join()
+            self.session_renewer = None
+
+    async def __aenter__(self):
+        if await self.acquire():
+            return self
+        return None
+
+    async def __aexit__(self, exc_type, exec_val, exec_tb):
+        await self.release()
+        return False
+
+
+class AsyncLockMonitor:
+    """
+    Sets an asyncio.Event when an AsyncLock or AsyncSemaphore is lost.
+
+    Works like session.LockMonitor, but runs as a task.
+    """
+
+    def __init__(self, lock, retries=2, retry_time=2, event=None):
+        self._lock = lock
+        self._lost = False
+        self._retries = retries
+        self._retry_time = retry_time
+        self._event = event
+        self._task = None
+
+    @property
+    def lost(self):
+        return self._lost
+
+    async def _run(self):
+        retries = 0
+        while not self._lost:
+            if self._lock.session:
+                if retries > self._retries:
+                    self._lost = True
+                elif self._lock.locked:
+                    try:
+                        # Only the .lock key of an AsyncLock, an AsyncSemaphore needs the contender keys.
+                        key, recurse = _lock_key(self._lock)
+                        _, data = await self._lock._con.kv.get(key, recurse=recurse)
+                        if self._lock._holds(_entries(data)):
+                            retries = 0
+                        else:
+                            self._lost = True
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception:
+                        LOG.warning("Unable to get lock. Trying again.", exc_info=True)
+                        retries += 1
+            if self._lost and self._event:
+                LOG.debug("AsyncLockMonitor firing event")
+                self._event.set()
+                break
+            await asyncio.sleep(self._retry_time)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def reset(self):
+        self._lost = False
+
+    def finish(self):
+        if self._task:
+            self._task.cancel()
@@ -0,0 +1,138 @@
+"""
+Releases the sessions of the process at once.
+
+Locks and semaphores released with keep_session="exit" register here, instead
+of one atexit handler each. At exit they are closed in parallel, bounded by
+EXIT_TIMEOUT. shutdown() does the same at any time and destroys the sessions
+of all other renewers of the process, too, in one transaction per client.
+
+    consul_lib.shutdown(timeout=5)
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from . import txn
+from .session import SessionRenewalHub
+
+LOG = logging.getLogger(__name__)
+
+# Seconds to wait for the registered objects at exit.
+EXIT_TIMEOUT = 10
+# Maximum number of parallel requests.
+MAX_WORKERS = 16
+
+_registered = OrderedDict()
+_mutex = threading.Lock()
+
+
+def register(obj):
+    """ Calls obj.close(blocking=False) at exit or on shutdown(). """
+    with _mutex:
+        _registered[id(obj)] = obj
+
+
+def unregister(obj):
+    with _mutex:
+        _registered.pop(id(obj), None)
+
+
+def _take_registered():
+    with _mutex:
+        objects = list(_registered.values())
+        _registered.clear()
+    return objects
+
+
+def _work(pending, done):
+    while True:
+        try:
+            task = pending.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            task()
+        except Exception:
+            LOG.warning("Cleanup failed.", exc_info=True)
+        finally:
+            done.release()
+
+
+def _run(tasks, deadline):
+    """
+    Runs the functions in tasks on up to MAX_WORKERS daemon threads. Returns
+    False if they did not finish before deadline. Daemon threads, so a
+    hanging request can not block the exit of the interpreter.
+    """
+    pending = queue.Queue()
+    for task in tasks:
+        pending.put(task)
+    done = threading.Semaphore(0)
+    for _ in range(min(MAX_WORKERS, len(tasks))):
+        threading.Thread(target=_work, args=(pending, done), name="consul_lib cleanup", daemon=True).start()
+    for _ in tasks:
+        if not done.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            return False
+    return True
+
+
+def _close(obj):
+    return lambda: obj.close(blocking=False)
+
+
+def _destroy_sessions(con, renewers):
+    """ Destroys the sessions of renewers in one transaction per 64 sessions. Returns those which failed. """
+    failed = []
+    for start in range(0, len(renewers), txn.MAX_OPERATIONS):
+        batch = renewers[start:start + txn.MAX_OPERATIONS]
+        try:
+            txn.execute(con, [txn.session("delete", x._session) for x in batch])
+        except (txn.TxnConflict, txn.TxnUnsupported):
+            # Rolled back, e.g. one of them is gone already.
+            failed.extend(batch)
+            continue
+        for renewer in batch:
+            renewer.finish()
+    return failed
+
+
+def _destroy_session(renewer):
+    def destroy():
+        try:
+            renewer._con.session.destroy(renewer._session)
+        finally:
+            renewer.finish()
+    return destroy
+
+
+def shutdown(timeout=10):
+    """
+    Closes everything registered with keep_session="exit" and destroys the
+    sessions of all renewers of SessionRenewalHub.default(), in parallel.
+    Returns True if everything is done within timeout seconds.
+
+    Locks and semaphores still held are lost. Objects holding them keep their
+    state and can not be used anymore.
+    """
+    deadline = time.monotonic() + timeout
+    if not _run([_close(x) for x in _take_registered()], deadline):
+        return False
+    by_con = defaultdict(list)
+    for renewer in SessionRenewalHub.default().renewers():
+        by_con[renewer._con].append(renewer)
+    failed = []
+    if not _run([lambda con=con, renewers=renewers: failed.extend(_destroy_sessions(con, renewers))
+                 for con, renewers in by_con.items()], deadline):
+        return False
+    return _run([_destroy_session(x) for x in failed], deadline)
+
+
+@atexit.register
+def _at_exit():
+    # Only the registered objects: sessions kept with keep_session="always"
+    # may be used by someone else after the exit.
+    if not _run([_close(x) for x in _take_registered()], time.monotonic() + EXIT_TIMEOUT):
+        LOG.warning("Not all sessions closed within %ss.", EXIT_TIMEOUT)
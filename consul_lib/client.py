@@ -0,0 +1,346 @@
+"""
+A python-consul client with separate connection pools for blocking queries
+and for short requests.
+
+consul.Consul uses one requests.Session for everything. Locks, semaphores,
+renewers and monitors of a process share it, so long running blocking
+queries occupy the kept-alive connections and requests without a timeout
+can hang forever. PooledConsul is a drop-in replacement:
+
+    con = consul_lib.PooledConsul(host="consul1")
+    lock = consul_lib.Lock(con, "services/my-service")
+
+MultiConsul spreads the requests over several agents and fails over to the
+next one, if an agent does not answer:
+
+    con = consul_lib.MultiConsul(["consul1:8500", "consul2:8500", "consul3:8500"])
+"""
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+
+import consul
+import requests
+from consul import base
+from requests.adapters import HTTPAdapter
+
+LOG = logging.getLogger(__name__)
+
+# Consul waits at most this long in a blocking query without a wait parameter.
+DEFAULT_WAIT = 300.0
+_UNITS = {"ns": 1e-9, "us": 1e-6, "ms": 1e-3, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def _seconds(wait):
+    """ Converts a consul duration like "30s" or "1m30s" to seconds. """
+    if wait is None:
+        return DEFAULT_WAIT
+    if isinstance(wait, (int, float)):
+        return float(wait)
+    parts = re.findall(r"([0-9.]+)(ns|us|ms|s|m|h)", wait)
+    if not parts:
+        return float(wait)
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+class _SharedRegistry:
+    """
+    Objects shared by everyone using a client, one per name.
+
+    The shared objects refer to their client, so a WeakKeyDictionary would
+    never let go of them. They are kept by id(con) instead, and must be
+    removed with remove() once they are idle. As long as an entry exists, its
+    client is alive, so the id can not be reused by another one.
+    """
+
+    def __init__(self):
+        self.mutex = threading.RLock()
+        self._entries = {}
+
+    def __contains__(self, con):
+        """ Whether anything is shared for con. """
+        with self.mutex:
+            return any(key == id(con) for key, _ in self._entries)
+
+    def get(self, con, name, create, valid=None):
+        """
+        The object shared for con and name.
+
+        :param create: called without arguments, if there is none yet.
+        :param valid: called with the shared object, which is replaced if it returns False.
+        """
+        with self.mutex:
+            shared = self._entries.get((id(con), name))
+            if shared is None or (valid is not None and not valid(shared)):
+                shared = self._entries[id(con), name] = create()
+            return shared
+
+    def remove(self, con, name, shared):
+        """ Forgets shared, unless something else is shared for con and name by now. """
+        with self.mutex:
+            if self._entries.get((id(con), name)) is shared:
+                del self._entries[id(con), name]
+
+
+class PooledHTTPClient(base.HTTPClient):
+    """
+    HTTP client for PooledConsul.
+
+    Blocking queries (GET with an index) use their own connection pool and a
+    timeout of their wait time plus margin, everything else (renewals, puts,
+    session handling) uses a second pool and the short timeout. The children
+    of a fork open new connections.
+    """
+
+    _clients = weakref.WeakSet()
+
+    def __init__(self, *args, blocking_pool_size=32, pool_size=8, timeout=10, margin=5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+        self.margin = margin
+        self._pool_sizes = (blocking_pool_size, pool_size)
+        self._connect()
+        self._clients.add(self)
+
+    def _connect(self):
+        blocking_pool_size, pool_size = self._pool_sizes
+        self.blocking_session = self._session(blocking_pool_size)
+        self.session = self._session(pool_size)
+
+    @staticmethod
+    def _session(size):
+        session = requests.Session()
+        # Not blocking: above size connections are opened anyway, just not kept alive.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=False)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _timeout(self, params):
+        """ Returns the session and timeout for a request with params. """
+        params = dict(params or ())
+        if params.get("index") is None:
+            return self.session, self.timeout
+        wait = _seconds(params.get("wait"))
+        # Consul adds up to wait / 16 of jitter.
+        return self.blocking_session, wait + wait / 16 + self.margin
+
+    def response(self, response):
+        response.encoding = "utf-8"
+        return base.Response(response.status_code, response.headers, response.text)
+
+    def get(self, callback, path, params=None):
+        session, timeout = self._timeout(params)
+        return callback(self.response(
+            session.get(self.uri(path, params), verify=self.verify, cert=self.cert, timeout=timeout)))
+
+    def put(self, callback, path, params=None, data=""):
+        return callback(self.response(
+            self.session.put(self.uri(path, params), data=data, verify=self.verify, cert=self.cert,
+                             timeout=self.timeout)))
+
+    def delete(self, callback, path, params=None):
+        return callback(self.response(
+            self.session.delete(self.uri(path, params), verify=self.verify, cert=self.cert, timeout=self.timeout)))
+
+    def post(self, callback, path, params=None, data=""):
+        return callback(self.response(
+            self.session.post(self.uri(path, params), data=data, verify=self.verify, cert=self.cert,
+                              timeout=self.timeout)))
+
+
+def _after_fork_in_child():
+    # The kept-alive connections are shared with the parent. Do not use them.
+    for client in list(PooledHTTPClient._clients):
+        client._connect()
+
+
+def _reconnect(con):
+    """ In the child of a fork: opens new connections for a plain consul.Consul, too. """
+    # Not the wrapper of metrics, which counts the requests.
+    http = getattr(con.http, "_http", con.http)
+    session = getattr(http, "session", None)
+    if isinstance(session, requests.Session) and not isinstance(http, PooledHTTPClient):
+        http.session = requests.Session()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class PooledConsul(consul.Consul):
+    """ consul.Consul using PooledHTTPClient. Safe to share between threads. """
+
+    def __init__(self, *args, blocking_pool_size=32, pool_size=8, timeout=10, margin=5, **kwargs):
+        """
+        Takes the arguments of consul.Consul and:
+
+        :param blocking_pool_size: connections kept alive for blocking queries.
+        :param pool_size: connections kept alive for all other requests.
+        :param timeout: timeout in seconds of requests which are not blocking queries.
+        :param margin: seconds a blocking query may take longer than its wait time.
+        """
+        self._pool_options = {
+            "blocking_pool_size": blocking_pool_size,
+            "pool_size": pool_size,
+            "timeout": timeout,
+            "margin": margin,
+        }
+        super().__init__(*args, **kwargs)
+
+    def connect(self, host, port, scheme, verify=True, cert=None):
+        return PooledHTTPClient(host, port, scheme, verify, cert, **self._pool_options)
+
+
+class _Endpoint:
+    """ One agent of a MultiEndpointHTTPClient, with its latency and errors. """
+
+    # Weight of the latest request in the moving average of the latency.
+    alpha = 0.3
+    # Seconds an agent is skipped after its first error, doubled with every further one.
+    backoff = 0.5
+    max_backoff = 30
+
+    def __init__(self, client):
+        self.client = client
+        self.address = "%s:%s" % (client.host, client.port)
+        # Moving average of the latency of requests which are not blocking queries.
+        self.latency = None
+        # Consecutive errors.
+        self.errors = 0
+        self.down_until = 0
+
+    @property
+    def healthy(self):
+        return self.down_until <= time.monotonic()
+
+    def succeeded(self, latency):
+        self.errors = 0
+        self.down_until = 0
+        if latency is not None:
+            self.latency = latency if self.latency is None else \
+                self.alpha * latency + (1 - self.alpha) * self.latency
+
+    def failed(self):
+        self.errors += 1
+        self.down_until = time.monotonic() + min(self.backoff * 2 ** (self.errors - 1), self.max_backoff)
+
+    def __repr__(self):
+        return "<_Endpoint %s latency=%s errors=%d>" % (self.address, self.latency, self.errors)
+
+
+def _agent_error(error):
+    """ Whether error is a problem of the agent, which another agent might not have. """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    # 5xx, e.g. "No known Consul servers" of a restarting agent. 4xx are
+    # raised as subclasses and are answers of the cluster.
+    return type(error) is base.ConsulException and str(error)[:1] == "5"
+
+
+class MultiEndpointHTTPClient(base.HTTPClient):
+    """
+    HTTP client for MultiConsul.
+
+    Sends each request to the healthy agent with the lowest latency. After a
+    connection error, a timeout or a 5xx answer, the request is repeated on
+    the next agent and the failed agent is skipped for a while, longer with
+    every further error. Agents without measurements are tried first, so
+    every agent gets measured. Blocking queries do not count for the latency.
+
+    Requests which failed after they reached the agent may have been applied,
+    so they are only safe to repeat if they are idempotent. The requests of
+    Lock, Semaphore and SessionRenewer are; a session created twice expires
+    after its ttl.
+    """
+
+    def __init__(self, endpoints, scheme="http", verify=True, cert=None, **pool_options):
+        """
+        :param endpoints: list of (host, port).
+        :param pool_options: arguments of PooledHTTPClient for each agent.
+        """
+        host, port = endpoints[0]
+        super().__init__(host, port, scheme, verify, cert)
+        self.endpoints = [_Endpoint(PooledHTTPClient(host, port, scheme, verify, cert, **pool_options))
+                          for host, port in endpoints]
+        self._mutex = threading.Lock()
+
+    def _ordered(self):
+        """ The endpoints in the order to try them. """
+        with self._mutex:
+            healthy = [x for x in self.endpoints if x.healthy]
+            down = [x for x in self.endpoints if not x.healthy]
+        healthy.sort(key=lambda x: -1 if x.latency is None else x.latency)
+        # If all are down, try them anyway, the one which is back first first.
+        down.sort(key=lambda x: x.down_until)
+        return healthy + down
+
+    def _request(self, method, callback, path, params=None, **kwargs):
+        blocking = dict(params or ()).get("index") is not None
+        error = None
+        for endpoint in self._ordered():
+            start = time.monotonic()
+            try:
+                result = getattr(endpoint.client, method)(callback, path, params=params, **kwargs)
+            except Exception as e:
+                if not _agent_error(e):
+                    with self._mutex:
+                        endpoint.succeeded(None)
+                    raise
+                with self._mutex:
+                    endpoint.failed()
+                LOG.warning("Agent %s failed on %s %s, trying the next one: %s", endpoint.address,
+                            method.upper(), path, e)
+                error = e
+                continue
+            with self._mutex:
+                endpoint.succeeded(None if blocking else time.monotonic() - start)
+            return result
+        raise error
+
+    def get(self, callback, path, params=None):
+        return self._request("get", callback, path, params)
+
+    def put(self, callback, path, params=None, data=""):
+        return self._request("put", callback, path, params, data=data)
+
+    def delete(self, callback, path, params=None):
+        return self._request("delete", callback, path, params)
+
+    def post(self, callback, path, params=None, data=""):
+        return self._request("post", callback, path, params, data=data)
+
+
+def _endpoint(address):
+    host, _, port = address.rpartition(":") if ":" in address else (address, None, "8500")
+    return host, int(port)
+
+
+class MultiConsul(PooledConsul):
+    """
+    consul.Consul using the fastest of several agents, see
+    MultiEndpointHTTPClient. Safe to share between threads.
+
+    Sessions are bound to the node of the agent which created them. They can
+    be renewed through any agent, but are still invalidated, if consul
+    considers that node as failed.
+    """
+
+    def __init__(self, endpoints, **kwargs):
+        """
+        Takes the arguments of PooledConsul, but instead of host and port:
+
+        :param endpoints: addresses of the agents, e.g. ["consul1:8500", "consul2:8500"].
+                          The port defaults to 8500.
+        """
+        self._endpoints = [_endpoint(x) for x in endpoints]
+        if not self._endpoints:
+            raise ValueError("MultiConsul needs at least one endpoint")
+        host, port = self._endpoints[0]
+        super().__init__(host=host, port=port, **kwargs)
+
+    def connect(self, host, port, scheme, verify=True, cert=None):
+        return MultiEndpointHTTPClient(self._endpoints, scheme, verify, cert, **self._pool_options)
@@ -0,0 +1,111 @@
+"""
+Consistency modes of reads.
+
+- "default": answered by the leader. Can be stale for a short time after a
+  leader election.
+- "stale": answered by any server, also without a leader. Spreads the load
+  over all servers. How old the answer may be, is reported by the server as
+  X-Consul-LastContact.
+- "consistent": answered by the leader after confirming its leadership with
+  a quorum. One more round trip between the servers.
+
+read() returns the LastContact of the answer and repeats stale reads with
+default consistency, if the answering server lost contact to the leader for
+longer than max_stale.
+"""
+import logging
+
+from consul.base import CB
+
+from .client import _seconds
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT = "default"
+STALE = "stale"
+CONSISTENT = "consistent"
+MODES = (DEFAULT, STALE, CONSISTENT)
+# Default of max_stale: seconds a server answering a stale read may have lost
+# contact to the leader.
+MAX_STALE = 5
+
+
+class Result:
+    """ Answer of read(). last_contact is in seconds, 0 for answers of the leader. """
+
+    def __init__(self, index, data, last_contact, known_leader, consistency):
+        self.index = index
+        self.data = data
+        self.last_contact = last_contact
+        self.known_leader = known_leader
+        self.consistency = consistency
+
+    def __iter__(self):
+        # Unpacks like the results of python-consul: index, data = read(...)
+        return iter((self.index, self.data))
+
+
+def validate(consistency):
+    if consistency not in MODES:
+        raise ValueError("consistency must be one of %s" % ", ".join(MODES))
+    return consistency
+
+
+def _get(con, path, params, consistency, decode):
+    params = list(params or [])
+    if consistency != DEFAULT:
+        params.append((consistency, "1"))
+    if getattr(con, "token", None):
+        params.append(("token", con.token))
+    if getattr(con, "dc", None) and not any(k == "dc" for k, _ in params):
+        params.append(("dc", con.dc))
+    parse = CB.json(decode=decode)
+
+    def callback(response):
+        # Not sent by agent endpoints.
+        index = response.headers.get("X-Consul-Index")
+        data = None if response.code == 404 else parse(response)
+        last_contact = int(response.headers.get("X-Consul-LastContact") or 0) / 1000.0
+        known_leader = response.headers.get("X-Consul-KnownLeader", "true") == "true"
+        return Result(index, data, last_contact, known_leader, consistency)
+
+    return con.http.get(callback, path, params=params)
+
+
+def read(con, path, params=None, *, consistency=DEFAULT, max_stale=None, decode=False):
+    """
+    GET path with the given consistency.
+
+    :param con: python-consul consul.Consul.
+    :param path: e.g. "/v1/health/state/any".
+    :param params: list of (name, value) query parameters.
+    :param consistency: "default", "stale" or "consistent".
+    :param max_stale: for stale reads: seconds (or a duration like "5s") the
+                      answering server may have lost contact to the leader.
+                      Older answers are read again with default consistency.
+    :param decode: key of the results to base64 decode, e.g. "Value" for KV reads.
+    """
+    validate(consistency)
+    result = _get(con, path, params, consistency, decode)
+    if consistency == STALE and max_stale is not None:
+        if not result.known_leader or result.last_contact > _seconds(max_stale):
+            LOG.debug("Stale read of %s is %.3fs old, reading from the leader.", path, result.last_contact)
+            # Not blocking, the stale answer has been waited for already.
+            params = [(k, v) for k, v in params or [] if k not in ("index", "wait")]
+            result = _get(con, path, params, DEFAULT, decode)
+    return result
+
+
+def kv_get(con, key, *, recurse=False, index=None, wait=None, consistency=DEFAULT, max_stale=None):
+    """ Like con.kv.get(), with consistency and max_stale of read(). """
+    params = []
+    if recurse:
+        params.append(("recurse", "1"))
+    if index:
+        params.append(("index", index))
+        if wait:
+            params.append(("wait", wait))
+    result = read(con, "/v1/kv/%s" % key, params, consistency=consistency, max_stale=max_stale, decode="Value")
+    if not recurse and result.data is not None:
+        result.data = result.data[0] if result.data else None
+    return result
@@ -0,0 +1,294 @@
+import logging
+import socket
+import threading
+import time
+from pathlib import Path
+
+from .consistency import CONSISTENT, MAX_STALE, STALE, kv_get, validate
+from .client import _SharedRegistry
+from .lock import Lock
+
+LOG = logging.getLogger(__name__)
+
+
+class Leader:
+    """ Holder of the lock of an election, as seen by LeaderObserver. """
+
+    def __init__(self, session, payload, index):
+        self.session = session
+        self.payload = payload
+        # LockIndex of the lock key, increases with every new leadership.
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, Leader) and (self.session, self.payload, self.index) == \
+            (other.session, other.payload, other.index)
+
+    def __hash__(self):
+        return hash((self.session, self.index))
+
+    def __repr__(self):
+        return "Leader(session=%r, payload=%r, index=%r)" % (self.session, self.payload, self.index)
+
+
+class LeaderObserver(threading.Thread):
+    """
+    Keeps the leader of an election in memory, updated by one blocking query
+    on its lock key. Use LeaderObserver.shared(), so all elections on the same
+    key within a process share one observer. It stops, when everyone who got
+    it from shared() has called release().
+    """
+
+    _shared = _SharedRegistry()
+
+    def __init__(self, con, path, *, wait="30s", retry_time=2, consistency=STALE, max_stale=MAX_STALE):
+        """
+        :param con: python-consul consul.Consul.
+        :param path: the lock key, e.g. services/my-service/.lock.
+        :param wait: maximum duration of a blocking query.
+        :param retry_time: seconds to wait after a failed request.
+        :param consistency: consistency mode of the reads, see consul_lib.consistency.
+        :param max_stale: seconds a server answering a stale read may have lost
+                          contact to the leader. Older answers are read again.
+        """
+        super().__init__(name="LeaderObserver %s" % path, daemon=True)
+        self._con = con
+        self._path = str(path)
+        self._wait = wait
+        self._retry_time = retry_time
+        self._consistency = validate(consistency)
+        self._max_stale = max_stale
+        self._finished = False
+        self._cond = threading.Condition()
+        self._callbacks = []
+        self._users = 0
+        self._leader = None
+        self._version = 0
+
+    @classmethod
+    def shared(cls, con, path):
+        """ The running observer of path for the client con. Call release() when done. """
+        path = str(path)
+
+        def create():
+            observer = cls(con, path)
+            observer.start()
+            return observer
+
+        with cls._shared.mutex:
+            # Not alive e.g. in the child of a fork.
+            observer = cls._shared.get(con, path, create, valid=lambda x: x.is_alive())
+            observer._users += 1
+            return observer
+
+    def release(self):
+        """ Gives back an observer of shared(). The last one stops it. """
+        with self._shared.mutex:
+            self._users -= 1
+            if self._users > 0:
+                return
+            self._shared.remove(self._con, self._path, self)
+        self.finish()
+
+    @property
+    def ready(self):
+        """ True as soon as the leader has been read once. """
+        return self._version > 0
+
+    def leader(self, timeout=None):
+        """ The current Leader, or None if there is none. Waits at most timeout seconds for the first read. """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.ready, timeout):
+                raise TimeoutError("Leader of %s not read yet" % self._path)
+            return self._leader
+
+    def add_callback(self, callback):
+        """ Calls callback(old, new) with the Leader objects (or None) on every change of leadership. """
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+    def wait_for_change(self, timeout=None):
+        """ Waits for the next change of leadership. Returns False on timeout. """
+        with self._cond:
+            version = self._version
+            return self._cond.wait_for(lambda: self._version != version or self._finished, timeout) \
+                and not self._finished
+
+    def finish(self):
+        with self._cond:
+            self._finished = True
+            self._cond.notify_all()
+
+    def run(self):
+        idx = None
+        while not self._finished:
+            try:
+                new_idx, data = kv_get(self._con, self._path, index=idx, wait=self._wait,
+                                       consistency=self._consistency, max_stale=self._max_stale)
+            except Exception:
+                LOG.warning("Unable to read the leader of %s. Trying again.", self._path, exc_info=True)
+                idx = None
+                time.sleep(self._retry_time)
+                continue
+            # The index may go backwards e.g. after a snapshot restore.
+            idx = new_idx if idx is None or int(new_idx) >= int(idx) else None
+            self._update(_leader(data))
+
+    def _update(self, leader):
+        with self._cond:
+            old = self._leader
+            first = self._version == 0
+            if not first and old == leader:
+                return
+            self._leader = leader
+        if not first:
+            LOG.debug("Leader of %s changed from %s to %s.", self._path, old, leader)
+            for callback in list(self._callbacks):
+                try:
+                    callback(old, leader)
+                except Exception:
+                    LOG.exception("LeaderObserver callback failed.")
+        # After the callbacks, so e.g. LeaderElection.is_leader is up to date for waiters.
+        with self._cond:
+            self._version += 1
+            self._cond.notify_all()
+
+
+def _leader(data):
+    if not data or not data.get("Session"):
+        return None
+    value = data.get("Value")
+    return Leader(data["Session"], value.decode() if value is not None else None, data.get("LockIndex"))
+
+
+class LeaderElection:
+
+    def __init__(self, con, prefix, *, payload=None, ttl=60, lock_delay=15, renew_margin=None):
+        """
+        Leader election on top of Lock.
+
+        The leader holds prefix/.lock with its payload as value. Everyone,
+        leader or follower, can ask for the current leader with
+        current_leader(), which is answered from memory: one LeaderObserver
+        per key and process keeps it up to date with a blocking query.
+
+        Usage:
+
+            election = LeaderElection(con, "services/my-service", payload="host1:8080")
+            election.add_callback(lambda old, new: print("new leader", new))
+            if election.campaign(blocking=False):
+                ...  # lead, while election.is_leader
+            else:
+                print(election.current_leader().payload)
+
+        :param con: python-consul consul.Consul.
+        :param prefix: prefix to use to. E.g. services/my-service.
+        :param payload: published by the leader, e.g. its address. Default: the hostname.
+        :param ttl: ttl of the session in seconds (10 - 86400).
+        :param lock_delay: seconds nobody can become leader after the session
+                           of the leader has been invalidated.
+        :param renew_margin: seconds before the ttl runs out to renew the session.
+        """
+        self._con = con
+        self._path = Path(prefix) / ".lock"
+        self._lock = Lock(con, prefix, payload=payload if payload is not None else socket.gethostname(),
+                          ttl=ttl, lock_delay=lock_delay, renew_margin=renew_margin)
+        self._observer = None
+        self._callbacks = []
+
+    @property
+    def session(self):
+        return self._lock.session
+
+    @property
+    def is_leader(self):
+        """ Whether this instance leads. Turns False when the observer sees someone else as leader and a consistent read confirms it. """
+        return self._lock.locked
+
+    def _observe(self):
+        if self._observer is None:
+            self._observer = LeaderObserver.shared(self._con, self._path)
+            self._observer.add_callback(self._changed)
+        return self._observer
+
+    def _changed(self, old, new):
+        if self._lock.locked and old and old.session == self._lock.session \
+                and (new is None or new.session != old.session) and self._lost():
+            LOG.warning("Lost leadership of %s.", self._path)
+            self._lock.locked = False
+        for callback in list(self._callbacks):
+            try:
+                callback(old, new)
+            except Exception:
+                LOG.exception("LeaderElection callback failed.")
+
+    def _lost(self):
+        """ Confirms a loss seen by the observer, whose read may be stale, with a consistent read. """
+        try:
+            _, data = kv_get(self._con, str(self._path), consistency=CONSISTENT)
+        except Exception:
+            LOG.warning("Unable to confirm the loss of leadership of %s.", self._path, exc_info=True)
+            return False
+        return not data or data.get("Session") != self._lock.session
+
+    def campaign(self, *, blocking=True, wait=None):
+        """
+        Tries to become the leader. Returns True if this instance leads.
+
+        :param blocking: Wait until the current leader resigns. Default True.
+        :param wait: Maximum duration to wait for a change of the leader (e.g. 10s)
+        """
+        self._observe()
+        return self._lock.acquire(blocking=blocking, wait=wait)
+
+    def publish(self, payload):
+        """ Publishes a new payload as leader. Returns False, if this instance does not lead. """
+        if not self._lock.locked:
+            return False
+        self._lock._payload = payload
+        return self._con.kv.put(str(self._path), payload, acquire=self._lock.session)
+
+    def resign(self, *, blocking=True):
+        """ Gives up the leadership and the session. """
+        if self._lock.locked:
+            self._lock.release(blocking=blocking)
+        else:
+            self._lock.close(blocking=blocking)
+
+    def current_leader(self, timeout=None):
+        """
+        Returns the Leader (session, payload, index) or None, from memory.
+        Only the first call waits for a read, at most timeout seconds. Changes
+        show up with the next answer of the blocking query, so right after
+        campaign() it may still return the previous leader.
+        """
+        return self._observe().leader(timeout)
+
+    def add_callback(self, callback):
+        """ Calls callback(old, new) with the Leader objects (or None) on every change of leadership. """
+        self._observe()
+        self._callbacks.append(callback)
+
+    def wait_for_change(self, timeout=None):
+        """ Waits for the next change of leadership. Returns False on timeout. """
+        return self._observe().wait_for_change(timeout)
+
+    def close(self, blocking=True):
+        """ Resigns and stops observing. """
+        self.resign(blocking=blocking)
+        if self._observer is not None:
+            self._observer.remove_callback(self._changed)
+            self._observer.release()
+            self._observer = None
+
+    def __enter__(self):
+        if self.campaign():
+            return self
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.resign()
+        return False
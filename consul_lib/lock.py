@@ -1,14 +1,67 @@
-import atexit
+import collections
 import logging
+import threading
+import time
 from pathlib import Path
-from .session import SessionRenewer
+from . import cleanup, metrics
+from .client import _SharedRegistry, _seconds
+from .session import HostSession, LeaseTracker, SessionRenewer
 
 LOG = logging.getLogger(__name__)
 
 
+def _start_session(owner):
+    """
+    Creates the session of owner, a Lock, MultiLock or RWLock, with its
+    session options and has it renewed by owner.session_renewer.
+    """
+    LOG.debug("Starting session.")
+    owner.session = owner._con.session.create(ttl=owner._ttl, lock_delay=owner._lock_delay,
+                                              behavior=owner._behavior)
+    # Register the session to be renewed periodically
+    # Reason:
+    # During acquire, a prefix/session is acquire=session.
+    # If a Holder fails, without cleanup, it would stuck in Holders.
+    # With a session with, ttl and renew of this session, broken
+    # clients can be detected and removed from Holders.
+    if owner.session_renewer and owner.session_renewer.is_alive():
+        owner.session_renewer._session = owner.session
+    else:
+        LOG.debug("Starting session_renewer.")
+        owner.session_renewer = SessionRenewer(owner.session, owner._con, ttl=owner._ttl,
+                                               renew_margin=owner._renew_margin)
+        owner.session_renewer.start()
+
+
+def _wait_for_key(con, key, wait):
+    """ Blocks until the lock key changes. Returns False, if it did not change within wait. """
+    # getting the current index …
+    idx, data = con.kv.get(key)
+    if data and "Session" not in data:
+        # Released since our attempt, or in lock-delay after the session of
+        # the holder was invalidated. In both cases there might be no further
+        # change to wait for, so retry soon.
+        with metrics.current().waiting():
+            con.kv.get(key, index=idx, wait="1s")
+        return True
+
+    # … and watching for updates
+    # infact, this blocks the program until the data changes
+    # within consul.
+    LOG.debug("Waiting for lock on %s.", key)
+    with metrics.current().waiting():
+        _, data = con.kv.get(key, index=idx, wait=wait)
+    if wait and data and int(data["ModifyIndex"]) == int(idx):
+        LOG.debug("No state change within %s", wait)
+        return False
+    return True
+
+
 class Lock:
 
-    def __init__(self, con, prefix, *, session=None, payload='{"state": "done"}'):
+    def __init__(self, con, prefix, *, session=None, payload='{"state": "done"}', fair=False,
+                 ttl=60, lock_delay=15, behavior="release", renew_margin=None, track_lease=False,
+                 coalesce=False, hold_local=False, pool=None):
         """
         Context manager to use consul session to create a mutex.
         Have a look at: https://www.consul.io/docs/guides/leader-election.html
@@ -17,27 +70,86 @@ class Lock:
 
         :param con: python-consul consul.Consul.
         :param prefix: prefix to use to. E.g. services/my-service.
-        :param session: create a new Lock object, but reuse session.
+        :param session: create a new Lock object, but reuse session. A
+                        HostSession shares one session between the worker
+                        processes of a host, see session.HostSession.
         :param payload: content of the lock during time of lock. Could be anything human readable.
+        :param fair: hand the lock over in the order of arrival. Waiters queue up
+                     in prefix/.queue and each one only watches its predecessor,
+                     so a release wakes up exactly one waiter.
+        :param ttl: ttl of the session in seconds (10 - 86400). A short ttl detects
+                    broken clients faster, a long ttl needs less renewals.
+        :param lock_delay: seconds the lock can not be acquired after the session
+                           of the holder has been invalidated.
+        :param behavior: "release" or "delete" the lock when the session is invalidated.
+        :param renew_margin: seconds before the ttl runs out to renew the session.
+                             Default: a third of the ttl.
+        :param track_lease: answer acquired from memory, see session.LeaseTracker.
+        :param coalesce: share one session and one acquire in consul with all
+                         other Lock(coalesce=True) of the same client and prefix
+                         in this process. The lock is handed between them in
+                         memory, in the order of arrival. The options of the
+                         first of them are used for the lock in consul.
+        :param hold_local: with coalesce: keep the lock in consul as long as
+                           contenders of this process wait for it.
+        :param pool: take the session from this SessionPool and give it back
+                     on release instead of destroying it. The session options
+                     of the pool are used instead of ttl, lock_delay,
+                     behavior and renew_margin.
         """
         self._con = con
         self._prefix = Path(prefix)
         self._path = self._prefix / ".lock"
+        self._queue = self._prefix / ".queue"
+        self._fair = fair
         self._payload = payload
-        self._ttl = 60
-        if session:
+        self._ttl = ttl
+        self._lock_delay = lock_delay
+        self._behavior = behavior
+        self._renew_margin = renew_margin
+        # Workers of a host with a HostSession exclude each other with a file lock.
+        self._host = session if isinstance(session, HostSession) else None
+        self._local_lock = None
+        if self._host and (fair or coalesce):
+            raise ValueError("A HostSession can not be used with fair or coalesce")
+        if self._host:
+            self.session = self._host.id
+        elif session:
             self.session = session
         else:
             self.session = None
         self.session_renewer = None
+        self._pool = pool
+        # Whether session has been taken from the pool.
+        self._pooled = False
         self.locked = False
+        self._lease = LeaseTracker(self) if track_lease else None
+        self._coalesce = coalesce
+        self._hold_local = hold_local
+        # The _Arbiter of the last acquire with coalesce.
+        self._arbiter = None
 
     @property
     def acquired(self):
+        if self._lease:
+            return self._lease.held()
+        if self._host and self._local_lock is None:
+            # Held by another worker with the same session, maybe.
+            return False
         _, consul_data = self._con.kv.get(str(self._path))
         return consul_data and "Session" in consul_data and consul_data["Session"] == self.session
 
+    def _holds(self, entries):
+        """ Whether entries (key -> kv entry below the prefix) show this lock as held. """
+        data = entries.get(str(self._path))
+        return bool(data and data.get("Session") == self.session)
+
     def reset_session(self):
+        if self._pooled:
+            # Kept by the caller, renewed no more, like without a pool.
+            self.session_renewer.finish()
+            self.session_renewer = None
+            self._pooled = False
         self.session = None
 
     def acquire(self, *, blocking=True, wait=None):
@@ -48,40 +160,107 @@ class Lock:
                          Take care to .close() when you are done.
         :param wait: Maximum duration to wait for a key change (e.g. 10s)
         """
-        # Create a session with a ttl of 60s.
+        with metrics.span("lock.acquire", self._con, prefix=str(self._prefix), fair=self._fair,
+                          coalesce=self._coalesce) as span:
+            if self._coalesce:
+                self._arbiter = _Arbiter.get(self)
+                acquired = self._arbiter.acquire(self, blocking=blocking, wait=wait)
+            elif self._host:
+                acquired = self._acquire_host(blocking=blocking, wait=wait)
+            else:
+                acquired = self._acquire(blocking=blocking, wait=wait)
+            span.set_attribute("acquired", acquired)
+        if acquired and self._lease:
+            self._lease.start()
+        return acquired
+
+    def _acquire(self, *, blocking=True, wait=None):
+        # Create a session with a ttl (default 60s).
         # So it is possible to find broken clients.
+        if not self.session and self._pool is not None:
+            self.session, self.session_renewer = self._pool.checkout()
+            self._pooled = True
         if not self.session:
-            LOG.debug("Starting session.")
-            self.session = self._con.session.create(ttl=self._ttl)
-            # Kick off a Thread to periodically renew the session
-            # Reason:
-            # During acquire, a prefix/session is acquire=session.
-            # If a Holder fails, without cleanup, it would stuck in Holders.
-            # With a session with, ttl and renew of this session, broken
-            # clients can be detected and removed from Holders.
-            if self.session_renewer and self.session_renewer.is_alive():
-                self.session_renewer._session = self.session
-            else:
-                LOG.debug("Starting session_renewer.")
-                self.session_renewer = SessionRenewer(self.session, self._con)
-                self.session_renewer.start()
+            _start_session(self)
+        if self._fair:
+            return self._acquire_fair(blocking=blocking, wait=wait)
         while not self._con.kv.put(str(self._path), self._payload, acquire=self.session):
-            # getting the current index …
-            idx, _ = self._con.kv.get(str(self._path))
+            if not blocking:
+                LOG.debug("Could not aquire lock on %s.", self._path)
+                return False
+            metrics.current().retries += 1
+            if not _wait_for_key(self._con, str(self._path), wait):
+                return False
+        self.locked = True
+        return True
 
-            # … and watching for updates
-            # infact, this blocks the program until the data changes
-            # within consul.
-            if blocking:
-                LOG.debug("Waiting for lock on %s.", self._path)
-                _, data = self._con.kv.get(str(self._path), index=idx, wait=wait)
-                if wait and data and int(data["ModifyIndex"]) == int(idx):
-                    LOG.debug("No state change within %s", wait)
+    def _acquire_host(self, *, blocking=True, wait=None):
+        """ Takes the local lock of the workers of the host, then the lock in consul. """
+        if self._local_lock is None:
+            with metrics.current().waiting():
+                self._local_lock = self._host._lock_local(str(self._path), blocking=blocking, wait=wait)
+            if self._local_lock is None:
+                LOG.debug("Could not aquire lock on %s, held by another worker.", self._path)
+                return False
+        if self._acquire(blocking=blocking, wait=wait):
+            return True
+        self._release_local()
+        return False
+
+    def _release_local(self):
+        if self._local_lock is not None:
+            self._host._unlock_local(self._local_lock)
+            self._local_lock = None
+
+    def _acquire_fair(self, *, blocking=True, wait=None):
+        """
+        Waiters are ordered by the CreateIndex of their key in prefix/.queue.
+        Only the first one competes for the lock, every other one waits for
+        the key of its predecessor to change. The holder keeps its key until
+        release(), so deleting it wakes up the next waiter.
+        """
+        key = str(self._queue / self.session)
+        if not self._con.kv.put(key, self._payload, acquire=self.session):
+            return False
+        while True:
+            waiters = self._queued()
+            keys = [x["Key"] for x in waiters]
+            if key not in keys:
+                # Removed by someone else, queue up again.
+                if not self._con.kv.put(key, self._payload, acquire=self.session):
                     return False
-            else:
+                continue
+
+            position = keys.index(key)
+            if position == 0:
+                if self._con.kv.put(str(self._path), self._payload, acquire=self.session):
+                    self.locked = True
+                    return True
+                metrics.current().retries += 1
+            if not blocking or not self._wait_in_queue(waiters, position, wait):
                 LOG.debug("Could not aquire lock on %s.", self._path)
+                self._con.kv.delete(key)
                 return False
-        self.locked = True
+
+    def _queued(self):
+        """ Returns the waiters in the queue, oldest first. Removes abandoned ones. """
+        _, data = self._con.kv.get(str(self._queue), recurse=True)
+        for abandoned in [x for x in data or [] if "Session" not in x]:
+            self._con.kv.delete(abandoned["Key"], cas=abandoned["ModifyIndex"])
+            metrics.current().cleanups += 1
+        return sorted([x for x in data or [] if "Session" in x], key=lambda x: x["CreateIndex"])
+
+    def _wait_in_queue(self, waiters, position, wait):
+        """ Blocks until it is worth trying again. Returns False, if nothing changed within wait. """
+        if position == 0:
+            return _wait_for_key(self._con, str(self._path), wait)
+        predecessor = waiters[position - 1]
+        LOG.debug("Waiting for %s in queue of %s.", predecessor["Key"], self._path)
+        with metrics.current().waiting():
+            _, data = self._con.kv.get(predecessor["Key"], index=predecessor["ModifyIndex"], wait=wait)
+        if wait and data and int(data["ModifyIndex"]) == int(predecessor["ModifyIndex"]):
+            LOG.debug("No state change within %s", wait)
+            return False
         return True
 
     def release(self, *, keep_session=None, blocking=True):
@@ -94,17 +273,45 @@ class Lock:
                              of program.
         """
         LOG.debug("Releasing lock %s.", self._path)
-        self._con.kv.put(str(self._path), None, release=self.session)
-        if keep_session == "always":
-            pass
-        elif keep_session == "exit":
-            # register this session to be cleaned up
-            atexit.register(lambda x: x.close(), self)
-        else:
-            self.close(blocking=blocking)
-        self.locked = False
+        if self._lease:
+            self._lease.stop()
+        with metrics.span("lock.release", self._con, prefix=str(self._prefix), fair=self._fair,
+                          coalesce=self._coalesce):
+            if self._arbiter:
+                self._arbiter.release(self, keep_session=keep_session, blocking=blocking)
+                return
+            self._con.kv.put(str(self._path), None, release=self.session)
+            if self._fair and self.session:
+                # Wakes up the next waiter.
+                self._con.kv.delete(str(self._queue / self.session))
+            if self._host:
+                # The session belongs to the host.
+                self._release_local()
+                self.locked = False
+                return
+            self.locked = False
+            if keep_session == "always":
+                pass
+            elif keep_session == "exit":
+                # register this session to be cleaned up
+                cleanup.register(self)
+            else:
+                self.close(blocking=blocking)
 
     def close(self, blocking=True, timeout=None):
+        cleanup.unregister(self)
+        if self._lease:
+            self._lease.stop()
+        if self._arbiter:
+            # The session belongs to the arbiter.
+            self._arbiter.release(self, blocking=blocking)
+            return
+        if self._host:
+            self._close_host()
+            return
+        if self._pooled:
+            self._give_back()
+            return
         if self.session:
             LOG.debug("Closing session %s.", self.session)
             try:
@@ -116,9 +323,30 @@ class Lock:
         if self.session_renewer:
             self.session_renewer.finish()
             if blocking:
-                LOG.debug("Waiting for SessionRenewer-Thread to terminate.")
+                LOG.debug("Waiting for SessionRenewer to terminate.")
                 self.session_renewer.join(timeout)
 
+    def _close_host(self):
+        if self.locked:
+            # The session outlives the lock, so it does not release it.
+            self._con.kv.put(str(self._path), None, release=self.session)
+        self._release_local()
+        self.locked = False
+
+    def _give_back(self):
+        """ Returns the session to the pool. It must not hold anything anymore. """
+        LOG.debug("Giving back session %s.", self.session)
+        if self.locked:
+            # Not released with the session.
+            self._con.kv.put(str(self._path), None, release=self.session)
+        if self._fair:
+            self._con.kv.delete(str(self._queue / self.session))
+        self._pool.checkin(self.session, self.session_renewer)
+        self._pooled = False
+        self.session = None
+        self.session_renewer = None
+        self.locked = False
+
     def __enter__(self):
         if self.acquire():
             return self
@@ -127,3 +355,105 @@ class Lock:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.release()
         return False
+
+
+class _Arbiter:
+    """
+    Lets all Lock(coalesce=True) of one client and prefix in this process
+    compete in memory. The first local contender in line acquires the lock in
+    consul with a Lock of the arbiter, everyone else waits on a condition. A
+    release hands the lock over to the next local contender without asking
+    consul, if the arbiter holds it for them (hold_local), otherwise it is
+    released in consul and the next one in line acquires it again.
+    """
+
+    _shared = _SharedRegistry()
+
+    def __init__(self, lock):
+        self._con = lock._con
+        self._prefix = str(lock._prefix)
+        self._lock = Lock(lock._con, lock._prefix, payload=lock._payload, fair=lock._fair, ttl=lock._ttl,
+                          lock_delay=lock._lock_delay, behavior=lock._behavior, renew_margin=lock._renew_margin,
+                          track_lease=lock._hold_local, pool=lock._pool)
+        self._hold_local = lock._hold_local
+        self._cond = threading.Condition()
+        # Local contenders in order of arrival.
+        self._queue = collections.deque()
+        self._owner = None
+        self._acquiring = False
+
+    @classmethod
+    def get(cls, lock):
+        """ The arbiter of the client and prefix of lock. """
+        return cls._shared.get(lock._con, str(lock._prefix), lambda: cls(lock))
+
+    def _drop_if_idle(self):
+        """ Forgets the arbiter once nobody holds or waits for it. Called with the condition held. """
+        if self._queue or self._owner is not None or self._acquiring or self._lock.locked:
+            return
+        if self._lock.session:
+            # Kept for a local contender which did not get the lock in consul,
+            # nobody would renew it anymore.
+            self._lock.close(blocking=False)
+        self._shared.remove(self._con, self._prefix, self)
+
+    def _take(self, lock):
+        self._owner = lock
+        lock.session = self._lock.session
+        lock.locked = True
+        return True
+
+    def acquire(self, lock, *, blocking=True, wait=None):
+        deadline = None if wait is None else time.monotonic() + _seconds(wait)
+        with self._cond:
+            if self._owner is lock:
+                return True
+            self._queue.append(lock)
+            try:
+                while True:
+                    if self._owner is None and self._queue[0] is lock and not self._acquiring:
+                        if self._lock.locked:
+                            # Held for the local contenders with hold_local.
+                            if self._lock.acquired:
+                                LOG.debug("Handing over lock %s in process.", self._prefix)
+                                return self._take(lock)
+                            LOG.warning("Lost lock %s, acquiring it again.", self._prefix)
+                            self._lock.close(blocking=False)
+                        if self._acquire(blocking, wait):
+                            return self._take(lock)
+                        return False
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if not blocking or (remaining is not None and remaining <= 0):
+                        return False
+                    with metrics.current().waiting():
+                        self._cond.wait(remaining)
+            finally:
+                self._queue.remove(lock)
+                self._cond.notify_all()
+                self._drop_if_idle()
+
+    def _acquire(self, blocking, wait):
+        """ Acquires the lock in consul, without holding the condition. """
+        self._acquiring = True
+        self._cond.release()
+        try:
+            return self._lock.acquire(blocking=blocking, wait=wait)
+        finally:
+            self._cond.acquire()
+            self._acquiring = False
+
+    def release(self, lock, *, keep_session=None, blocking=True):
+        with self._cond:
+            if self._owner is not lock:
+                return
+            self._owner = None
+            lock.locked = False
+            lock.session = None
+            if self._queue and self._hold_local and self._lock.locked:
+                # The next local contender takes over.
+                self._cond.notify_all()
+                return
+            # Keep the session for local contenders, which acquire in consul next.
+            self._lock.release(keep_session="always" if self._queue else keep_session, blocking=blocking)
+            self._cond.notify_all()
+            self._drop_if_idle()
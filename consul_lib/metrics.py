@@ -0,0 +1,368 @@
+"""
+Metrics and tracing hooks.
+
+Lock, Semaphore, SessionRenewer and the lock monitors report what they do to
+the recorders registered here. Without a recorder nothing is measured, so the
+hooks cost next to nothing.
+
+Operations (e.g. "lock.acquire") are reported as Span objects with their wall
+time, the time spent in blocking queries, the number of HTTP round trips, CAS
+retries and removed abandoned contenders. Single values (e.g. the latency of
+a session renewal) are reported as Measurement objects.
+
+Example:
+
+    import consul_lib.metrics
+
+    def report(event):
+        print(event)
+
+    consul_lib.metrics.add_callback(report)
+"""
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+_recorders = []
+_recorders_lock = threading.Lock()
+_local = threading.local()
+_install_lock = threading.Lock()
+
+
+class Recorder:
+    """ Base class of recorders. Override the methods you are interested in. """
+
+    def on_span(self, span):
+        pass
+
+    def on_measurement(self, measurement):
+        pass
+
+
+class _CallbackRecorder(Recorder):
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def on_span(self, span):
+        self.callback(span)
+
+    def on_measurement(self, measurement):
+        self.callback(measurement)
+
+
+def add_recorder(recorder):
+    """ Registers a Recorder. Measuring starts with the first one. """
+    global _recorders
+    with _recorders_lock:
+        # Copy on write, so emitting does not need the lock.
+        _recorders = _recorders + [recorder]
+    return recorder
+
+
+def remove_recorder(recorder):
+    global _recorders
+    with _recorders_lock:
+        _recorders = [x for x in _recorders if x is not recorder]
+
+
+def add_callback(callback):
+    """
+    Calls callback with every Span and Measurement.
+
+    Returns the recorder, pass it to remove_recorder() to stop.
+    """
+    return add_recorder(_CallbackRecorder(callback))
+
+
+def enabled():
+    return bool(_recorders)
+
+
+def _emit(method, event):
+    for recorder in _recorders:
+        try:
+            getattr(recorder, method)(event)
+        except Exception:
+            LOG.exception("Metrics recorder %r failed.", recorder)
+
+
+class Measurement:
+    """ A single value, e.g. the latency of one session renewal in seconds. """
+
+    def __init__(self, name, value, attributes):
+        self.name = name
+        self.value = value
+        self.attributes = attributes
+
+    def __repr__(self):
+        return "<Measurement %s=%.6f %s>" % (self.name, self.value, self.attributes)
+
+
+def observe(name, value, **attributes):
+    """ Reports a Measurement, if metrics are enabled. """
+    if _recorders:
+        _emit("on_measurement", Measurement(name, value, attributes))
+
+
+class Span:
+    """
+    One operation, modeled after OpenTelemetry spans.
+
+    start_time and end_time are unix timestamps, duration, wait_time in seconds.
+    error is the exception which ended the span, if any.
+    """
+
+    def __init__(self, name, con, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start_time = None
+        self.end_time = None
+        self.duration = None
+        self.wait_time = 0.0
+        self.round_trips = 0
+        self.retries = 0
+        self.cleanups = 0
+        self.error = None
+        self._con = con
+        self._started = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def waiting(self):
+        """ Context manager adding its duration to wait_time, e.g. around a blocking query. """
+        return _Waiting(self)
+
+    def __enter__(self):
+        if self._con is not None:
+            _count_round_trips(self._con)
+        _spans().append(self)
+        self.start_time = time.time()
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.duration = time.monotonic() - self._started
+        self.end_time = self.start_time + self.duration
+        self.error = exc_val
+        spans = _spans()
+        if spans and spans[-1] is self:
+            spans.pop()
+        _emit("on_span", self)
+        return False
+
+    def __repr__(self):
+        return "<Span %s duration=%.6f wait=%.6f round_trips=%d retries=%d cleanups=%d %s>" % (
+            self.name, self.duration or 0, self.wait_time, self.round_trips, self.retries, self.cleanups,
+            self.attributes)
+
+
+class _Waiting:
+
+    def __init__(self, span):
+        self._span = span
+
+    def __enter__(self):
+        self._started = time.monotonic()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._span.wait_time += time.monotonic() - self._started
+        return False
+
+
+class _NoopSpan:
+    """ Returned while metrics are disabled. Ignores everything. """
+
+    name = None
+    wait_time = 0.0
+    round_trips = 0
+    retries = 0
+    cleanups = 0
+
+    def __setattr__(self, key, value):
+        pass
+
+    def set_attribute(self, key, value):
+        pass
+
+    def waiting(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name, con=None, **attributes):
+    """
+    Returns a context manager measuring an operation.
+
+    :param name: name of the operation, e.g. "lock.acquire".
+    :param con: python-consul client whose HTTP requests are counted as round trips.
+    """
+    if not _recorders:
+        return _NOOP
+    return Span(name, con, attributes)
+
+
+def current():
+    """ The innermost Span of this thread, or a no-op span. """
+    spans = getattr(_local, "spans", None)
+    if spans:
+        return spans[-1]
+    return _NOOP
+
+
+def _spans():
+    spans = getattr(_local, "spans", None)
+    if spans is None:
+        spans = _local.spans = []
+    return spans
+
+
+class _CountingHTTP:
+    """ Wraps the HTTP client of a python-consul client to count requests of the spans of a thread. """
+
+    def __init__(self, http):
+        self._http = http
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+    def _count(self):
+        for active in getattr(_local, "spans", None) or ():
+            active.round_trips += 1
+
+    def get(self, *args, **kwargs):
+        self._count()
+        return self._http.get(*args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        self._count()
+        return self._http.put(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        self._count()
+        return self._http.delete(*args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        self._count()
+        return self._http.post(*args, **kwargs)
+
+
+def _count_round_trips(con):
+    """ Installs _CountingHTTP on con, once. Only happens while metrics are enabled. """
+    http = getattr(con, "http", None)
+    if http is None or isinstance(http, _CountingHTTP):
+        return
+    with _install_lock:
+        if not isinstance(con.http, _CountingHTTP):
+            con.http = _CountingHTTP(con.http)
+
+
+class PrometheusCollector(Recorder):
+    """
+    Aggregates spans and measurements for prometheus_client.
+
+    Usage:
+
+        from prometheus_client import REGISTRY
+        collector = consul_lib.metrics.add_recorder(consul_lib.metrics.PrometheusCollector())
+        REGISTRY.register(collector)
+    """
+
+    def __init__(self, namespace="consul_lib"):
+        self._namespace = namespace
+        self._mutex = threading.Lock()
+        # (operation, outcome) -> [count, seconds, wait seconds, round trips, retries, cleanups]
+        self._operations = {}
+        # name -> [count, sum]
+        self._measurements = {}
+
+    def on_span(self, span):
+        outcome = "error" if span.error is not None else "ok"
+        with self._mutex:
+            values = self._operations.setdefault((span.name, outcome), [0, 0.0, 0.0, 0, 0, 0])
+            values[0] += 1
+            values[1] += span.duration
+            values[2] += span.wait_time
+            values[3] += span.round_trips
+            values[4] += span.retries
+            values[5] += span.cleanups
+
+    def on_measurement(self, measurement):
+        with self._mutex:
+            values = self._measurements.setdefault(measurement.name, [0, 0.0])
+            values[0] += 1
+            values[1] += measurement.value
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, SummaryMetricFamily
+
+        ns = self._namespace
+        with self._mutex:
+            operations = {k: list(v) for k, v in self._operations.items()}
+            measurements = {k: list(v) for k, v in self._measurements.items()}
+
+        duration = SummaryMetricFamily(ns + "_operation_seconds", "Wall time of operations.",
+                                       labels=["operation", "outcome"])
+        wait = CounterMetricFamily(ns + "_operation_wait_seconds", "Time operations spent in blocking queries.",
+                                   labels=["operation", "outcome"])
+        round_trips = CounterMetricFamily(ns + "_round_trips", "HTTP requests to consul.",
+                                          labels=["operation", "outcome"])
+        retries = CounterMetricFamily(ns + "_cas_retries", "Failed check-and-set attempts.",
+                                      labels=["operation", "outcome"])
+        cleanups = CounterMetricFamily(ns + "_cleanups", "Removed abandoned contenders.",
+                                       labels=["operation", "outcome"])
+        for labels, (count, seconds, wait_seconds, requests, cas, removed) in sorted(operations.items()):
+            labels = list(labels)
+            duration.add_metric(labels, count_value=count, sum_value=seconds)
+            wait.add_metric(labels, wait_seconds)
+            round_trips.add_metric(labels, requests)
+            retries.add_metric(labels, cas)
+            cleanups.add_metric(labels, removed)
+        yield duration
+        yield wait
+        yield round_trips
+        yield retries
+        yield cleanups
+
+        for name, (count, total) in sorted(measurements.items()):
+            summary = SummaryMetricFamily("%s_%s" % (ns, name.replace(".", "_")), name)
+            summary.add_metric([], count_value=count, sum_value=total)
+            yield summary
+
+
+class OpenTelemetryExporter(Recorder):
+    """
+    Exports spans to an OpenTelemetry tracer.
+
+    Usage:
+
+        from opentelemetry import trace
+        consul_lib.metrics.add_recorder(consul_lib.metrics.OpenTelemetryExporter(trace.get_tracer("consul_lib")))
+    """
+
+    def __init__(self, tracer):
+        self._tracer = tracer
+
+    def on_span(self, span):
+        attributes = {k: v for k, v in span.attributes.items() if isinstance(v, (str, bool, int, float))}
+        attributes.update({
+            "consul_lib.wait_time": span.wait_time,
+            "consul_lib.round_trips": span.round_trips,
+            "consul_lib.cas_retries": span.retries,
+            "consul_lib.cleanups": span.cleanups,
+        })
+        otel_span = self._tracer.start_span(span.name, start_time=int(span.start_time * 1e9), attributes=attributes)
+        if span.error is not None:
+            otel_span.record_exception(span.error)
+        otel_span.end(end_time=int(span.end_time * 1e9))
@@ -0,0 +1,158 @@
+import logging
+from pathlib import Path
+
+from . import cleanup, metrics, txn
+from .lock import _start_session, _wait_for_key
+
+LOG = logging.getLogger(__name__)
+
+
+class MultiLock:
+
+    def __init__(self, con, prefixes, *, session=None, payload='{"state": "done"}',
+                 ttl=60, lock_delay=15, behavior="release", renew_margin=None):
+        """
+        Context manager holding several locks at once, all or nothing.
+
+        Uses the same prefix/.lock keys as Lock, so a MultiLock of "net/a" and
+        "net/b" excludes Lock(con, "net/a") and vice versa. All keys are locked
+        with one session in a single transaction. While one of the keys is
+        held by someone else, it waits for that key to change.
+
+        :param con: python-consul consul.Consul.
+        :param prefixes: prefixes to lock. E.g. ["net/a", "net/b", "storage/x"].
+        :param session: reuse this session.
+        :param payload: content of the locks during time of lock. Could be anything human readable.
+        :param ttl: ttl of the session in seconds (10 - 86400).
+        :param lock_delay: seconds a lock can not be acquired after the session
+                           of the holder has been invalidated.
+        :param behavior: "release" or "delete" the locks when the session is invalidated.
+        :param renew_margin: seconds before the ttl runs out to renew the session.
+        """
+        # Sorted, so the fallback without transactions always locks in the same order.
+        self._paths = sorted(set(str(Path(prefix) / ".lock") for prefix in prefixes))
+        if not self._paths:
+            raise ValueError("MultiLock needs at least one prefix")
+        if len(self._paths) > txn.MAX_OPERATIONS:
+            raise ValueError("MultiLock can lock at most %d prefixes" % txn.MAX_OPERATIONS)
+        self._con = con
+        self._payload = payload
+        self._ttl = ttl
+        self._lock_delay = lock_delay
+        self._behavior = behavior
+        self._renew_margin = renew_margin
+        self._use_txn = True
+        self.session = session
+        self.session_renewer = None
+        self.locked = False
+
+    @property
+    def acquired(self):
+        for path in self._paths:
+            _, data = self._con.kv.get(path)
+            if not data or data.get("Session") != self.session:
+                return False
+        return True
+
+    def acquire(self, *, blocking=True, wait=None):
+        """
+        Returns True, if all locks are held, or False if not.
+
+        :param blocking: Wait until all locks are free. Default True.
+        :param wait: Maximum duration to wait for a key change (e.g. 10s)
+        """
+        with metrics.span("multilock.acquire", self._con, locks=len(self._paths)) as span:
+            acquired = self._acquire(blocking=blocking, wait=wait)
+            span.set_attribute("acquired", acquired)
+            return acquired
+
+    def _acquire(self, *, blocking=True, wait=None):
+        if not self.session:
+            _start_session(self)
+        while True:
+            blocked = self._try_lock()
+            if blocked is None:
+                self.locked = True
+                return True
+            if not blocking:
+                LOG.debug("Could not aquire lock on %s.", blocked)
+                return False
+            metrics.current().retries += 1
+            if not _wait_for_key(self._con, blocked, wait):
+                return False
+
+    def _try_lock(self):
+        """ Tries to lock all keys. Returns None on success, or the key which is held by someone else. """
+        if self._use_txn:
+            operations = [txn.kv("lock", path, self._payload, session=self.session) for path in self._paths]
+            try:
+                txn.execute(self._con, operations)
+                return None
+            except txn.TxnConflict as e:
+                failed = [x for x in e.failed_operations if x is not None]
+                return self._paths[failed[0] if failed else 0]
+            except txn.TxnUnsupported:
+                LOG.info("Transactions are not supported, falling back to single requests.")
+                self._use_txn = False
+        locked = []
+        for path in self._paths:
+            if not self._con.kv.put(path, self._payload, acquire=self.session):
+                # Do not hold some of the locks while waiting.
+                self._unlock(locked)
+                return path
+            locked.append(path)
+        return None
+
+    def _unlock(self, paths):
+        if self._use_txn:
+            try:
+                txn.execute(self._con, [txn.kv("unlock", path, session=self.session) for path in paths])
+                return
+            except txn.TxnConflict:
+                # Some of the locks are not held anymore, release the others one by one.
+                pass
+            except txn.TxnUnsupported:
+                self._use_txn = False
+        for path in paths:
+            self._con.kv.put(path, None, release=self.session)
+
+    def release(self, *, keep_session=None, blocking=True):
+        """
+        :param keep_session: Release the locks, but still keep the session.
+                             Default None. always: just keep. exit: until end
+                             of program.
+        """
+        LOG.debug("Releasing locks %s.", self._paths)
+        if self.session:
+            self._unlock(self._paths)
+        if keep_session == "always":
+            pass
+        elif keep_session == "exit":
+            cleanup.register(self)
+        else:
+            self.close(blocking=blocking)
+        self.locked = False
+
+    def close(self, blocking=True, timeout=None):
+        cleanup.unregister(self)
+        if self.session:
+            LOG.debug("Closing session %s.", self.session)
+            try:
+                self._con.session.destroy(self.session)
+            except Exception:
+                LOG.debug("Unable to destroy session. Consul not available.")
+            self.session = None
+        self.locked = False
+        if self.session_renewer:
+            self.session_renewer.finish()
+            if blocking:
+                self.session_renewer.join(timeout)
+
+    def __enter__(self):
+        if self.acquire():
+            return self
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+        return False
@@ -0,0 +1,136 @@
+"""
+Sessions kept ready for locks and semaphores.
+
+Without a session, every Lock.acquire() creates one and every release()
+destroys it again: two raft commits per cycle on top of the lock itself. A
+SessionPool keeps released sessions renewed for the next user instead:
+
+    pool = consul_lib.SessionPool(con, size=8, ttl=30)
+    lock = consul_lib.Lock(con, "services/my-service", pool=pool)
+    with lock:
+        ...
+
+Sessions are bound to the options of the pool (ttl, lock_delay, behavior).
+Idle sessions are renewed like all others, so the pool keeps at most size of
+them and destroys those idle for longer than max_idle seconds.
+"""
+import collections
+import logging
+import threading
+import time
+
+from . import cleanup
+from .session import SessionRenewer
+
+LOG = logging.getLogger(__name__)
+
+_Idle = collections.namedtuple("_Idle", ["session", "renewer", "since"])
+
+
+class SessionPool:
+
+    def __init__(self, con, *, size=8, max_idle=300, warm=0, ttl=60, lock_delay=15, behavior="release",
+                 renew_margin=None):
+        """
+        :param con: python-consul consul.Consul.
+        :param size: maximum number of idle sessions. Sessions returned to a
+                     full pool are destroyed.
+        :param max_idle: seconds an idle session is kept.
+        :param warm: number of sessions to create right away.
+        :param ttl: ttl of the sessions in seconds (10 - 86400).
+        :param lock_delay: seconds a lock can not be acquired after a session has been invalidated.
+        :param behavior: "release" or "delete" the locks when a session is invalidated.
+        :param renew_margin: seconds before the ttl runs out to renew a session.
+        """
+        self._con = con
+        self.size = size
+        self.max_idle = max_idle
+        self._ttl = ttl
+        self._lock_delay = lock_delay
+        self._behavior = behavior
+        self._renew_margin = renew_margin
+        self._mutex = threading.Lock()
+        # Most recently returned last.
+        self._idle = collections.deque()
+        self._closed = False
+        self.created = 0
+        self.reused = 0
+        self.destroyed = 0
+        for _ in range(min(warm, size)):
+            self._idle.append(_Idle(*self._create(), time.monotonic()))
+        # Destroys the idle sessions at exit.
+        cleanup.register(self)
+
+    def __len__(self):
+        """ Number of idle sessions. """
+        return len(self._idle)
+
+    def _create(self):
+        session = self._con.session.create(ttl=self._ttl, lock_delay=self._lock_delay, behavior=self._behavior)
+        renewer = SessionRenewer(session, self._con, ttl=self._ttl, renew_margin=self._renew_margin)
+        renewer.start()
+        self.created += 1
+        return session, renewer
+
+    def _destroy(self, session, renewer):
+        renewer.finish()
+        try:
+            self._con.session.destroy(session)
+        except Exception:
+            LOG.debug("Unable to destroy session. Consul not available.")
+        self.destroyed += 1
+
+    def _expired(self):
+        """ Takes the idle sessions out which are too old to be kept. """
+        deadline = time.monotonic() - self.max_idle
+        expired = []
+        while self._idle and self._idle[0].since < deadline:
+            expired.append(self._idle.popleft())
+        return expired
+
+    def checkout(self):
+        """ Returns a renewed session and its SessionRenewer, an idle one if there is one. """
+        with self._mutex:
+            expired = self._expired()
+            # The most recently returned one: the others may age out.
+            idle = self._idle.pop() if self._idle else None
+        for stale in expired:
+            self._destroy(stale.session, stale.renewer)
+        while idle:
+            renewer = idle.renewer
+            if renewer.is_alive() and not renewer.invalidated and not renewer.stats.consecutive_failures:
+                self.reused += 1
+                return idle.session, renewer
+            LOG.debug("Idle session %s is not renewed anymore.", idle.session)
+            self._destroy(idle.session, renewer)
+            with self._mutex:
+                idle = self._idle.pop() if self._idle else None
+        return self._create()
+
+    def checkin(self, session, renewer):
+        """
+        Gives back a session of checkout(). It must not hold any lock or
+        contender key anymore.
+        """
+        with self._mutex:
+            keep = not self._closed and len(self._idle) < self.size and renewer.is_alive() \
+                and not renewer.invalidated
+            if keep:
+                self._idle.append(_Idle(session, renewer, time.monotonic()))
+            expired = self._expired()
+        if not keep:
+            self._destroy(session, renewer)
+        for stale in expired:
+            self._destroy(stale.session, stale.renewer)
+
+    def close(self, blocking=True):
+        """ Destroys the idle sessions. Sessions given back later are destroyed, too. """
+        cleanup.unregister(self)
+        with self._mutex:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for entry in idle:
+            self._destroy(entry.session, entry.renewer)
+            if blocking:
+                entry.renewer.join()
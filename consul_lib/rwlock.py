@@ -0,0 +1,207 @@
+import logging
+import socket
+from pathlib import Path
+
+from . import cleanup, metrics
+from .lock import _start_session, _wait_for_key
+
+LOG = logging.getLogger(__name__)
+
+
+class RWLock:
+
+    def __init__(self, con, prefix, *, session=None, payload='{"state": "done"}',
+                 ttl=60, lock_delay=15, behavior="release", renew_margin=None):
+        """
+        Reader-writer lock: any number of readers or one writer.
+
+        Readers hold a key prefix/readers/<session>, writers the key
+        prefix/.writer. A reader writes its key and then reads .writer, a
+        writer locks .writer and then waits until no reader key is left. Both
+        reads are consistent, so a reader and a writer can not miss each other.
+        Writers are preferred: readers back off as soon as a writer waits.
+
+        Usage:
+
+            lock = RWLock(con, "config/snapshot")
+            with lock.read():
+                ...
+            with lock.write():
+                ...
+
+        :param con: python-consul consul.Consul.
+        :param prefix: prefix to use to. E.g. services/my-service.
+        :param session: reuse this session.
+        :param payload: content of .writer during time of lock. Could be anything human readable.
+        :param ttl: ttl of the session in seconds (10 - 86400).
+        :param lock_delay: seconds .writer can not be acquired after the session
+                           of the writer has been invalidated.
+        :param behavior: "release" or "delete" the keys when the session is invalidated.
+        :param renew_margin: seconds before the ttl runs out to renew the session.
+        """
+        self._con = con
+        self._prefix = Path(prefix)
+        self._writer = str(self._prefix / ".writer")
+        # Trailing slash, so the recursive read does not match e.g. "readers2".
+        self._readers = str(self._prefix / "readers") + "/"
+        self._payload = payload
+        self._ttl = ttl
+        self._lock_delay = lock_delay
+        self._behavior = behavior
+        self._renew_margin = renew_margin
+        self.session = session
+        self.session_renewer = None
+        self.locked = False
+        # True while held by a reader, False while held by a writer.
+        self.shared = None
+
+    @property
+    def _reader(self):
+        return self._readers + self.session
+
+    def _holds(self, entries):
+        """ Whether entries (key -> kv entry below the prefix) show this lock as held. """
+        data = entries.get(self._reader if self.shared else self._writer)
+        return bool(data and data.get("Session") == self.session)
+
+    def acquire(self, *, shared=False, blocking=True, wait=None):
+        """
+        :param shared: acquire as a reader. Default False, as writer.
+        :param blocking: Wait for the lock. Default True.
+        :param wait: Maximum duration to wait for a key change (e.g. 10s)
+        """
+        with metrics.span("rwlock.acquire", self._con, prefix=str(self._prefix), shared=shared) as span:
+            self._ensure_session()
+            if shared:
+                acquired = self._acquire_read(blocking, wait)
+            else:
+                acquired = self._acquire_write(blocking, wait)
+            span.set_attribute("acquired", acquired)
+        if acquired:
+            self.locked = True
+            self.shared = shared
+        return acquired
+
+    def _ensure_session(self):
+        if not self.session:
+            _start_session(self)
+
+    def _acquire_read(self, blocking, wait):
+        while True:
+            if not self._con.kv.put(self._reader, socket.gethostname(), acquire=self.session):
+                return False
+            idx, data = self._con.kv.get(self._writer, consistency="consistent")
+            if not data or data.get("Session") in (None, self.session):
+                return True
+            # A writer holds the lock or waits for it. Make way for it.
+            self._con.kv.delete(self._reader)
+            if not blocking:
+                LOG.debug("Could not aquire read lock on %s.", self._prefix)
+                return False
+            metrics.current().retries += 1
+            LOG.debug("Waiting for writer on %s.", self._writer)
+            with metrics.current().waiting():
+                _, data = self._con.kv.get(self._writer, index=idx, wait=wait)
+            if wait and data and int(data["ModifyIndex"]) == int(idx):
+                LOG.debug("No state change within %s", wait)
+                return False
+
+    def _acquire_write(self, blocking, wait):
+        while not self._con.kv.put(self._writer, self._payload, acquire=self.session):
+            if not blocking:
+                LOG.debug("Could not aquire write lock on %s.", self._prefix)
+                return False
+            metrics.current().retries += 1
+            if not _wait_for_key(self._con, self._writer, wait):
+                return False
+        # From now on, new readers back off. Wait for the current ones.
+        idx = None
+        while True:
+            if idx is None:
+                idx, data = self._con.kv.get(self._readers, recurse=True, consistency="consistent")
+            else:
+                with metrics.current().waiting():
+                    new_idx, data = self._con.kv.get(self._readers, recurse=True, index=idx, wait=wait)
+                if wait and int(new_idx) == int(idx):
+                    LOG.debug("No state change within %s", wait)
+                    break
+                idx = new_idx
+            if not self._active_readers(data):
+                return True
+            if not blocking:
+                break
+        self._con.kv.put(self._writer, None, release=self.session)
+        return False
+
+    def _active_readers(self, data):
+        """ Returns the number of readers. Removes keys of readers whose session is gone. """
+        readers = 0
+        for entry in data or []:
+            if "Session" not in entry:
+                self._con.kv.delete(entry["Key"], cas=entry["ModifyIndex"])
+                metrics.current().cleanups += 1
+            elif entry["Session"] != self.session:
+                readers += 1
+        return readers
+
+    def release(self, *, keep_session=None, blocking=True):
+        """
+        :param keep_session: Release the lock, but still keep the session.
+                             Default None. always: just keep. exit: until end
+                             of program.
+        """
+        LOG.debug("Releasing lock %s.", self._prefix)
+        if self.session and self.locked:
+            if self.shared:
+                # Deleting the key wakes up a waiting writer.
+                self._con.kv.delete(self._reader)
+            else:
+                self._con.kv.put(self._writer, None, release=self.session)
+        self.locked = False
+        self.shared = None
+        if keep_session == "always":
+            pass
+        elif keep_session == "exit":
+            cleanup.register(self)
+        else:
+            self.close(blocking=blocking)
+
+    def close(self, blocking=True, timeout=None):
+        cleanup.unregister(self)
+        if self.session:
+            LOG.debug("Closing session %s.", self.session)
+            try:
+                self._con.session.destroy(self.session)
+            except Exception:
+                LOG.debug("Unable to destroy session. Consul not available.")
+            self.session = None
+        self.locked = False
+        self.shared = None
+        if self.session_renewer:
+            self.session_renewer.finish()
+            if blocking:
+                self.session_renewer.join(timeout)
+
+    def read(self, **kwargs):
+        """ Context manager holding the lock as a reader. Takes the arguments of acquire(). """
+        return _Holding(self, shared=True, **kwargs)
+
+    def write(self, **kwargs):
+        """ Context manager holding the lock as the writer. Takes the arguments of acquire(). """
+        return _Holding(self, shared=False, **kwargs)
+
+
+class _Holding:
+
+    def __init__(self, lock, **kwargs):
+        self._lock = lock
+        self._kwargs = kwargs
+
+    def __enter__(self):
+        if self._lock.acquire(**self._kwargs):
+            return self._lock
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._lock.release()
+        return False
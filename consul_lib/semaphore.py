@@ -1,16 +1,88 @@
-import atexit
 import json
 import logging
 import socket
+import zlib
 from pathlib import Path
-from .session import SessionRenewer
+from . import cleanup, metrics, txn
+from .consistency import CONSISTENT, DEFAULT, kv_get, validate
+from .session import LeaseTracker, SessionRenewer, _entries
 
 LOG = logging.getLogger(__name__)
 
 
+def _used(value):
+    """ Permits taken by the holders in a .lock value. Holders without a weight take one. """
+    weights = value.get("Weights", {})
+    return sum(weights.get(x, 1) for x in value["Holders"])
+
+
+def _prune(value, live):
+    """ Drops the sessions which are not in live from the holders, waiters and weights of a .lock value. """
+    value["Holders"] = [x for x in value["Holders"] if x in live]
+    waiting = [x for x in value.pop("Waiting", []) if x in live]
+    weights = {k: v for k, v in value.pop("Weights", {}).items() if k in value["Holders"] or k in waiting}
+    # Only written if used, so .lock stays as it was for unweighted semaphores.
+    if waiting:
+        value["Waiting"] = waiting
+    if weights:
+        value["Weights"] = weights
+    return value
+
+
+def _admits(value, session, permits):
+    """ Whether permits are free in value and nobody waits for permits in front of session. """
+    waiting = value.get("Waiting", [])
+    if waiting and waiting[0] != session:
+        return False
+    return _used(value) + permits <= value["Limit"]
+
+
+def _queue_up(value, session, permits, blocking):
+    """ Adds session to the waiters of value. Returns False if it does not need to wait there. """
+    if not blocking or permits == 1 or session in value.get("Waiting", []):
+        return False
+    value.setdefault("Waiting", []).append(session)
+    value.setdefault("Weights", {})[session] = permits
+    return True
+
+
+def _take(value, session, permits):
+    """ Adds session with permits to the holders of value. """
+    value["Holders"].append(session)
+    waiting = value.pop("Waiting", [])
+    if session in waiting:
+        waiting.remove(session)
+    if waiting:
+        value["Waiting"] = waiting
+    weights = value.pop("Weights", {})
+    weights.pop(session, None)
+    if permits != 1:
+        weights[session] = permits
+    if weights:
+        value["Weights"] = weights
+
+
+def _give_back(value, session, permits):
+    """ Removes permits of session from value. Returns True if it still holds the rest. """
+    held = value.get("Weights", {}).get(session, 1)
+    if permits is not None and not 1 <= permits <= held:
+        raise ValueError("permits must be between 1 and the %d held" % held)
+    weights = value.pop("Weights", {})
+    weights.pop(session, None)
+    if permits is not None and permits < held:
+        weights[session] = held - permits
+    else:
+        value["Holders"].remove(session)
+    if weights:
+        value["Weights"] = weights
+    return session in weights
+
+
 class Semaphore:
 
-    def __init__(self, con, prefix, size, *, session=None):
+    def __init__(self, con, prefix, size, *, session=None, use_txn=True, fair=False,
+                 ttl=60, lock_delay=15, behavior="release", renew_margin=None, track_lease=False,
+                 consistency=DEFAULT, pool=None, session_renewer=None):
         """
         Context manager to use consul session to create a semaphore.
         Have a look at: https://www.consul.io/docs/guides/semaphore.html
@@ -21,41 +93,100 @@ class Semaphore:
 
         :param con: python-consul consul.Consul.
         :param prefix: prefix to use to. E.g. services/my-service.
+        :param session: reuse this session. Its ttl is not known, so it is
+                        renewed every few seconds, whatever ttl says.
         :param payload: content of the lock during time of lock. Could be anything human readable. Default: lock
+        :param use_txn: acquire with a single transaction per attempt. Falls back to
+                        single requests, if the agent does not support transactions.
+        :param fair: hand out free slots in the order of arrival, waking up only
+                     as many waiters as there are free slots. Needs transactions.
+        :param ttl: ttl of the session in seconds (10 - 86400). A short ttl detects
+                    broken clients faster, a long ttl needs less renewals.
+        :param lock_delay: seconds the contender key can not be acquired after the
+                           session has been invalidated.
+        :param behavior: "release" or "delete" the contender key when the session is invalidated.
+        :param renew_margin: seconds before the ttl runs out to renew the session.
+                             Default: a third of the ttl.
+        :param track_lease: answer acquired() from memory, see session.LeaseTracker.
+        :param consistency: consistency mode of the reads of the prefix with
+                            transactions, see consul_lib.consistency. Each
+                            read is a snapshot and the update a check-and-set
+                            on it, so "stale" is safe, too. After a failed
+                            update the next read is consistent.
+        :param pool: take the session from this SessionPool and give it back
+                     on close instead of destroying it. The session options
+                     of the pool are used.
+        :param session_renewer: SessionRenewer already renewing session, so
+                                no other one is started.
+
+        acquire(permits=n) takes n of the size at once. The weights are kept
+        in .lock next to the holders. A blocked acquire of more than one
+        permit queues up in .lock, and nobody else gets permits until it has
+        been served, so a stream of small requests can not starve it.
         """
-        if session:
+        self._pool = pool if not session else None
+        if self._pool is not None:
+            # Renewed by the pool already.
+            self.session, self.session_renewer = pool.checkout()
+        elif session and session_renewer is not None:
             self.session = session
+            self.session_renewer = session_renewer
         else:
-            # Create a session with a ttl of 60s.
-            # So it is possible to find broken clients.
-            self.session = con.session.create(ttl=60)
-        # Kick off a Thread to periodically renew the session
-        # Reason:
-        # During acquire, a prefix/session is acquire=session.
-        # If a Holder fails, without cleanup, it would stuck in Holders.
-        # With a session with, ttl and renew of this session, broken
-        # clients can be detected and removed from Holders.
-        self.session_renewer = SessionRenewer(self.session, con)
-        self.session_renewer.start()
+            if session:
+                self.session = session
+            else:
+                # Create a session with a ttl (default 60s).
+                # So it is possible to find broken clients.
+                self.session = con.session.create(ttl=ttl, lock_delay=lock_delay, behavior=behavior)
+            # Register the session to be renewed periodically
+            # Reason:
+            # During acquire, a prefix/session is acquire=session.
+            # If a Holder fails, without cleanup, it would stuck in Holders.
+            # With a session with, ttl and renew of this session, broken
+            # clients can be detected and removed from Holders.
+            # The ttl of a session from outside is not known.
+            self.session_renewer = SessionRenewer(self.session, con, ttl=None if session else ttl,
+                                                  renew_margin=renew_margin)
+            self.session_renewer.start()
         self._con = con
         self.prefix = Path(prefix)
         self.size = size
         self.lock_path = str(self.prefix / ".lock")
+        self.locked = False
+        self._use_txn = use_txn
+        self._fair = fair
+        self._lease = LeaseTracker(self) if track_lease else None
+        self._consistency = validate(consistency)
+        # Read consistently after a failed check-and-set.
+        self._conflict = False
 
-    def _cleanup_holders(self, holders):
+    def _cleanup_holders(self, value):
+        # Not stale: the scan must not be older than the read of .lock before.
         _, contender = self._con.kv.get(str(self.prefix), recurse=True)
         if contender:
             LOG.debug("Cleaning up broken clients.")
             abandoned = [x for x in contender if not x["Key"].endswith(".lock") and "Session" not in x]
-            abandoned_sessions = [x["Key"].split("/")[-1] for x in abandoned]
+            # Holders without a contender key held by their session are gone,
+            # also if the key was deleted with session behavior "delete".
+            alive = [x["Key"].split("/")[-1] for x in contender if not x["Key"].endswith(".lock") and "Session" in x]
             for broken in abandoned:
                 self._con.kv.delete(broken["Key"])
-            LOG.debug("Holders before: %s", holders)
-            holders = [x for x in holders if x not in abandoned_sessions]
-            LOG.debug("Holders after: %s", holders)
-        return holders
+            metrics.current().cleanups += len(abandoned)
+            LOG.debug("Holders before: %s", value["Holders"])
+            _prune(value, alive)
+            LOG.debug("Holders after: %s", value["Holders"])
+        return value
 
-    def acquire(self, *, blocking=True):
+    def _holds(self, entries):
+        """ Whether entries (key -> kv entry below the prefix) show this semaphore as held. """
+        contender = entries.get(str(self.prefix / self.session)) if self.session else None
+        data = entries.get(self.lock_path)
+        if not contender or contender.get("Session") != self.session or not data:
+            return False
+        value = json.loads(data["Value"].decode())
+        return self.session in value.get("Holders", [])
+
+    def acquire(self, *, blocking=True, permits=1):
         """
         Returns True, or False if the Semaphore could not be acquired.
 
@@ -63,7 +194,176 @@ class Semaphore:
                          In long running programs this is the best solution.
                          Using consul from a web application should not block, but warn.
                          Take care to .close() when you are done.
+        :param permits: number of permits to take at once, at most size.
+                        If this session already holds the Semaphore, it
+                        keeps the permits it has.
+        """
+        if not 1 <= permits <= self.size:
+            raise ValueError("permits must be between 1 and size")
+        if permits != 1 and self._fair:
+            raise ValueError("permits are not supported with fair")
+        with metrics.span("semaphore.acquire", self._con, prefix=str(self.prefix), size=self.size,
+                          fair=self._fair, permits=permits) as span:
+            acquired = self._acquire(blocking=blocking, permits=permits)
+            span.set_attribute("acquired", acquired)
+        if acquired and self._lease:
+            self._lease.start()
+        return acquired
+
+    def _acquire(self, *, blocking=True, permits=1):
+        if self._use_txn or self._fair:
+            try:
+                if self._fair:
+                    return self._acquire_fair(blocking=blocking)
+                return self._acquire_txn(blocking=blocking, permits=permits)
+            except txn.TxnUnsupported:
+                LOG.info("Transactions are not supported, falling back to single requests.")
+                self._use_txn = False
+                self._fair = False
+        return self._acquire_keys(blocking=blocking, permits=permits)
+
+    def _acquire_txn(self, *, blocking=True, permits=1):
+        """
+        Each attempt is one recursive read of the prefix and one transaction,
+        which creates the contender key, removes abandoned contenders and
+        updates .lock with check-and-set. It fails as a whole, if someone
+        else changed .lock in between. Queuing up as waiter for more than one
+        permit is such a transaction, too.
+        """
+        idx = None
+        while True:
+            LOG.debug("Trying to obtain lock")
+            # Blocks on changes below the prefix. So dying holders wake up
+            # waiters, too, not only changes of .lock.
+            idx, data = self._get_prefix(idx)
+            lock, value, abandoned, _ = self._state(data)
+
+            if self.session in value["Holders"]:
+                self.locked = True
+                return True
+            if _admits(value, self.session, permits):
+                _take(value, self.session, permits)
+            elif not _queue_up(value, self.session, permits, blocking):
+                if not blocking:
+                    return False
+                continue
+            committed = self._commit(lock, value, abandoned)
+            if committed is None:
+                return False
+            if committed and self.session in value["Holders"]:
+                self.locked = True
+                return True
+            # Do not wait, the state has changed already.
+            idx = None
+            if not blocking:
+                return False
+
+    def _acquire_fair(self, *, blocking=True):
         """
+        Waiters are ordered by the CreateIndex of their contender key. Only as
+        many waiters as there are free slots try to acquire. The first waiter
+        watches the prefix, every other one waits for the key of its
+        predecessor to change, which happens when the predecessor becomes a
+        holder (its key is rewritten) or gives up (its key is deleted).
+        """
+        contender_path = str(self.prefix / self.session)
+        enqueue = True
+        idx = None
+        while True:
+            if enqueue and not self._con.kv.put(contender_path, socket.gethostname(), acquire=self.session):
+                return False
+            LOG.debug("Trying to obtain lock")
+            idx, data = self._get_prefix(idx)
+            lock, value, abandoned, contenders = self._state(data)
+            if self.session in value["Holders"]:
+                self.locked = True
+                return True
+
+            waiting = sorted([x for x in contenders if x["Key"].split("/")[-1] not in value["Holders"]],
+                             key=lambda x: x["CreateIndex"])
+            keys = [x["Key"] for x in waiting]
+            # Not in the queue, if the key has been removed by someone else.
+            enqueue = contender_path not in keys
+            position = 0 if enqueue else keys.index(contender_path)
+            if not enqueue and position < value["Limit"] - _used(value):
+                _take(value, self.session, 1)
+                committed = self._commit(lock, value, abandoned)
+                if committed is not False:
+                    self.locked = bool(committed)
+                    return self.locked
+            if not blocking:
+                break
+            if position > 0:
+                predecessor = waiting[position - 1]
+                LOG.debug("Waiting for %s in queue of %s.", predecessor["Key"], self.lock_path)
+                with metrics.current().waiting():
+                    self._con.kv.get(predecessor["Key"], index=predecessor["ModifyIndex"], wait="30s")
+            if position > 0 or enqueue:
+                idx = None
+        self._con.kv.delete(contender_path)
+        return False
+
+    def _get_prefix(self, idx):
+        consistency = CONSISTENT if self._conflict else self._consistency
+        self._conflict = False
+        if idx is None:
+            return kv_get(self._con, str(self.prefix), recurse=True, consistency=consistency)
+        with metrics.current().waiting():
+            return kv_get(self._con, str(self.prefix), recurse=True, index=idx, wait="30s", consistency=consistency)
+
+    def _state(self, data):
+        """
+        Parses a recursive read of the prefix. Returns the .lock entry, its value
+        without gone holders, the abandoned and the live contender keys.
+        """
+        entries = _entries(data)
+        lock = entries.get(self.lock_path)
+        if lock:
+            value = json.loads(lock["Value"].decode())
+        else:
+            value = {"Limit": self.size,
+                     "Holders": []}
+        # Force setting the Limit parameter. All users of this Semaphore must
+        # have the same opinion about self.size!
+        value["Limit"] = self.size
+
+        contenders = [x for x in entries.values()
+                      if x["Key"].rsplit("/", 1)[0] == str(self.prefix) and not x["Key"].endswith(".lock")]
+        abandoned = [x for x in contenders if "Session" not in x]
+        # Holders without a live contender key are gone, also if the key was
+        # deleted with session behavior "delete".
+        live = [x for x in contenders if "Session" in x]
+        _prune(value, [x["Key"].split("/")[-1] for x in live])
+        return lock, value, abandoned, live
+
+    def _commit(self, lock, value, abandoned):
+        """
+        Writes value, to which this session has been added, in one transaction.
+
+        Returns True on success, False if .lock changed in between and None if
+        the contender key could not be written.
+        """
+        # Writing the contender key also wakes up a waiter watching it.
+        operations = [txn.kv("lock", str(self.prefix / self.session), socket.gethostname(), session=self.session)]
+        # Leftovers are removed by the next attempt.
+        operations += [txn.kv("delete-cas", x["Key"], index=x["ModifyIndex"])
+                       for x in abandoned[:txn.MAX_OPERATIONS - 2]]
+        operations.append(txn.kv("cas", self.lock_path, json.dumps(value),
+                                 index=lock["ModifyIndex"] if lock else 0))
+        try:
+            txn.execute(self._con, operations)
+        except txn.TxnConflict as e:
+            if 0 in e.failed_operations:
+                LOG.debug("Could not write contender %s.", self.session)
+                return None
+            LOG.debug("Semaphore %s changed in between, retrying.", self.lock_path)
+            metrics.current().retries += 1
+            self._conflict = True
+            return False
+        metrics.current().cleanups += len(operations) - 2
+        return True
+
+    def _acquire_keys(self, *, blocking=True, permits=1):
         # This value (socket.gethostname) does not have any technical matter.
         res = self._con.kv.put(str(self.prefix / self.session), socket.gethostname(), acquire=self.session)
         if not res:
@@ -82,7 +382,8 @@ class Semaphore:
             # Both active clients crash. So no update on consul will happen and this get
             # waits until a timeout, to rerun the loop. The timeout by default is 5 minutes.
             # However. This code loops until the lock can be obtained (as long as blocking=True).
-            idx, data = self._con.kv.get(self.lock_path, index=idx or None, wait="30s")
+            with metrics.current().waiting():
+                idx, data = self._con.kv.get(self.lock_path, index=idx or None, wait="30s")
             if data:
                 value = json.loads(data["Value"].decode())
             else:
@@ -97,21 +398,31 @@ class Semaphore:
             value["Limit"] = self.size
 
             # Cleanup. Remove broken clients from Holders.
-            value["Holders"] = self._cleanup_holders(value["Holders"])
+            self._cleanup_holders(value)
 
             if self.session in value["Holders"]:
+                self.locked = True
                 return True
-            if len(value["Holders"]) < value["Limit"]:
-                value["Holders"].append(self.session)
+            admitted = _admits(value, self.session, permits)
+            if admitted:
+                _take(value, self.session, permits)
+            if admitted or _queue_up(value, self.session, permits, blocking):
                 res = self._con.kv.put(self.lock_path, json.dumps(value), cas=idx)
                 if res:
-                    acquired = True
+                    acquired = admitted
+                else:
+                    metrics.current().retries += 1
+                # Read again instead of waiting for the own change.
+                idx = None
             if not blocking:
                 # Return out of the while loop without retrying to acquire lock
                 break
+        self.locked = acquired
         return acquired
 
     def acquired(self):
+        if self._lease:
+            return self._lease.held()
         if not self.session:
             return False
         idx, data = self._con.kv.get(self.lock_path)
@@ -122,7 +433,26 @@ class Semaphore:
         # A KeyError at this point would prevent a cleanup.
         return "Holders" in value and self.session in value["Holders"]
 
-    def release(self, *, keep_session=None, blocking=True):
+    def release(self, *, keep_session=None, blocking=True, permits=None):
+        """
+        Gives back the Semaphore. Returns False if not blocking and .lock changed in between.
+
+        :param keep_session: "exit" keeps the session until the exit of the process.
+        :param blocking: retry until released.
+        :param permits: give back only this many of the permits taken with
+                        acquire(permits=n), at most all of them, and keep
+                        holding the rest. Default: all.
+        """
+        if self._lease and permits is None:
+            self._lease.stop()
+        with metrics.span("semaphore.release", self._con, prefix=str(self.prefix), size=self.size) as span:
+            released = self._release(keep_session=keep_session, blocking=blocking, permits=permits)
+            span.set_attribute("released", released)
+        if self._lease and not self.locked:
+            self._lease.stop()
+        return released
+
+    def _release(self, *, keep_session=None, blocking=True, permits=None):
         released = False
         idx = None
         while not released:
@@ -130,37 +460,247 @@ class Semaphore:
             idx, data = self._con.kv.get(self.lock_path, index=idx)
             if not data:
                 LOG.debug("No lock found, so it is not used by us.")
+                self.locked = False
                 return True
             value = json.loads(data["Value"].decode())
 
             if self.session not in value["Holders"]:
                 LOG.debug("We do not hold this lock.")
+                self.locked = False
                 return True
 
-            value["Holders"].remove(self.session)
+            partial = _give_back(value, self.session, permits)
             # Optimistic put. May need to be retried.
             res = self._con.kv.put(self.lock_path, json.dumps(value), cas=idx)
+            if res and partial:
+                return True
             if res:
                 released = True
+                self.locked = False
+                if self._fair:
+                    # Queue up at the end on the next acquire().
+                    self._con.kv.delete(str(self.prefix / self.session))
+            else:
+                metrics.current().retries += 1
             if not blocking:
                 # Return out of the while loop without retrying to release lock
                 break
         if keep_session == "exit":
             # register this session to be cleaned up
-            atexit.register(lambda x: x.close(blocking), self)
+            cleanup.register(self)
         else:
             self.close(blocking)
         return released
 
     def close(self, blocking=True):
+        cleanup.unregister(self)
+        if self._lease:
+            self._lease.stop()
+        if self._pool is not None:
+            if self.session:
+                LOG.debug("Giving back session %s.", self.session)
+                # Without its contender key, the session is no holder anymore.
+                self._con.kv.delete(str(self.prefix / self.session))
+                self._pool.checkin(self.session, self.session_renewer)
+                self.session = None
+            self.locked = False
+            return
         if self.session:
             LOG.debug("Closing session %s.", self.session)
             self._con.kv.delete(str(self.prefix / self.session))
             self._con.session.destroy(self.session)
             self.session = None
+        self.locked = False
+        self.session_renewer.finish()
+        if blocking:
+            LOG.debug("Waiting for SessionRenewer to terminate.")
+            self.session_renewer.join()
+
+    def __enter__(self):
+        if self.acquire():
+            return self
+        return None
+
+    def __exit__(self, exc_type, exec_val, exec_tb):
+        self.release()
+        return False
+
+
+class _Shard(Semaphore):
+    """ Semaphore on one shard of a ShardedSemaphore, with the session of the ShardedSemaphore. """
+
+    def __init__(self, parent, index, size):
+        super().__init__(parent._con, parent.prefix / ("shard-%d" % index), size, session=parent.session,
+                         use_txn=parent._use_txn, consistency=parent._consistency,
+                         session_renewer=parent.session_renewer)
+
+    def _attempt(self, use_txn):
+        """ Tries to become a holder, without waiting. Returns the result and the index read. """
+        if not use_txn:
+            # Read before the attempt, so waiting on it does not miss a change.
+            idx, _ = self._con.kv.get(self.lock_path)
+            acquired = self._acquire_keys(blocking=False)
+            if not acquired:
+                self._con.kv.delete(str(self.prefix / self.session))
+            return acquired, idx
+        while True:
+            idx, data = self._get_prefix(None)
+            lock, value, abandoned, _ = self._state(data)
+            if self.session in value["Holders"]:
+                return True, idx
+            if len(value["Holders"]) >= value["Limit"]:
+                return False, idx
+            _take(value, self.session, 1)
+            committed = self._commit(lock, value, abandoned)
+            if committed is not False:
+                self.locked = bool(committed)
+                return self.locked, idx
+
+    def _remove(self, blocking):
+        """ Removes the session from the holders. Returns False if not blocking and .lock changed in between. """
+        while True:
+            idx, data = self._con.kv.get(self.lock_path)
+            value = json.loads(data["Value"].decode()) if data else {"Holders": []}
+            if self.session in value["Holders"]:
+                value["Holders"].remove(self.session)
+                if not self._con.kv.put(self.lock_path, json.dumps(value), cas=idx):
+                    metrics.current().retries += 1
+                    if blocking:
+                        continue
+                    return False
+            self._con.kv.delete(str(self.prefix / self.session))
+            self.locked = False
+            return True
+
+
+class ShardedSemaphore:
+
+    def __init__(self, con, prefix, size, *, shards=4, session=None, use_txn=True,
+                 ttl=60, lock_delay=15, behavior="release", renew_margin=None, consistency=DEFAULT):
+        """
+        Semaphore for large sizes, split into shards.
+
+        Every shard is a Semaphore on prefix/shard-<n> with a part of size,
+        the parts add up to size. A client tries the shard its session hashes
+        to first, then the others in order. So holders spread over the shards
+        and check-and-set conflicts only happen between clients of the same
+        shard, while never more than size clients hold the semaphore. Waiting
+        clients watch the whole prefix and try again on any change.
+
+        All users of the semaphore must agree on size and shards. Not
+        compatible with Semaphore(con, prefix, size) on the same prefix.
+
+        :param con: python-consul consul.Consul.
+        :param prefix: prefix to use to. E.g. rollouts/my-rollout.
+        :param size: number of holders at the same time.
+        :param shards: number of shards, at most size.
+        :param session: reuse this session. It is renewed every few seconds,
+                        as its ttl is not known.
+        :param use_txn: see Semaphore.
+        :param ttl: ttl of the session in seconds (10 - 86400).
+        :param lock_delay: seconds the contender key can not be acquired after the
+                           session has been invalidated.
+        :param behavior: "release" or "delete" the contender key when the session is invalidated.
+        :param renew_margin: seconds before the ttl runs out to renew the session.
+        :param consistency: see Semaphore.
+        """
+        if not 1 <= shards <= size:
+            raise ValueError("shards must be between 1 and size")
+        self.session = session or con.session.create(ttl=ttl, lock_delay=lock_delay, behavior=behavior)
+        # The ttl of a session from outside is not known.
+        self.session_renewer = SessionRenewer(self.session, con, ttl=None if session else ttl, renew_margin=renew_margin)
+        self.session_renewer.start()
+        self._con = con
+        self.prefix = Path(prefix)
+        self.size = size
+        self.locked = False
+        self._use_txn = use_txn
+        self._consistency = validate(consistency)
+        self._shards = [_Shard(self, n, size // shards + (1 if n < size % shards else 0)) for n in range(shards)]
+        # The shard holding the semaphore.
+        self._held = None
+
+    def _order(self):
+        """ The shards in the order to try them: the one of the session first. """
+        first = zlib.crc32(self.session.encode()) % len(self._shards)
+        return self._shards[first:] + self._shards[:first]
+
+    def acquire(self, *, blocking=True):
+        """
+        Returns True, or False if the semaphore could not be acquired.
+
+        :param blocking: Wait until a slot becomes free. Default True.
+        """
+        with metrics.span("semaphore.acquire", self._con, prefix=str(self.prefix), size=self.size,
+                          shards=len(self._shards)) as span:
+            acquired = self._acquire(blocking=blocking)
+            span.set_attribute("acquired", acquired)
+            return acquired
+
+    def _acquire(self, *, blocking=True):
+        if self._held:
+            # Already a holder, do not take a slot on another shard.
+            return True
+        idx = 0
+        while True:
+            for shard in self._order():
+                try:
+                    acquired, shard_idx = shard._attempt(self._use_txn)
+                except txn.TxnUnsupported:
+                    LOG.info("Transactions are not supported, falling back to single requests.")
+                    self._use_txn = False
+                    acquired, shard_idx = shard._attempt(self._use_txn)
+                if acquired:
+                    self._held = shard
+                    self.locked = True
+                    return True
+                idx = max(idx, int(shard_idx or 0))
+            if not blocking:
+                return False
+            # All shards are full. Any change below the prefix after the reads
+            # above has a higher index, so no release is missed.
+            LOG.debug("All shards of %s are full, waiting.", self.prefix)
+            with metrics.current().waiting():
+                new_idx, _ = self._con.kv.get(str(self.prefix), keys=True, index=idx, wait="30s")
+            idx = max(idx, int(new_idx))
+
+    def acquired(self):
+        if not self.session or not self._held:
+            return False
+        _, data = self._con.kv.get(self._held.lock_path)
+        if not data:
+            return False
+        return self.session in json.loads(data["Value"].decode()).get("Holders", [])
+
+    def release(self, *, keep_session=None, blocking=True):
+        with metrics.span("semaphore.release", self._con, prefix=str(self.prefix), size=self.size,
+                          shards=len(self._shards)) as span:
+            released = True
+            if self._held:
+                released = self._held._remove(blocking)
+                if released:
+                    self._held = None
+                    self.locked = False
+            span.set_attribute("released", released)
+        if keep_session == "exit":
+            cleanup.register(self)
+        elif keep_session != "always":
+            self.close(blocking)
+        return released
+
+    def close(self, blocking=True):
+        cleanup.unregister(self)
+        if self.session:
+            LOG.debug("Closing session %s.", self.session)
+            if self._held:
+                self._con.kv.delete(str(self._held.prefix / self.session))
+            self._con.session.destroy(self.session)
+            self.session = None
+        self._held = None
+        self.locked = False
         self.session_renewer.finish()
         if blocking:
-            LOG.debug("Waiting for SessionRenewer-Thread to terminate.")
+            LOG.debug("Waiting for SessionRenewer to terminate.")
             self.session_renewer.join()
 
     def __enter__(self):
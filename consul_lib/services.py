@@ -1,4 +1,12 @@
 import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from consul.base import BadRequest
+
+from .consistency import MAX_STALE, STALE, read, validate
 
 LOG = logging.getLogger(__name__)
 
@@ -10,7 +18,10 @@ def get_local_checks(con, tags=[]):
     """
 
     if tags:
-        checks = [k for k, v in con.agent.services().items() if v["Tags"] and set(tags).intersection(set(v["Tags"]))]
+        expression = " or ".join("%s in Tags" % _quote(x) for x in tags)
+        services = _filtered_read(con, "/v1/agent/services", expression).data
+        # Agents without filter support ignore the parameter, so filter here as well.
+        checks = [k for k, v in services.items() if v["Tags"] and set(tags).intersection(set(v["Tags"]))]
     else:
         checks = con.agent.services().keys()
 
@@ -21,7 +32,34 @@ def get_local_checks(con, tags=[]):
     return checks
 
 
-def get_failed_cluster_checks(con, service_names):
+def _quote(value):
+    """ Quotes value as a string of a filter expression. """
+    return '"%s"' % str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+# Filter expressions consul rejected, warned about once.
+_rejected = set()
+
+
+def _filtered_read(con, path, expression, params=None, **kwargs):
+    """
+    read() with filter=expression. Agents which do not know the expression
+    (400 Bad Request) are asked again without it. Agents before consul 1.4
+    ignore the filter, so callers have to filter the results anyway.
+    """
+    try:
+        return read(con, path, list(params or []) + [("filter", expression)], **kwargs)
+    except BadRequest as e:
+        if expression not in _rejected:
+            # Every read transfers everything from now on, tell once.
+            _rejected.add(expression)
+            LOG.warning("Filter %s of %s rejected by consul, reading everything: %s", expression, path, e)
+        else:
+            LOG.debug("Filter %s not supported, filtering locally: %s", expression, e)
+        return read(con, path, params, **kwargs)
+
+
+def get_failed_cluster_checks(con, service_names, *, strategy="auto", consistency=STALE, max_stale=MAX_STALE):
     """
     Returns a dict with all checks where the check status is != passing.
     The service_names parameter is a list of service names.
@@ -29,20 +67,266 @@ def get_failed_cluster_checks(con, service_names):
     If a service has the tag "ignore_maintenance", we ignore the check called
     "_node_maintenance", which is a failing check when the node is in
     maintenance.
+
+    The health of the services can be fetched in different ways, all of them
+    give the same result:
+
+    - "sequential": one health.service request after the other.
+    - "concurrent": health.service requests for all services in parallel.
+    - "bulk": one request for the state of all checks in the cluster, plus one
+      catalog request per node with a failing node check.
+    - "auto" (default): "concurrent" for up to BULK_THRESHOLD services, "bulk" above.
+
+    Only unhealthy instances and failing checks are transferred, filtered by
+    consul. Agents without filter support send everything, the result is the
+    same.
+
+    By default the health is read with consistency "stale", so every consul
+    server can answer. Answers of servers which lost contact to the leader
+    for more than max_stale seconds are read again from the leader. See
+    consul_lib.consistency.
     """
+    service_names = list(service_names)
+    if strategy == "auto":
+        strategy = "bulk" if len(service_names) > BULK_THRESHOLD else "concurrent"
+    if strategy not in _STRATEGIES:
+        raise ValueError("Unknown strategy %s" % strategy)
+    reader = _Reader(con, validate(consistency), max_stale, unhealthy=True)
+    return _failed_checks(_STRATEGIES[strategy](reader, service_names), service_names)
 
-    failed_checks = {}
+
+def _failing(health, service_names, log=True):
+    """ Yields (service name, check) of the failed checks in health (service name -> health.service results). """
     for service_name in service_names:
-        for service_results in con.health.service(service_name)[1]:
+        for service_results in health.get(service_name, []):
             tags = service_results["Service"]["Tags"]
             for check in service_results["Checks"]:
-                LOG.info("Service %s check %s on %s. Status: %s",
-                         service_name, check["CheckID"], check["Node"], check["Status"])
+                if log:
+                    LOG.info("Service %s check %s on %s. Status: %s",
+                             service_name, check["CheckID"], check["Node"], check["Status"])
                 if check["Status"] != "passing":
                     if not ignore_maintenance_check(check["CheckID"], tags):
-                        failed_checks[check["CheckID"]] = check
+                        yield service_name, check
+
+
+def _failed_checks(health, service_names, log=True):
+    """ Evaluates health (service name -> health.service results). """
+    return {check["CheckID"]: check for _, check in _failing(health, service_names, log)}
+
+
+class DatacenterChecks:
+    """
+    Result of get_failed_datacenter_checks().
+
+    failed maps datacenter -> service name -> node -> list of failed checks,
+    for every datacenter which answered. errors maps datacenter -> exception
+    for the others, TimeoutError if it did not answer in time.
+    """
+
+    def __init__(self, failed=None, errors=None):
+        self.failed = failed or {}
+        self.errors = errors or {}
+
+    @property
+    def complete(self):
+        """ True if all datacenters answered. """
+        return not self.errors
+
+    @property
+    def healthy(self):
+        """ True if all datacenters answered and no check failed. """
+        return self.complete and not any(self.failed.values())
+
+    def __repr__(self):
+        return "<DatacenterChecks failed=%r errors=%r>" % (self.failed, self.errors)
+
+
+def get_failed_datacenter_checks(con, service_names, datacenters, *, timeout=None, strategy="auto",
+                                 consistency=STALE, max_stale=MAX_STALE):
+    """
+    get_failed_cluster_checks() for several datacenters at once.
+
+    All datacenters are asked in parallel, so the round trips to the other
+    datacenters overlap. Datacenters which fail or do not answer within
+    timeout seconds are reported in errors of the result, the others in
+    failed. Requests running into the timeout are not aborted, they end
+    with the timeout of the HTTP client (see PooledConsul).
+
+    :param con: python-consul consul.Consul.
+    :param service_names: list of service names.
+    :param datacenters: names of the datacenters, e.g. ["dc1", "dc2", "dc3"].
+    :param timeout: seconds to wait for all datacenters. Default: no limit.
+    :param strategy: see get_failed_cluster_checks().
+    :param consistency: see get_failed_cluster_checks().
+    :param max_stale: see get_failed_cluster_checks().
+    :return: DatacenterChecks
+    """
+    service_names = list(service_names)
+    datacenters = list(datacenters)
+    if strategy == "auto":
+        strategy = "bulk" if len(service_names) > BULK_THRESHOLD else "concurrent"
+    if strategy not in _STRATEGIES:
+        raise ValueError("Unknown strategy %s" % strategy)
+    validate(consistency)
+
+    def evaluate(dc):
+        reader = _Reader(con, consistency, max_stale, unhealthy=True, dc=dc)
+        failed = defaultdict(lambda: defaultdict(list))
+        for name, check in _failing(_STRATEGIES[strategy](reader, service_names), service_names, log=False):
+            failed[name][check["Node"]].append(check)
+        return {name: dict(nodes) for name, nodes in failed.items()}
+
+    result = DatacenterChecks()
+    if not datacenters:
+        return result
+    executor = ThreadPoolExecutor(max_workers=len(datacenters))
+    try:
+        futures = {executor.submit(evaluate, dc): dc for dc in datacenters}
+        done, _ = wait(futures, timeout=timeout)
+    finally:
+        # Do not wait for requests which ran into the timeout.
+        executor.shutdown(wait=False)
+    for future, dc in futures.items():
+        if future not in done:
+            LOG.warning("No health of datacenter %s within %ss.", dc, timeout)
+            result.errors[dc] = TimeoutError("No answer within %ss" % timeout)
+        elif future.exception() is not None:
+            LOG.warning("Unable to get the health of datacenter %s: %s", dc, future.exception())
+            result.errors[dc] = future.exception()
+        else:
+            result.failed[dc] = future.result()
+    return result
+
+
+# Above this number of services, a single request for all checks is cheaper
+# than one request per service.
+BULK_THRESHOLD = 10
+# Maximum number of parallel requests of the "concurrent" strategy.
+MAX_WORKERS = 8
+
+
+# Instances of health.service with at least one check != passing. A selector
+# over the Checks list matches if any check matches, and only supports == and
+# != there. The "_node_maintenance" check is critical, too.
+_UNHEALTHY_INSTANCES = 'Checks.Status == "critical" or Checks.Status == "warning" or Checks.Status == "maintenance"'
+# Checks of health.state != passing.
+_UNHEALTHY_CHECKS = 'Status != "passing"'
+
+
+class _Reader:
+    """
+    Reads the health endpoints with a consistency mode.
+
+    With unhealthy=True only unhealthy instances and failing checks are read,
+    filtered by consul. Passing ones are the vast majority and do not change
+    the result of _failed_checks().
+    """
 
-    return failed_checks
+    def __init__(self, con, consistency, max_stale, unhealthy=False, dc=None):
+        self.con = con
+        self.dc = dc
+        self.consistency = consistency
+        self.max_stale = max_stale
+        self.unhealthy = unhealthy
+        self.last_contact = 0
+
+    def get(self, path, params=None, expression=None):
+        kwargs = {"consistency": self.consistency, "max_stale": self.max_stale}
+        if self.dc:
+            params = list(params or []) + [("dc", self.dc)]
+        if expression and self.unhealthy:
+            result = _filtered_read(self.con, path, expression, params, **kwargs)
+        else:
+            result = read(self.con, path, params, **kwargs)
+        self.last_contact = result.last_contact
+        return result
+
+    def service(self, name):
+        return self.get("/v1/health/service/%s" % name, expression=_UNHEALTHY_INSTANCES).data
+
+    def state(self, state="any", index=None, wait=None):
+        params = [("index", index), ("wait", wait)] if index else []
+        return self.get("/v1/health/state/%s" % state, params, expression=_UNHEALTHY_CHECKS)
+
+    def node_services(self, node):
+        data = self.get("/v1/catalog/node/%s" % node).data
+        return list(((data or {}).get("Services") or {}).values())
+
+
+def _sequential_service_health(reader, service_names):
+    return {name: reader.service(name) for name in service_names}
+
+
+def _concurrent_service_health(reader, service_names):
+    if len(service_names) <= 1:
+        return _sequential_service_health(reader, service_names)
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(service_names))) as executor:
+        results = executor.map(reader.service, service_names)
+        return dict(zip(service_names, results))
+
+
+def _bulk_service_health(reader, service_names):
+    """
+    Rebuilds the relevant part of the health.service results of many services
+    from the state of all checks in the cluster.
+    """
+    checks = reader.state("any").data
+    return _service_health_from_checks(checks, reader.node_services, service_names)
+
+
+def _service_health_from_checks(checks, node_services, service_names=None):
+    """
+    Builds health.service like results from a list of checks.
+
+    Only service instances with at least one check != passing are returned,
+    since instances with passing checks do not add anything to the result.
+
+    :param checks: checks of the cluster, as returned by health.state("any"). The
+                   failing ones are enough.
+    :param node_services: function returning the catalog services of a node.
+    :param service_names: services to return. Default: all.
+    """
+    wanted = set(service_names) if service_names is not None else None
+
+    node_checks = defaultdict(list)
+    service_checks = defaultdict(list)
+    # (node, service id) -> (service name, tags)
+    instances = {}
+    for check in checks or []:
+        if not check["ServiceID"]:
+            node_checks[check["Node"]].append(check)
+        elif wanted is None or check["ServiceName"] in wanted:
+            key = (check["Node"], check["ServiceID"])
+            service_checks[key].append(check)
+            instances[key] = (check["ServiceName"], check.get("ServiceTags") or [])
+
+    # A failing node check affects every service on that node, even services
+    # without checks of their own, so ask the catalog for them.
+    for node, checks in node_checks.items():
+        if all(x["Status"] == "passing" for x in checks):
+            continue
+        for service in node_services(node):
+            if wanted is None or service["Service"] in wanted:
+                instances[(node, service["ID"])] = (service["Service"], service["Tags"])
+
+    health = {name: [] for name in service_names or []}
+    # Same order as health.service: by node, then service id.
+    for node, service_id in sorted(instances):
+        name, tags = instances[(node, service_id)]
+        checks = sorted(node_checks[node] + service_checks[(node, service_id)], key=lambda x: x["CheckID"])
+        if any(x["Status"] != "passing" for x in checks):
+            health.setdefault(name, []).append({
+                "Service": {"ID": service_id, "Service": name, "Tags": tags},
+                "Checks": checks,
+            })
+    return health
+
+
+_STRATEGIES = {
+    "sequential": _sequential_service_health,
+    "concurrent": _concurrent_service_health,
+    "bulk": _bulk_service_health,
+}
 
 
 def ignore_maintenance_check(checkid, tags):
@@ -50,3 +334,138 @@ def ignore_maintenance_check(checkid, tags):
         if checkid == "_node_maintenance":
             return True
     return False
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+class HealthWatcher(threading.Thread):
+    """
+    Keeps the state of all checks of the cluster in memory.
+
+    The state is updated by blocking queries on health.state("any"), so
+    failed_checks() is answered from memory, and polling loops can wait for
+    changes with wait_for_change() or wait_until_healthy().
+
+    Example:
+
+        watcher = HealthWatcher(con)
+        watcher.start()
+        watcher.wait_until_healthy(["service1", "service2"], timeout=600)
+        watcher.finish()
+    """
+
+    def __init__(self, con, *, wait="30s", retry_time=2, consistency=STALE, max_stale=MAX_STALE, **kwargs):
+        """
+        :param con: python-consul consul.Consul.
+        :param wait: maximum duration of a blocking query.
+        :param retry_time: seconds to wait after a failed request.
+        :param consistency: consistency mode of the reads, see consul_lib.consistency.
+        :param max_stale: seconds a server answering a stale read may have lost
+                          contact to the leader. Older answers are read again.
+        """
+        super().__init__(daemon=True, **kwargs)
+        self._con = con
+        self._reader = _Reader(con, validate(consistency), max_stale)
+        self._wait = wait
+        self._retry_time = retry_time
+        self._finished = False
+        self._cond = threading.Condition()
+        self._callbacks = []
+        # service name -> health.service like results of unhealthy instances
+        self._health = {}
+        # (node, check id) -> check
+        self._checks = {}
+        self._version = 0
+
+    @property
+    def last_contact(self):
+        """ Seconds the server answering the last read had lost contact to the leader. """
+        return self._reader.last_contact
+
+    @property
+    def ready(self):
+        """ True as soon as the first state has been loaded. """
+        return self._version > 0
+
+    def add_callback(self, callback):
+        """
+        Calls callback(changes) on every change of a check. changes is a dict
+        of (node, check id) -> (old check or None, new check or None).
+        """
+        self._callbacks.append(callback)
+
+    def failed_checks(self, service_names, timeout=None):
+        """
+        Same result as get_failed_cluster_checks(con, service_names), from memory.
+        Waits for the first state to be loaded, at most timeout seconds.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.ready, timeout):
+                raise TimeoutError("No health state loaded yet")
+            health = self._health
+        return _failed_checks(health, service_names, log=False)
+
+    def wait_for_change(self, timeout=None):
+        """ Waits for the next change of any check. Returns False on timeout. """
+        with self._cond:
+            version = self._version
+            return self._cond.wait_for(lambda: self._version != version or self._finished, timeout) \
+                and not self._finished
+
+    def wait_until_healthy(self, service_names, timeout=None):
+        """
+        Waits until no check of service_names fails.
+        Returns the failed checks, which are empty unless timeout expired.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            failed = self.failed_checks(service_names, timeout=_remaining(deadline))
+            if not failed or not self.wait_for_change(_remaining(deadline)):
+                return failed
+
+    def finish(self):
+        with self._cond:
+            self._finished = True
+            self._cond.notify_all()
+
+    def run(self):
+        idx = None
+        while not self._finished:
+            try:
+                new_idx, checks = self._reader.state("any", index=idx, wait=self._wait)
+                if idx is not None and int(new_idx) == int(idx):
+                    continue
+                health = _service_health_from_checks(checks, self._reader.node_services)
+            except Exception:
+                LOG.warning("Unable to update health state. Trying again.", exc_info=True)
+                idx = None
+                time.sleep(self._retry_time)
+                continue
+            # The index may go backwards e.g. after a snapshot restore.
+            idx = new_idx if idx is None or int(new_idx) >= int(idx) else None
+            self._update(health, checks or [])
+
+    def _update(self, health, checks):
+        checks = {(x["Node"], x["CheckID"]): x for x in checks}
+        with self._cond:
+            old = self._checks
+            first = self._version == 0
+            self._health = health
+            self._checks = checks
+            self._version += 1
+            self._cond.notify_all()
+        changes = {}
+        for key in set(old) | set(checks):
+            before, after = old.get(key), checks.get(key)
+            if before is None or after is None or before["Status"] != after["Status"]:
+                changes[key] = (before, after)
+        if changes and not first:
+            for callback in self._callbacks:
+                try:
+                    callback(changes)
+                except Exception:
+                    LOG.exception("HealthWatcher callback failed.")
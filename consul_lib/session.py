@@ -1,71 +1,551 @@
+import fcntl
+import heapq
+import itertools
 import logging
+import os
+import shutil
+import tempfile
 import threading
 import time
+import weakref
+from pathlib import Path
+
+from consul.base import NotFound
+
+from . import metrics
+from .client import _SharedRegistry, _reconnect, _seconds
+from .consistency import CONSISTENT, MAX_STALE, STALE, kv_get, validate
 
 LOG = logging.getLogger(__name__)
 
 
-class SessionRenewer(threading.Thread):
-    def __init__(self, session, con, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+class SessionRenewalHub:
+    """
+    Renews the sessions of many SessionRenewer from a small pool of threads.
+
+    Registered renewers are kept in a heap ordered by the time of their next
+    renewal. A worker sleeps until the earliest deadline, renews that session
+    and schedules it again. So a process holding hundreds of locks still only
+    runs a handful of threads, and each session is renewed only shortly before
+    its TTL runs out instead of every few seconds.
+
+    A renewal which hangs, e.g. on a plain consul.Consul without a request
+    timeout, only blocks its worker: when all workers are busy, another one
+    is started, up to max_workers. Workers above workers stop again after
+    idle_timeout seconds without work. Use PooledConsul, so hanging requests
+    time out at all.
+
+    After a fork, the child starts its own worker threads for the renewers
+    it inherited, see SessionRenewer(inherit=...).
+    """
+
+    _default = None
+    _default_lock = threading.Lock()
+    _hubs = weakref.WeakSet()
+    # Seconds a worker above workers waits for work before it stops.
+    idle_timeout = 60
+
+    def __init__(self, workers=2, max_workers=16):
+        """
+        :param workers: number of worker threads kept running.
+        :param max_workers: number of worker threads while renewals hang.
+        """
+        self._workers = workers
+        self._max_workers = max(workers, max_workers)
+        self._threads = []
+        # Workers renewing right now.
+        self._busy = 0
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._renewers = set()
+        self.stats = RenewalStats()
+        self._hubs.add(self)
+
+    @classmethod
+    def default(cls):
+        """ The process wide hub used by SessionRenewer if no hub is given. """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def register(self, renewer):
+        with self._cond:
+            self._renewers.add(renewer)
+            self._schedule(renewer, time.monotonic() + renewer.interval)
+            self._start_workers()
+            self._cond.notify()
+
+    def unregister(self, renewer):
+        with self._cond:
+            self._renewers.discard(renewer)
+            renewer._finished = True
+            # The heap entry is dropped lazily, once it is due.
+            if not renewer._renewing:
+                renewer._stopped.set()
+            self._cond.notify_all()
+
+    def _after_fork(self):
+        """ In the child of a fork: the worker threads are gone, and locks may be held by them. """
+        self._cond = threading.Condition()
+        self._threads = []
+        self._busy = 0
+        for renewer in list(self._renewers):
+            if not renewer.inherit:
+                self._renewers.discard(renewer)
+                renewer._finished = True
+            elif renewer._renewing:
+                # The renewal was running in a thread of the parent.
+                renewer._renewing = False
+                self._schedule(renewer, time.monotonic())
+        self._heap = [x for x in self._heap if not x[2]._finished]
+        heapq.heapify(self._heap)
+        if self._heap:
+            self._start_workers()
+
+    def renewers(self):
+        """ The registered renewers. """
+        with self._cond:
+            return list(self._renewers)
+
+    def __len__(self):
+        with self._cond:
+            return len([x for x in self._heap if not x[2]._finished])
+
+    def _schedule(self, renewer, deadline):
+        heapq.heappush(self._heap, (deadline, next(self._counter), renewer))
+
+    def _start_workers(self, count=None):
+        self._threads = [x for x in self._threads if x.is_alive()]
+        while len(self._threads) < (count or self._workers):
+            thread = threading.Thread(target=self._run, name="SessionRenewalHub", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_due(self):
+        """ Blocks until a renewer is due and returns it, or None if the worker can stop. Needs self._cond. """
+        idle_since = time.monotonic()
+        while True:
+            # Another worker without work stays.
+            spare = len(self._threads) > self._workers and len(self._threads) - self._busy > 1
+            if spare and time.monotonic() - idle_since > self.idle_timeout:
+                return None
+            if not self._heap:
+                self._cond.wait(self.idle_timeout)
+                continue
+            deadline, _, renewer = self._heap[0]
+            if renewer._finished:
+                heapq.heappop(self._heap)
+                continue
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                heapq.heappop(self._heap)
+                return renewer
+            self._cond.wait(min(delay, self.idle_timeout))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                renewer = self._next_due()
+                if renewer is None:
+                    if threading.current_thread() in self._threads:
+                        self._threads.remove(threading.current_thread())
+                    return
+                renewer._renewing = True
+                self._busy += 1
+                if self._busy >= len(self._threads) and len(self._threads) < self._max_workers:
+                    # Nobody left for the next renewal, if this one hangs.
+                    self._start_workers(len(self._threads) + 1)
+            try:
+                interval = renewer._renew()
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    renewer._renewing = False
+                    if renewer._finished:
+                        renewer._stopped.set()
+                    else:
+                        self._schedule(renewer, time.monotonic() + interval)
+                    self._cond.notify_all()
+
+
+class RenewalStats:
+    """ Counters of the renewals of a SessionRenewer, or of all renewers of a hub. """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self.renewals = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        # time.monotonic() of the last successful renewal.
+        self.last_success = None
+
+    @property
+    def mean_latency(self):
+        if not self.renewals:
+            return None
+        return self.total_latency / self.renewals
+
+    def record(self, latency, success):
+        with self._mutex:
+            self.renewals += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+            if success:
+                self.consecutive_failures = 0
+                self.last_success = time.monotonic()
+            else:
+                self.failures += 1
+                self.consecutive_failures += 1
+
+    def __repr__(self):
+        return "<RenewalStats renewals=%d failures=%d mean_latency=%s max_latency=%.3f>" % (
+            self.renewals, self.failures, self.mean_latency, self.max_latency)
+
+
+class SessionRenewer:
+    """
+    Keeps a session alive until finish() is called.
+
+    The renewal itself is done by a SessionRenewalHub shared by all renewers
+    of the process. start(), finish(), join() and is_alive() behave like the
+    former thread per session.
+
+    A session with a ttl is renewed renew_margin seconds before the ttl runs
+    out. After a failed renewal, it is retried after a quarter of the time the
+    session has left, so the retries get more frequent the closer the session
+    gets to its expiry. Latency and failures are counted in stats.
+    """
+
+    # Delay before retrying a failed renewal, if nothing is known about the ttl.
+    retry_interval = 5
+    # Seconds between renewals of a session without a known ttl.
+    default_interval = 5
+    # Never renew more often than this.
+    min_interval = 0.5
+
+    def __init__(self, session, con, *, ttl=None, renew_margin=None, hub=None, inherit=True):
+        """
+        :param session: id of the session to renew.
+        :param con: python-consul consul.Consul.
+        :param ttl: ttl of the session in seconds. Without a ttl it is renewed every 5s.
+        :param renew_margin: seconds before the ttl runs out to renew the session.
+                             Default: a third of the ttl.
+        :param hub: SessionRenewalHub to use. Default: SessionRenewalHub.default().
+        :param inherit: keep renewing in the children of a fork, too. The
+                        objects holding the session are copied into the
+                        child, so by default the session stays alive there.
+        """
+        self.inherit = inherit
         self._session = session
         self._con = con
+        self._ttl = ttl
+        self._renew_margin = renew_margin
+        self._hub = hub if hub is not None else SessionRenewalHub.default()
+        self._started = False
         self._finished = False
+        self._renewing = False
+        self._stopped = threading.Event()
+        self.stats = RenewalStats()
+        # Set when consul reports the session as gone.
+        self.invalidated = False
 
-    def run(self):
-        """ Renew the session in a 5 second interval """
-        while not self._finished:
-            try:
-                self._con.session.renew(self._session)
-            except Exception:
-                LOG.warning("Unable to renew session.")
-                # We do not want to return on failure, since a leader election
-                # in the consul cluster can cause a failure of renew.
-                # It is accepted, that this code runs until the finished-flag
-                # is set.
-            time.sleep(5)
+    @property
+    def interval(self):
+        """ Seconds between two successful renewals. """
+        if not self._ttl:
+            return self.default_interval
+        margin = self._ttl / 3 if self._renew_margin is None else self._renew_margin
+        return max(self._ttl - margin, self.min_interval)
+
+    def _retry_delay(self):
+        if not self._ttl or self.stats.last_success is None:
+            return min(self.retry_interval, self.interval)
+        remaining = self.stats.last_success + self._ttl - time.monotonic()
+        if remaining <= 0:
+            return self.retry_interval
+        return max(min(remaining / 4, self.retry_interval), self.min_interval)
+
+    def _renew(self):
+        """ Renews the session once and returns the delay until the next renewal. """
+        start = time.monotonic()
+        try:
+            self._con.session.renew(self._session)
+            self.invalidated = False
+            success = True
+        except NotFound:
+            LOG.warning("Session %s does not exist anymore.", self._session)
+            self.invalidated = True
+            success = False
+        except Exception:
+            LOG.warning("Unable to renew session.")
+            # We do not want to give up on failure, since a leader election
+            # in the consul cluster can cause a failure of renew.
+            # It is accepted, that this is retried until the finished-flag
+            # is set.
+            success = False
+        latency = time.monotonic() - start
+        self.stats.record(latency, success)
+        self._hub.stats.record(latency, success)
+        metrics.observe("session.renew_seconds", latency, success=success)
+        return self.interval if success else self._retry_delay()
+
+    def start(self):
+        if self._started:
+            raise RuntimeError("SessionRenewer can only be started once")
+        self._started = True
+        # The session is expected to be fresh, e.g. just created.
+        self.stats.last_success = time.monotonic()
+        self._hub.register(self)
+
+    def is_alive(self):
+        return self._started and not self._finished
 
     def finish(self):
-        self._finished = True
+        if self._started:
+            self._hub.unregister(self)
+        else:
+            self._finished = True
+            self._stopped.set()
+
+    def join(self, timeout=None):
+        """ Waits until a renewal which is currently in progress is done. """
+        if self._started:
+            self._stopped.wait(timeout)
+
+
+def _after_fork_in_child():
+    SessionRenewalHub._default_lock = threading.Lock()
+    hubs = list(SessionRenewalHub._hubs)
+    # Requests on connections shared with the parent may get its answers.
+    for con in {x._con for hub in hubs for x in hub._renewers if x.inherit}:
+        _reconnect(con)
+    for hub in hubs:
+        hub._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class HostSession:
+    """
+    One session for all worker processes of a host.
+
+    Create it in the parent before forking the workers, and pass it to Lock
+    as session. Only the parent renews it, so the number of sessions and
+    renewals does not grow with the number of workers. A Lock with a
+    HostSession first takes a local file lock for its key, so the workers of
+    the host still exclude each other, and then the lock in consul. Release
+    and close keep the session, only HostSession.close() in the parent
+    destroys it.
+
+    Processes which did not fork from the parent can use the session with
+    HostSession.attach(con, session_id), e.g. with the id passed in an
+    environment variable.
+
+        host = HostSession(con, ttl=30)
+        # fork the workers, in each of them:
+        lock = Lock(con, "services/my-service", session=host)
+
+    Locks with a HostSession are lost, when the parent stops renewing it.
+    """
+
+    def __init__(self, con, *, ttl=60, lock_delay=15, behavior="release", renew_margin=None, session=None):
+        """
+        :param con: python-consul consul.Consul.
+        :param ttl: ttl of the session in seconds (10 - 86400).
+        :param lock_delay: seconds a lock can not be acquired after the session has been invalidated.
+        :param behavior: "release" or "delete" the locks when the session is invalidated.
+        :param renew_margin: seconds before the ttl runs out to renew the session.
+        :param session: use this existing session, which someone else renews.
+        """
+        self._con = con
+        self.session_renewer = None
+        if session:
+            self.id = session
+            self._owner = None
+        else:
+            self.id = con.session.create(ttl=ttl, lock_delay=lock_delay, behavior=behavior)
+            self._owner = os.getpid()
+            self.session_renewer = SessionRenewer(self.id, con, ttl=ttl, renew_margin=renew_margin, inherit=False)
+            self.session_renewer.start()
+        # Local file locks of the workers.
+        self.directory = os.path.join(tempfile.gettempdir(), "consul_lib-%s" % self.id)
+        os.makedirs(self.directory, exist_ok=True)
+
+    @classmethod
+    def attach(cls, con, session_id):
+        """ A HostSession for a session created by another process. """
+        return cls(con, session=session_id)
+
+    def _lock_local(self, key, *, blocking=True, wait=None):
+        """ Takes the local file lock of key. Returns its file descriptor, or None if not acquired. """
+        fd = os.open(os.path.join(self.directory, key.replace("/", "%")), os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = None if wait is None else time.monotonic() + _seconds(wait)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | (fcntl.LOCK_NB if not blocking or deadline else 0))
+                    return fd
+                except BlockingIOError:
+                    if not blocking or time.monotonic() >= deadline:
+                        os.close(fd)
+                        return None
+                    time.sleep(0.01)
+        except Exception:
+            os.close(fd)
+            raise
+
+    @staticmethod
+    def _unlock_local(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def close(self):
+        """ Destroys the session, if this process created it. """
+        if self._owner != os.getpid():
+            return
+        self.session_renewer.finish()
+        try:
+            self._con.session.destroy(self.id)
+        except Exception:
+            LOG.debug("Unable to destroy session. Consul not available.")
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self._owner = None
+
+
+def _lock_prefix(lock):
+    """ The kv prefix below which a Lock or Semaphore keeps its keys. """
+    prefix = getattr(lock, "_prefix", None)
+    if prefix is None:
+        prefix = lock.prefix
+    return str(prefix)
+
+
+def _lock_key(lock):
+    """
+    The key to read for lock._holds() and whether to read below it: the .lock
+    key of a Lock, all keys below the prefix for those which need the keys of
+    the contenders.
+    """
+    path = getattr(lock, "_path", None)
+    if path is not None:
+        return str(path), False
+    return _lock_prefix(lock), True
+
+
+def _entries(data):
+    if isinstance(data, dict):
+        # A single key, read without recurse.
+        return {data["Key"]: data}
+    return {x["Key"]: x for x in data or []}
+
+
+def _observe_detection(confirmed, monitor):
+    """ Reports the time since the lock was last seen held, an upper bound of the loss-detection latency. """
+    if confirmed is not None:
+        metrics.observe("lock_monitor.detection_seconds", time.monotonic() - confirmed, monitor=monitor)
 
 
 class LockMonitor(threading.Thread):
-    """Fires event when lock is lost."""
-    def __init__(self, lock, retries=2, retry_time=2, event=None, *args, **kwargs):
+    """
+    Fires event when lock is lost.
+
+    By default the lock is polled every retry_time seconds. With blocking=True
+    the monitor uses blocking queries instead and notices the loss as soon as
+    consul reports it.
+    """
+    def __init__(self, lock, retries=2, retry_time=2, event=None, *args, blocking=False, wait="30s",
+                 callback=None, consistency=STALE, max_stale=MAX_STALE, **kwargs):
+        """
+        :param lock: Lock or Semaphore to monitor.
+        :param retries: number of failed requests before the lock is considered lost.
+        :param retry_time: seconds between polls, or between retries with blocking=True.
+        :param event: threading.Event to set when the lock is lost.
+        :param blocking: use blocking queries instead of polling.
+        :param wait: maximum duration of a blocking query.
+        :param callback: called with the lock when it is lost.
+        :param consistency: consistency mode of the reads, see consul_lib.consistency.
+                            A loss seen by a read which is not consistent is
+                            confirmed by a consistent read before firing.
+        :param max_stale: seconds a server answering a stale read may have lost
+                          contact to the leader. Older answers are read again.
+        """
         super().__init__(*args, **kwargs)
         self._finished = False
+        # Set by finish(), so the monitor stops without waiting for retry_time.
+        self._wakeup = threading.Event()
         self._lock = lock
         self._lost = False
         self._retries = retries
         self._event = event
+        self._callback = callback
         self._retry_time = retry_time
+        self._blocking = blocking
+        self._wait = wait
+        self._consistency = validate(consistency)
+        self._max_stale = max_stale
+        # Seconds the server answering the last read had lost contact to the leader.
+        self.last_contact = 0
 
     def run(self):
         retries = 0
+        idx = None
+        # Last time the lock was seen held, to measure how long detecting a loss took.
+        confirmed = None
         while not self._finished and not self._lost:
             if self._lock.session:
                 if retries > self._retries:
                     self._lost = True
+                    _observe_detection(confirmed, "lock_monitor")
                 else:
                     try:
                         if self._lock.locked:
-                            _, data = self._lock._con.kv.get(str(self._lock._path))
-                            if not data:
-                                self._lost = True
-                            elif data and data.get("Session", "") != self._lock.session:
+                            key, recurse = _lock_key(self._lock)
+                            result = kv_get(self._lock._con, key, recurse=recurse,
+                                            index=idx if self._blocking else None, wait=self._wait,
+                                            consistency=self._consistency, max_stale=self._max_stale)
+                            idx = result.index
+                            self.last_contact = result.last_contact
+                            if not self._lock._holds(_entries(result.data)) and self._confirm_lost():
                                 self._lost = True
+                                _observe_detection(confirmed, "lock_monitor")
                             else:
                                 retries = 0
+                                confirmed = time.monotonic()
                         else:
+                            idx = None
+                            confirmed = None
                             self._lost = False
                     except Exception:
                         LOG.warning("Unable to get lock. Trying again.", exc_info=True)
                         retries += 1
-            if self._lost and self._event:
-                # Firing the event if there is one.
-                LOG.debug("LockMonitor firing event")
-                self._event.set()
-            time.sleep(self._retry_time)
+                        idx = None
+            if self._lost:
+                self._fire()
+            elif not self._blocking or idx is None:
+                self._wakeup.wait(self._retry_time)
+
+    def _confirm_lost(self):
+        if self._consistency == CONSISTENT:
+            return True
+        key, recurse = _lock_key(self._lock)
+        _, data = kv_get(self._lock._con, key, recurse=recurse, consistency=CONSISTENT)
+        return not self._lock._holds(_entries(data))
+
+    def _fire(self):
+        if self._event:
+            # Firing the event if there is one.
+            LOG.debug("LockMonitor firing event")
+            self._event.set()
+        if self._callback:
+            self._callback(self._lock)
 
     def reset(self):
         self._lost = False
@@ -73,3 +553,265 @@ class LockMonitor(threading.Thread):
 
     def finish(self):
         self._finished = True
+        self._wakeup.set()
+
+
+class LeaseTracker:
+    """
+    Answers whether a Lock or Semaphore is still held from memory.
+
+    The answer is fed by a MonitorHub watching the lock's keys and by the
+    results of the session renewals. As long as the session has been renewed
+    recently, held() does not ask consul. Once the session gets within margin
+    seconds of its ttl without a successful renewal, every call does a
+    consistent read, so the answer is never based on a session which might
+    have expired already.
+    """
+
+    def __init__(self, lock, *, hub=None, margin=None):
+        """
+        :param lock: Lock or Semaphore.
+        :param hub: MonitorHub to watch the lock with. Default: MonitorHub.shared(lock._con).
+        :param margin: seconds before the session's ttl runs out to start reading from consul.
+                       Default: half of the renew margin of the SessionRenewer.
+        """
+        self._lock = lock
+        self._hub = hub if hub is not None else MonitorHub.shared(lock._con)
+        self._margin = margin
+        self._lost = False
+        self._watching = False
+        # Number of reads from consul, e.g. to see that held() is answered from memory.
+        self.checks = 0
+
+    def start(self):
+        """ Starts tracking. The lock must be held. """
+        self._lost = False
+        self._watching = True
+        self._hub.watch(self._lock, callback=self._on_lost)
+
+    def stop(self):
+        if self._watching:
+            self._watching = False
+            self._hub.unwatch(self._lock)
+
+    def _on_lost(self, lock):
+        self._lost = True
+
+    def _fresh(self, renewer):
+        """ Whether the last successful renewal guarantees the session is alive. """
+        if not renewer._ttl or renewer.stats.last_success is None:
+            return False
+        margin = self._margin
+        if margin is None:
+            margin = (renewer._ttl - renewer.interval) / 2
+        return time.monotonic() < renewer.stats.last_success + renewer._ttl - margin
+
+    def held(self):
+        lock = self._lock
+        renewer = lock.session_renewer
+        if renewer is None:
+            # A HostSession: renewed in the process which created it, the
+            # other workers have to ask consul.
+            renewer = getattr(getattr(lock, "_host", None), "session_renewer", None)
+        if self._lost or not self._watching or not lock.locked or not lock.session:
+            return False
+        if renewer is not None and renewer.invalidated:
+            return False
+        if renewer is not None and self._fresh(renewer):
+            return True
+        self.checks += 1
+        key, recurse = _lock_key(lock)
+        try:
+            _, data = kv_get(lock._con, key, recurse=recurse, consistency=CONSISTENT)
+        except Exception:
+            LOG.warning("Unable to check lock %s.", key, exc_info=True)
+            return False
+        if lock._holds(_entries(data)):
+            return True
+        self._lost = True
+        return False
+
+
+class MonitorHub:
+    """
+    Watches many Lock and Semaphore objects with one blocking query per prefix.
+
+    Locks are grouped by a shared prefix (by default the parent of the lock's
+    prefix, e.g. "services" for "services/a" and "services/b"). Each group is
+    served by one thread running a recursive blocking query. When a lock is
+    lost, its event is set and its callback is called, once. A thread stops
+    once it has no locks left to watch.
+    """
+
+    _shared = _SharedRegistry()
+
+    def __init__(self, con, *, wait="30s", retries=2, retry_time=2, consistency=STALE, max_stale=MAX_STALE):
+        """
+        :param con: python-consul consul.Consul used for the blocking queries.
+        :param wait: maximum duration of a blocking query.
+        :param retries: number of failed requests before all locks of a prefix are considered lost.
+        :param retry_time: seconds to wait after a failed request.
+        :param consistency: consistency mode of the blocking queries, see consul_lib.consistency.
+                            Losses seen by reads which are not consistent are
+                            confirmed by a consistent read before firing.
+        :param max_stale: seconds a server answering a stale read may have lost
+                          contact to the leader. Older answers are read again.
+        """
+        self._con = con
+        self._wait = wait
+        self._consistency = validate(consistency)
+        self._max_stale = max_stale
+        self._retries = retries
+        self._retry_time = retry_time
+        self._watchers = {}
+        self._mutex = threading.Lock()
+
+    @classmethod
+    def shared(cls, con):
+        """ A MonitorHub shared by everyone using the client con. """
+        return cls._shared.get(con, None, lambda: cls(con))
+
+    def _drop_if_idle(self):
+        """ Forgets a shared hub without watchers. Called with _mutex held. """
+        if not self._watchers:
+            self._shared.remove(self._con, None, self)
+
+    def watch(self, lock, *, event=None, callback=None, prefix=None):
+        """
+        Start watching a lock. It should be acquired already.
+
+        :param lock: Lock or Semaphore.
+        :param event: threading.Event to set when the lock is lost.
+        :param callback: called with the lock when it is lost.
+        :param prefix: prefix of the blocking query. Must contain the lock's prefix.
+        """
+        if prefix is None:
+            prefix = str(Path(_lock_prefix(lock)).parent)
+            if prefix == ".":
+                prefix = _lock_prefix(lock)
+        prefix = str(prefix)
+        if not _lock_prefix(lock).startswith(prefix):
+            raise ValueError("%s is not below %s" % (_lock_prefix(lock), prefix))
+        with self._mutex:
+            watcher = self._watchers.get(prefix)
+            if watcher is None or not watcher.is_alive():
+                watcher = _PrefixWatcher(self, prefix)
+                self._watchers[prefix] = watcher
+                watcher.add(lock, event, callback)
+                watcher.start()
+            else:
+                watcher.add(lock, event, callback)
+
+    def unwatch(self, lock):
+        with self._mutex:
+            for watcher in self._watchers.values():
+                watcher.remove(lock)
+
+    def finish(self):
+        with self._mutex:
+            for watcher in self._watchers.values():
+                watcher.finish()
+            self._watchers = {}
+            self._drop_if_idle()
+
+
+class _PrefixWatcher(threading.Thread):
+    """ Runs the blocking query for one prefix of a MonitorHub. """
+
+    def __init__(self, hub, prefix):
+        super().__init__(name="MonitorHub %s" % prefix, daemon=True)
+        self._hub = hub
+        self._prefix = prefix
+        self._finished = False
+        self._mutex = threading.Lock()
+        # lock -> (event, callback, number of the first query to check it against)
+        self._locks = {}
+        self._query = 0
+        # Time the last successful query returned.
+        self._confirmed = None
+
+    def add(self, lock, event, callback):
+        with self._mutex:
+            # The query currently running may have been started before the
+            # lock was acquired, so only check the lock with later queries.
+            self._locks[lock] = (event, callback, self._query + 1)
+
+    def remove(self, lock):
+        with self._mutex:
+            self._locks.pop(lock, None)
+
+    def finish(self):
+        self._finished = True
+
+    def _idle(self):
+        """ Stops the watcher, if there is nothing to watch. """
+        with self._hub._mutex, self._mutex:
+            if self._locks:
+                return False
+            if self._hub._watchers.get(self._prefix) is self:
+                del self._hub._watchers[self._prefix]
+                self._hub._drop_if_idle()
+            self._finished = True
+            return True
+
+    def run(self):
+        retries = 0
+        idx = None
+        while not self._finished and not self._idle():
+            with self._mutex:
+                self._query += 1
+                query = self._query
+            try:
+                new_idx, data = kv_get(self._hub._con, self._prefix, recurse=True, index=idx, wait=self._hub._wait,
+                                       consistency=self._hub._consistency, max_stale=self._hub._max_stale)
+            except Exception:
+                LOG.warning("Unable to watch %s. Trying again.", self._prefix, exc_info=True)
+                retries += 1
+                idx = None
+                if retries > self._hub._retries:
+                    self._check(query, None)
+                time.sleep(self._hub._retry_time)
+                continue
+            retries = 0
+            # The index may go backwards e.g. after a snapshot restore.
+            idx = new_idx if idx is None or int(new_idx) >= int(idx) else None
+            self._check(query, _entries(data))
+            self._confirmed = time.monotonic()
+
+    def _lost(self, query, entries):
+        with self._mutex:
+            return [lock for lock, (_, _, first_query) in self._locks.items()
+                    if query >= first_query and lock.session and lock.locked
+                    and (entries is None or not lock._holds(entries))]
+
+    def _confirm(self, query, candidates):
+        """ Returns the candidates which are lost according to a consistent read. """
+        try:
+            _, data = kv_get(self._hub._con, self._prefix, recurse=True, consistency=CONSISTENT)
+        except Exception:
+            LOG.warning("Unable to confirm lost locks below %s.", self._prefix, exc_info=True)
+            return []
+        lost = self._lost(query, _entries(data))
+        return [x for x in candidates if x in lost]
+
+    def _check(self, query, entries):
+        """ Fires all locks lost according to entries. entries None: all are lost. """
+        candidates = self._lost(query, entries)
+        if candidates and entries is not None and self._hub._consistency != CONSISTENT:
+            candidates = self._confirm(query, candidates)
+        lost = []
+        with self._mutex:
+            for lock in candidates:
+                if lock in self._locks:
+                    event, callback, _ = self._locks.pop(lock)
+                    lost.append((lock, event, callback))
+        for lock, event, callback in lost:
+            LOG.debug("MonitorHub: lost lock below %s", self._prefix)
+            _observe_detection(self._confirmed, "monitor_hub")
+            if event:
+                event.set()
+            if callback:
+                try:
+                    callback(lock)
+                except Exception:
+                    LOG.exception("MonitorHub callback failed.")
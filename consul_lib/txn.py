@@ -0,0 +1,84 @@
+"""
+Helpers for consul transactions (/v1/txn).
+
+A transaction applies up to 64 operations atomically: either all of them
+succeed, or none is applied.
+"""
+import base64
+import json
+
+from consul.base import BadRequest, ClientError, NotFound
+
+# Maximum number of operations in one transaction.
+MAX_OPERATIONS = 64
+
+
+class TxnConflict(Exception):
+    """ The transaction was rolled back. errors is the list of consul's error objects. """
+
+    def __init__(self, errors):
+        super().__init__("Transaction rolled back: %s" % errors)
+        self.errors = errors
+
+    @property
+    def failed_operations(self):
+        """ Indexes of the operations which failed. """
+        return [x.get("OpIndex") for x in self.errors or []]
+
+
+class TxnUnsupported(Exception):
+    """ The agent does not support transactions. """
+
+
+def kv(verb, key, value=None, *, index=None, session=None, flags=None):
+    """ Returns a KV operation for execute(). """
+    operation = {"Verb": verb, "Key": str(key)}
+    if value is not None:
+        if isinstance(value, str):
+            value = value.encode()
+        operation["Value"] = base64.b64encode(value).decode()
+    if index is not None:
+        operation["Index"] = int(index)
+    if session is not None:
+        operation["Session"] = session
+    if flags is not None:
+        operation["Flags"] = flags
+    return {"KV": operation}
+
+
+def session(verb, session_id):
+    """ Returns a Session operation for execute(). Consul only knows the verb "delete". """
+    return {"Session": {"Verb": verb, "Session": {"ID": session_id}}}
+
+
+def execute(con, operations):
+    """
+    Executes the operations in one transaction.
+
+    Returns the list of results (KV entries with decoded values).
+    Raises TxnConflict, if the transaction was rolled back and
+    TxnUnsupported, if the agent has no /v1/txn endpoint.
+    """
+    try:
+        data = con.txn.put(operations)
+    except ClientError as e:
+        code, _, body = str(e).partition(" ")
+        if code != "409":
+            raise TxnUnsupported(str(e))
+        try:
+            errors = json.loads(body).get("Errors")
+        except ValueError:
+            errors = [{"What": body}]
+        raise TxnConflict(errors)
+    except (BadRequest, NotFound, KeyError) as e:
+        # KeyError: python-consul expects an index header on 404.
+        raise TxnUnsupported(str(e))
+    results = []
+    for result in (data or {}).get("Results") or []:
+        entry = result.get("KV")
+        if entry is None:
+            continue
+        if entry.get("Value") is not None:
+            entry["Value"] = base64.b64decode(entry["Value"])
+        results.append(entry)
+    return results
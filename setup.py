@@ -16,4 +16,9 @@ setup(
         "python-consul",
         "requests",
     ],
+    extras_require={
+        "aio": ["aiohttp"],
+        "prometheus": ["prometheus_client"],
+        "opentelemetry": ["opentelemetry-api"],
+    },
 )
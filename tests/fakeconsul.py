@@ -0,0 +1,1070 @@
+"""
+In-process stand-in for a Consul cluster.
+
+Implements the parts of the Consul HTTP API used by consul_lib: the KV store
+with ModifyIndex/CAS/acquire/release, recursive reads and blocking queries,
+sessions with TTL, transactions, the agent/catalog/health endpoints and a
+small subset of the filter expression language.
+
+Each agent of the cluster is served by its own HTTP server, so several
+``consul.Consul`` clients can talk to different "nodes" just like the
+docker-compose setup with consul1 … consul4:
+
+    cluster = FakeConsul(nodes=["consul1", "consul2"])
+    cluster.start()
+    con = consul.Consul(host=cluster.host, port=cluster.port("consul1"))
+    ...
+    cluster.stop()
+"""
+import base64
+import collections
+import json
+import re
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+DEFAULT_WAIT = 300.0
+
+
+class TxnFailed(Exception):
+    def __init__(self, op_index, what):
+        super().__init__(what)
+        self.op_index = op_index
+        self.what = what
+
+
+class FilterError(Exception):
+    pass
+
+
+def parse_duration(value):
+    """Parse a Consul duration ("10s", "100ms", "5m") into seconds."""
+    if value is None or value == "":
+        return None
+    match = re.match(r"^([0-9.]+)(ms|s|m|h)?$", str(value))
+    if not match:
+        raise ValueError("Invalid duration %r" % value)
+    number = float(match.group(1))
+    unit = match.group(2) or "s"
+    return number * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+
+
+# Filter expressions
+# ==================
+# Supports the subset consul_lib sends: ``<selector> <op> <value>`` terms with
+# ==, !=, in, not in, contains, is empty, is not empty, combined by "and", "or",
+# "not" and parentheses.
+
+_TOKEN = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([A-Za-z0-9_.:\-]+|==|!=))')
+
+
+def _tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = _TOKEN.match(expression, pos)
+        if not match or match.end() == pos:
+            raise FilterError("Unable to parse filter at %d: %r" % (pos, expression))
+        lparen, rparen, string, word = match.groups()
+        if lparen:
+            tokens.append(("(", None))
+        elif rparen:
+            tokens.append((")", None))
+        elif string is not None:
+            tokens.append(("str", string.replace('\\"', '"')))
+        else:
+            tokens.append(("word", word))
+        pos = match.end()
+    return tokens
+
+
+def _select(obj, selector):
+    """ The values of selector in obj, and whether they were collected from a list of objects. """
+    values = [obj]
+    through_list = False
+    for part in selector.split("."):
+        nxt = []
+        for value in values:
+            if isinstance(value, list):
+                through_list = True
+                for item in value:
+                    if isinstance(item, dict) and part in item:
+                        nxt.append(item[part])
+            elif isinstance(value, dict):
+                if part not in value:
+                    raise FilterError("Selector %r is not valid" % selector)
+                nxt.append(value[part])
+        values = nxt
+    return values, through_list
+
+
+class _FilterParser:
+    def __init__(self, expression):
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise FilterError("Unexpected token %r" % (self.peek(),))
+        return node
+
+    def parse_or(self):
+        left = self.parse_and()
+        while self.peek() == ("word", "or"):
+            self.take()
+            right = self.parse_and()
+            left = ("or", left, right)
+        return left
+
+    def parse_and(self):
+        left = self.parse_not()
+        while self.peek() == ("word", "and"):
+            self.take()
+            right = self.parse_not()
+            left = ("and", left, right)
+        return left
+
+    def parse_not(self):
+        if self.peek() == ("word", "not"):
+            self.take()
+            return ("not", self.parse_not())
+        if self.peek()[0] == "(":
+            self.take()
+            node = self.parse_or()
+            if self.take()[0] != ")":
+                raise FilterError("Missing closing parenthesis")
+            return node
+        return self.parse_term()
+
+    def parse_term(self):
+        first = self.take()
+        if first[0] not in ("word", "str"):
+            raise FilterError("Unexpected token %r" % (first,))
+        op = self.take()
+        if op == ("word", "in"):
+            selector = self.take()
+            return ("in", selector[1], first[1])
+        if op == ("word", "not") and self.peek() == ("word", "in"):
+            self.take()
+            selector = self.take()
+            return ("not", ("in", selector[1], first[1]))
+        if op == ("word", "is"):
+            negate = False
+            if self.peek() == ("word", "not"):
+                self.take()
+                negate = True
+            if self.take() != ("word", "empty"):
+                raise FilterError("Expected 'empty'")
+            node = ("empty", first[1])
+            return ("not", node) if negate else node
+        if op in (("word", "=="), ("word", "!="), ("word", "contains")):
+            value = self.take()
+            if value[0] not in ("word", "str"):
+                raise FilterError("Expected value after %s" % op[1])
+            return (op[1], first[1], value[1])
+        raise FilterError("Unknown operator %r" % (op,))
+
+
+def _evaluate(node, obj):
+    kind = node[0]
+    if kind == "or":
+        return _evaluate(node[1], obj) or _evaluate(node[2], obj)
+    if kind == "and":
+        return _evaluate(node[1], obj) and _evaluate(node[2], obj)
+    if kind == "not":
+        return not _evaluate(node[1], obj)
+    if kind == "empty":
+        values, _ = _select(obj, node[1])
+        return all(not v for v in values)
+    return _match(kind, node[1], node[2], obj)
+
+
+def _match(kind, selector, expected, obj):
+    values, through_list = _select(obj, selector)
+    if kind in ("in", "contains"):
+        # Like consul: membership in a list, a substring of a string. Fields
+        # of the objects of a list (e.g. Checks.Status) only support == and !=.
+        if through_list:
+            raise FilterError("Selector %r does not support %s" % (selector, kind))
+        return any(expected in v for v in values if isinstance(v, (list, str)))
+    flat = []
+    for value in values:
+        if isinstance(value, list):
+            flat.extend(value)
+        else:
+            flat.append(value)
+    # Selectors over lists match if any element matches, != is the negation of ==.
+    if kind == "==":
+        return any(str(v) == expected for v in flat)
+    if kind == "!=":
+        return not any(str(v) == expected for v in flat)
+    raise FilterError("Unknown node %r" % (kind,))
+
+
+def _validate(node, obj):
+    """ Raises FilterError for every term consul would reject, also those "and"/"or" skip. """
+    if node[0] in ("or", "and"):
+        _validate(node[1], obj)
+        _validate(node[2], obj)
+    elif node[0] == "not":
+        _validate(node[1], obj)
+    else:
+        _evaluate(node, obj)
+
+
+def apply_filter(expression, items):
+    tree = _FilterParser(expression).parse()
+    for item in items.values() if isinstance(items, dict) else items:
+        _validate(tree, item)
+    if isinstance(items, dict):
+        return {k: v for k, v in items.items() if _evaluate(tree, v)}
+    return [item for item in items if _evaluate(tree, item)]
+
+
+class _Datacenter:
+    """State of one datacenter: KV, sessions, catalog and health."""
+
+    def __init__(self, name, nodes):
+        self.name = name
+        self.index = 1
+        self.kv = {}
+        self.tombstones = {}
+        self.lock_delays = {}
+        self.sessions = {}
+        self.nodes = collections.OrderedDict()
+        self.health_index = 1
+        self.session_index = 1
+        for node in nodes:
+            self.add_node(node)
+
+    def bump(self):
+        self.index += 1
+        return self.index
+
+    # Catalog / health
+
+    def add_node(self, node):
+        index = self.bump()
+        self.nodes[node] = {
+            "services": collections.OrderedDict(),
+            "checks": collections.OrderedDict([
+                ("serfHealth", self._check(node, "serfHealth", "Serf Health Status", "passing", index)),
+            ]),
+        }
+        self.health_index = index
+
+    def _check(self, node, check_id, name, status, index, service=None):
+        return {
+            "Node": node,
+            "CheckID": check_id,
+            "Name": name,
+            "Status": status,
+            "Notes": "",
+            "Output": "",
+            "ServiceID": service["ID"] if service else "",
+            "ServiceName": service["Service"] if service else "",
+            "ServiceTags": list(service["Tags"]) if service else [],
+            "Type": "",
+            "CreateIndex": index,
+            "ModifyIndex": index,
+        }
+
+    def register_service(self, node, payload):
+        index = self.bump()
+        name = payload.get("name") or payload.get("Name")
+        service_id = payload.get("id") or payload.get("ID") or name
+        service = {
+            "ID": service_id,
+            "Service": name,
+            "Tags": payload.get("tags") or payload.get("Tags") or [],
+            "Address": payload.get("address", ""),
+            "Port": payload.get("port", 0),
+            "Meta": payload.get("meta") or {},
+            "CreateIndex": index,
+            "ModifyIndex": index,
+        }
+        state = self.nodes[node]
+        state["services"][service_id] = service
+        for check_id in [k for k, v in state["checks"].items() if v["ServiceID"] == service_id]:
+            del state["checks"][check_id]
+        checks = []
+        if payload.get("check"):
+            checks.append(payload["check"])
+        checks.extend(payload.get("checks") or [])
+        for i, check in enumerate(checks):
+            check_id = "service:%s" % service_id
+            if len(checks) > 1:
+                check_id = "%s:%d" % (check_id, i + 1)
+            # TTL checks start out as critical, other checks are treated as passing.
+            status = check.get("status") or ("critical" if "ttl" in check else "passing")
+            state["checks"][check_id] = self._check(
+                node, check_id, "Service '%s' check" % name, status, index, service)
+        self.health_index = index
+
+    def deregister_service(self, node, service_id):
+        state = self.nodes[node]
+        if service_id not in state["services"]:
+            return False
+        index = self.bump()
+        del state["services"][service_id]
+        for check_id in [k for k, v in state["checks"].items() if v["ServiceID"] == service_id]:
+            del state["checks"][check_id]
+        self.health_index = index
+        return True
+
+    def set_maintenance(self, node, enable, reason=None):
+        index = self.bump()
+        checks = self.nodes[node]["checks"]
+        if enable:
+            check = self._check(node, "_node_maintenance", "Node Maintenance Mode", "critical", index)
+            check["Notes"] = reason or "Maintenance mode is enabled for this node"
+            checks["_node_maintenance"] = check
+        else:
+            checks.pop("_node_maintenance", None)
+        self.health_index = index
+
+    def set_check_status(self, node, check_id, status):
+        index = self.bump()
+        check = self.nodes[node]["checks"][check_id]
+        check["Status"] = status
+        check["ModifyIndex"] = index
+        self.health_index = index
+
+    def all_checks(self):
+        for node, state in self.nodes.items():
+            for check in state["checks"].values():
+                yield check
+
+    def service_entries(self, name, passing=False, tag=None):
+        entries = []
+        for node in sorted(self.nodes):
+            state = self.nodes[node]
+            for service in state["services"].values():
+                if service["Service"] != name:
+                    continue
+                if tag is not None and tag not in service["Tags"]:
+                    continue
+                checks = [dict(c) for c in state["checks"].values()
+                          if c["ServiceID"] in ("", service["ID"])]
+                if passing and any(c["Status"] != "passing" for c in checks):
+                    continue
+                entries.append({
+                    "Node": {"Node": node, "Address": "127.0.0.1", "Datacenter": self.name},
+                    "Service": dict(service),
+                    "Checks": checks,
+                })
+        return entries
+
+    # KV
+
+    def kv_entry(self, key):
+        entry = self.kv.get(key)
+        return dict(entry) if entry else None
+
+    def kv_index(self, key, recurse):
+        if recurse:
+            indexes = [e["ModifyIndex"] for k, e in self.kv.items() if k.startswith(key)]
+            indexes += [i for k, i in self.tombstones.items() if k.startswith(key)]
+        else:
+            indexes = [self.kv[key]["ModifyIndex"]] if key in self.kv else []
+            if key in self.tombstones:
+                indexes.append(self.tombstones[key])
+        return max(indexes) if indexes else self.index
+
+    def kv_set(self, key, value, flags=None, session=None, lock=False, unlock=False):
+        index = self.bump()
+        entry = self.kv.get(key)
+        if entry is None:
+            entry = {"Key": key, "CreateIndex": index, "LockIndex": 0, "Flags": 0}
+            self.kv[key] = entry
+            self.tombstones.pop(key, None)
+        entry["Value"] = value
+        entry["ModifyIndex"] = index
+        if flags is not None:
+            entry["Flags"] = int(flags)
+        if lock and entry.get("Session") != session:
+            entry["Session"] = session
+            entry["LockIndex"] += 1
+        if unlock:
+            entry.pop("Session", None)
+        return entry
+
+    def kv_delete(self, key):
+        if key in self.kv:
+            del self.kv[key]
+            self.tombstones[key] = self.bump()
+
+    def can_lock(self, key, session):
+        if session not in self.sessions:
+            raise TxnFailed(0, "invalid session %r" % session)
+        entry = self.kv.get(key)
+        if entry and entry.get("Session") and entry["Session"] != session:
+            return False
+        if entry and not entry.get("Session") and self.lock_delays.get(key, 0) > time.time():
+            return False
+        return True
+
+    def kv_put(self, key, value, params):
+        if "cas" in params:
+            cas = int(params["cas"])
+            entry = self.kv.get(key)
+            if cas == 0 and entry is not None:
+                return False
+            if cas != 0 and (entry is None or entry["ModifyIndex"] != cas):
+                return False
+        if "acquire" in params:
+            session = params["acquire"]
+            if session not in self.sessions:
+                raise ValueError("invalid session %r" % session)
+            if not self.can_lock(key, session):
+                return False
+            self.kv_set(key, value, params.get("flags"), session=session, lock=True)
+            return True
+        if "release" in params:
+            entry = self.kv.get(key)
+            if not entry or entry.get("Session") != params["release"]:
+                return False
+            self.kv_set(key, value, params.get("flags"), unlock=True)
+            return True
+        self.kv_set(key, value, params.get("flags"))
+        return True
+
+    # Sessions
+
+    def session_create(self, node, payload):
+        index = self.bump()
+        session_id = str(uuid.uuid4())
+        ttl = parse_duration(payload.get("ttl") or payload.get("TTL"))
+        lock_delay = parse_duration(payload.get("lockdelay") or payload.get("LockDelay") or "15s")
+        self.sessions[session_id] = {
+            "ID": session_id,
+            "Name": payload.get("name", ""),
+            "Node": payload.get("node") or node,
+            "Checks": ["serfHealth"],
+            "LockDelay": int(lock_delay * 1e9),
+            "Behavior": payload.get("behavior", "release"),
+            "TTL": payload.get("ttl", ""),
+            "CreateIndex": index,
+            "ModifyIndex": index,
+            "_ttl": ttl,
+            "_expires": time.time() + ttl if ttl else None,
+        }
+        self.session_index = index
+        return session_id
+
+    def session_renew(self, session_id):
+        session = self.sessions.get(session_id)
+        if not session:
+            return None
+        if session["_ttl"]:
+            session["_expires"] = time.time() + session["_ttl"]
+        return session
+
+    def session_destroy(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if not session:
+            return
+        self.session_index = self.bump()
+        lock_delay = session["LockDelay"] / 1e9
+        for key, entry in list(self.kv.items()):
+            if entry.get("Session") != session_id:
+                continue
+            if lock_delay:
+                self.lock_delays[key] = time.time() + lock_delay
+            if session["Behavior"] == "delete":
+                self.kv_delete(key)
+            else:
+                self.kv_set(key, entry.get("Value"), unlock=True)
+
+    def expire_sessions(self, now):
+        expired = [s for s, v in self.sessions.items() if v["_expires"] and v["_expires"] < now]
+        for session_id in expired:
+            self.session_destroy(session_id)
+        return bool(expired)
+
+    def public_session(self, session):
+        return {k: v for k, v in session.items() if not k.startswith("_")}
+
+    # Transactions
+
+    def txn(self, operations):
+        # Work on a copy so a failing transaction does not change anything.
+        backup = (self.index, {k: dict(v) for k, v in self.kv.items()}, dict(self.tombstones),
+                  dict(self.sessions))
+        results = []
+        try:
+            for i, operation in enumerate(operations):
+                try:
+                    results.extend(self._txn_op(operation))
+                except TxnFailed as e:
+                    raise TxnFailed(i, e.what)
+        except TxnFailed:
+            self.index, self.kv, self.tombstones, self.sessions = backup
+            raise
+        return results
+
+    def _txn_op(self, operation):  # noqa: C901
+        if "Session" in operation:
+            op = operation["Session"]
+            if op.get("Verb") != "delete":
+                raise TxnFailed(0, "unknown session verb %r" % op.get("Verb"))
+            session_id = op["Session"]["ID"]
+            if session_id not in self.sessions:
+                raise TxnFailed(0, "session %r does not exist" % session_id)
+            self.session_destroy(session_id)
+            return []
+        op = operation["KV"]
+        verb = op["Verb"]
+        key = op["Key"]
+        value = base64.b64decode(op["Value"]) if op.get("Value") is not None else None
+        entry = self.kv.get(key)
+        if verb == "set":
+            return [self.kv_set(key, value, op.get("Flags"))]
+        if verb == "cas":
+            index = int(op.get("Index", 0))
+            if (index == 0 and entry is not None) or (index != 0 and (not entry or entry["ModifyIndex"] != index)):
+                raise TxnFailed(0, "current modify index %s != %s for %r" % (
+                    entry and entry["ModifyIndex"], index, key))
+            return [self.kv_set(key, value, op.get("Flags"))]
+        if verb == "lock":
+            if not self.can_lock(key, op.get("Session")):
+                raise TxnFailed(0, "failed to lock key %r, lock is already held" % key)
+            return [self.kv_set(key, value, op.get("Flags"), session=op["Session"], lock=True)]
+        if verb == "unlock":
+            if not entry or entry.get("Session") != op.get("Session"):
+                raise TxnFailed(0, "failed to unlock key %r, lock is not held" % key)
+            return [self.kv_set(key, value, op.get("Flags"), unlock=True)]
+        if verb == "get":
+            if not entry:
+                raise TxnFailed(0, "key %r does not exist" % key)
+            return [entry]
+        if verb == "get-tree":
+            return [e for k, e in sorted(self.kv.items()) if k.startswith(key)]
+        if verb == "check-index":
+            if not entry or entry["ModifyIndex"] != int(op["Index"]):
+                raise TxnFailed(0, "index check failed for %r" % key)
+            return []
+        if verb == "check-session":
+            if not entry or entry.get("Session") != op.get("Session"):
+                raise TxnFailed(0, "session check failed for %r" % key)
+            return []
+        if verb == "check-not-exists":
+            if entry:
+                raise TxnFailed(0, "key %r exists" % key)
+            return []
+        if verb == "delete":
+            self.kv_delete(key)
+            return []
+        if verb == "delete-tree":
+            for k in [k for k in self.kv if k.startswith(key)]:
+                self.kv_delete(k)
+            return []
+        if verb == "delete-cas":
+            if not entry or entry["ModifyIndex"] != int(op["Index"]):
+                raise TxnFailed(0, "delete-cas failed for %r" % key)
+            self.kv_delete(key)
+            return []
+        raise TxnFailed(0, "unknown verb %r" % verb)
+
+
+class FakeConsul:
+    """
+    A fake Consul cluster. Every node gets its own HTTP agent.
+
+    :param nodes: names of the nodes (agents) of the default datacenter.
+    :param datacenter: name of the default datacenter.
+    :param datacenters: additional datacenters, mapping name to list of nodes.
+    """
+
+    def __init__(self, nodes=("consul1",), datacenter="test", datacenters=None, host="127.0.0.1"):
+        self.host = host
+        self.datacenter = datacenter
+        self.dcs = collections.OrderedDict()
+        self.dcs[datacenter] = _Datacenter(datacenter, nodes)
+        for name, dc_nodes in (datacenters or {}).items():
+            self.dcs[name] = _Datacenter(name, dc_nodes)
+        self.cond = threading.Condition()
+        self.requests = collections.Counter()
+        self.last_contact = 0
+        self.latency = {}
+        self.unavailable = set()
+        self.dc_latency = {}
+        self._servers = {}
+        self._threads = []
+        self._stopped = threading.Event()
+
+    @property
+    def dc(self):
+        return self.dcs[self.datacenter]
+
+    def start(self):
+        for dc in self.dcs.values():
+            for node in dc.nodes:
+                self._start_agent(dc.name, node)
+        reaper = threading.Thread(target=self._reap, name="fakeconsul-reaper", daemon=True)
+        reaper.start()
+        self._threads.append(reaper)
+        return self
+
+    def _start_agent(self, dc, node):
+        server = _Server((self.host, 0), _Handler)
+        server.cluster = self
+        server.node = node
+        server.datacenter = dc
+        thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05},
+                                  name="fakeconsul-%s" % node, daemon=True)
+        thread.start()
+        self._servers[node] = server
+        self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        with self.cond:
+            self.cond.notify_all()
+        for server in self._servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def port(self, node=None):
+        node = node or next(iter(self.dc.nodes))
+        return self._servers[node].server_address[1]
+
+    def address(self, node=None):
+        return "%s:%d" % (self.host, self.port(node))
+
+    def reset_counters(self):
+        with self.cond:
+            self.requests.clear()
+
+    def total_requests(self):
+        with self.cond:
+            return sum(self.requests.values())
+
+    def changed(self):
+        """Wake up blocking queries. Must be called with self.cond held."""
+        self.cond.notify_all()
+
+    def _reap(self):
+        while not self._stopped.wait(0.05):
+            with self.cond:
+                now = time.time()
+                if any([dc.expire_sessions(now) for dc in self.dcs.values()]):
+                    self.changed()
+
+    # Helpers for tests
+
+    def register_service(self, node, name, service_id=None, tags=None, check=None):
+        payload = {"name": name, "id": service_id or name, "tags": tags or []}
+        if check:
+            payload["check"] = check
+        with self.cond:
+            self.dc.register_service(node, payload)
+            self.changed()
+
+    def set_check_status(self, node, check_id, status):
+        with self.cond:
+            self.dc.set_check_status(node, check_id, status)
+            self.changed()
+
+    def maintenance(self, node, enable, reason=None):
+        with self.cond:
+            self.dc.set_maintenance(node, enable, reason)
+            self.changed()
+
+    def expire_session(self, session_id):
+        with self.cond:
+            self.dc.session_destroy(session_id)
+            self.changed()
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, avoid delayed ACK stalls.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    # Plumbing
+
+    def _respond(self, code, body=None, index=None, raw=False):
+        if raw:
+            payload = body.encode() if isinstance(body, str) else (body or b"")
+        else:
+            payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if index is not None:
+            self.send_header("X-Consul-Index", str(index))
+        self.send_header("X-Consul-KnownLeader", "true")
+        self.send_header("X-Consul-LastContact", str(int(self.server.cluster.last_contact)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _error(self, code, message):
+        self._respond(code, message, raw=True)
+
+    def _handle(self, method):  # noqa: C901
+        cluster = self.server.cluster
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        self.params = dict(parse_qsl(url.query, keep_blank_values=True))
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length) if length else b""
+        node = self.server.node
+        latency = cluster.latency.get(node)
+        if node in cluster.unavailable:
+            self.close_connection = True
+            self.connection.close()
+            return
+        if latency:
+            time.sleep(latency)
+        dc_name = self.params.get("dc") or self.server.datacenter
+        if dc_name not in cluster.dcs:
+            self._error(500, "No path to datacenter")
+            return
+        if cluster.dc_latency.get(dc_name):
+            time.sleep(cluster.dc_latency[dc_name])
+        with cluster.cond:
+            cluster.requests[(method, path.split("/")[2] if path.count("/") >= 2 else path)] += 1
+        self.dc = cluster.dcs[dc_name]
+        self.node = node
+        try:
+            for pattern, handler_method, handler in _ROUTES:
+                if handler_method != method:
+                    continue
+                match = re.match(pattern, path)
+                if match:
+                    handler(self, *match.groups())
+                    return
+            self._error(404, "Unknown endpoint %s %s" % (method, path))
+        except FilterError as e:
+            self._error(400, "Failed to create boolean expression evaluator: %s" % e)
+        except ValueError as e:
+            self._error(500, str(e))
+
+    def do_GET(self):  # noqa: N802
+        self._handle("GET")
+
+    def do_PUT(self):  # noqa: N802
+        self._handle("PUT")
+
+    def do_DELETE(self):  # noqa: N802
+        self._handle("DELETE")
+
+    def do_POST(self):  # noqa: N802
+        self._handle("PUT")
+
+    def _block(self, current_index):
+        """Implements blocking queries on top of a function returning the current index."""
+        cluster = self.server.cluster
+        index = int(self.params.get("index") or 0)
+        if not index:
+            return current_index()
+        wait = parse_duration(self.params.get("wait")) or DEFAULT_WAIT
+        deadline = time.time() + wait
+        while True:
+            result = current_index()
+            remaining = deadline - time.time()
+            if result > index or remaining <= 0 or cluster._stopped.is_set():
+                return result
+            cluster.cond.wait(remaining)
+
+    def _filtered(self, items):
+        expression = self.params.get("filter")
+        if expression:
+            return apply_filter(expression, items)
+        return items
+
+    # Status
+
+    def status_leader(self):
+        self._respond(200, "%s:8300" % self.server.cluster.host)
+
+    def status_peers(self):
+        self._respond(200, ["%s:8300" % self.server.cluster.host])
+
+    # KV
+
+    def kv_get(self, key):
+        cluster = self.server.cluster
+        recurse = "recurse" in self.params
+        keys = "keys" in self.params
+        with cluster.cond:
+            index = self._block(lambda: self.dc.kv_index(key, recurse or keys))
+            if keys:
+                result = sorted(k for k in self.dc.kv if k.startswith(key))
+            elif recurse:
+                result = [self.dc.kv_entry(k) for k in sorted(self.dc.kv) if k.startswith(key)]
+            else:
+                entry = self.dc.kv_entry(key)
+                result = [entry] if entry else []
+        if not result:
+            self._respond(404, "", index=index, raw=True)
+            return
+        if not keys:
+            for entry in result:
+                if entry.get("Value") is not None:
+                    entry["Value"] = base64.b64encode(entry["Value"]).decode()
+        self._respond(200, result, index=index)
+
+    def kv_put(self, key):
+        cluster = self.server.cluster
+        value = self.body if self.body else None
+        with cluster.cond:
+            try:
+                result = self.dc.kv_put(key, value, self.params)
+            except (ValueError, TxnFailed) as e:
+                self._error(500, str(e))
+                return
+            cluster.changed()
+        self._respond(200, result)
+
+    def kv_delete(self, key):
+        cluster = self.server.cluster
+        with cluster.cond:
+            if "recurse" in self.params:
+                for k in [k for k in self.dc.kv if k.startswith(key)]:
+                    self.dc.kv_delete(k)
+                result = True
+            elif "cas" in self.params:
+                entry = self.dc.kv.get(key)
+                result = bool(entry and entry["ModifyIndex"] == int(self.params["cas"]))
+                if result:
+                    self.dc.kv_delete(key)
+            else:
+                self.dc.kv_delete(key)
+                result = True
+            cluster.changed()
+        self._respond(200, result)
+
+    # Transactions
+
+    def txn(self):
+        cluster = self.server.cluster
+        operations = json.loads(self.body.decode() or "[]")
+        if len(operations) > 64:
+            self._error(413, "Transaction contains too many operations (%d > 64)" % len(operations))
+            return
+        with cluster.cond:
+            try:
+                results = self.dc.txn(operations)
+            except TxnFailed as e:
+                self._respond(409, {"Results": None, "Errors": [{"OpIndex": e.op_index, "What": e.what}]})
+                return
+            index = self.dc.index
+            cluster.changed()
+        out = []
+        for entry in results:
+            entry = dict(entry)
+            if entry.get("Value") is not None:
+                entry["Value"] = base64.b64encode(entry["Value"]).decode()
+            out.append({"KV": entry})
+        self._respond(200, {"Results": out, "Errors": None}, index=index)
+
+    # Sessions
+
+    def session_create(self):
+        cluster = self.server.cluster
+        payload = json.loads(self.body.decode()) if self.body else {}
+        with cluster.cond:
+            session_id = self.dc.session_create(self.node, payload)
+        self._respond(200, {"ID": session_id})
+
+    def session_destroy(self, session_id):
+        cluster = self.server.cluster
+        with cluster.cond:
+            self.dc.session_destroy(session_id)
+            cluster.changed()
+        self._respond(200, True)
+
+    def session_renew(self, session_id):
+        cluster = self.server.cluster
+        with cluster.cond:
+            session = self.dc.session_renew(session_id)
+            result = self.dc.public_session(session) if session else None
+        if not session:
+            self._error(404, "Session id '%s' not found" % session_id)
+            return
+        self._respond(200, [result])
+
+    def session_info(self, session_id):
+        cluster = self.server.cluster
+        with cluster.cond:
+            index = self._block(lambda: self.dc.session_index)
+            session = self.dc.sessions.get(session_id)
+            result = [self.dc.public_session(session)] if session else []
+        self._respond(200, result, index=index)
+
+    def session_list(self):
+        cluster = self.server.cluster
+        with cluster.cond:
+            index = self._block(lambda: self.dc.session_index)
+            result = [self.dc.public_session(s) for s in self.dc.sessions.values()]
+        self._respond(200, result, index=index)
+
+    # Agent
+
+    def agent_self(self):
+        self._respond(200, {"Config": {"NodeName": self.node, "Datacenter": self.dc.name},
+                            "Member": {"Name": self.node}})
+
+    def agent_services(self):
+        cluster = self.server.cluster
+        with cluster.cond:
+            services = {k: dict(v) for k, v in self.dc.nodes[self.node]["services"].items()}
+        self._respond(200, self._filtered(services))
+
+    def agent_checks(self):
+        cluster = self.server.cluster
+        with cluster.cond:
+            checks = {k: dict(v) for k, v in self.dc.nodes[self.node]["checks"].items()}
+        self._respond(200, self._filtered(checks))
+
+    def agent_service_register(self):
+        cluster = self.server.cluster
+        payload = json.loads(self.body.decode())
+        with cluster.cond:
+            self.dc.register_service(self.node, payload)
+            cluster.changed()
+        self._respond(200, "", raw=True)
+
+    def agent_service_deregister(self, service_id):
+        cluster = self.server.cluster
+        with cluster.cond:
+            self.dc.deregister_service(self.node, service_id)
+            cluster.changed()
+        self._respond(200, "", raw=True)
+
+    def agent_maintenance(self):
+        cluster = self.server.cluster
+        with cluster.cond:
+            self.dc.set_maintenance(self.node, self.params.get("enable") in ("true", "True", "1"),
+                                    self.params.get("reason"))
+            cluster.changed()
+        self._respond(200, "", raw=True)
+
+    def agent_check_update(self, status, check_id):
+        cluster = self.server.cluster
+        status = {"pass": "passing", "warn": "warning", "fail": "critical"}[status]
+        with cluster.cond:
+            self.dc.set_check_status(self.node, check_id, status)
+            cluster.changed()
+        self._respond(200, "", raw=True)
+
+    # Catalog
+
+    def catalog_datacenters(self):
+        self._respond(200, list(self.server.cluster.dcs))
+
+    def catalog_nodes(self):
+        cluster = self.server.cluster
+        with cluster.cond:
+            index = self._block(lambda: self.dc.health_index)
+            nodes = [{"Node": n, "Address": "127.0.0.1", "Datacenter": self.dc.name} for n in self.dc.nodes]
+        self._respond(200, nodes, index=index)
+
+    def catalog_services(self):
+        cluster = self.server.cluster
+        with cluster.cond:
+            index = self._block(lambda: self.dc.health_index)
+            services = {}
+            for state in self.dc.nodes.values():
+                for service in state["services"].values():
+                    tags = services.setdefault(service["Service"], [])
+                    tags.extend(t for t in service["Tags"] if t not in tags)
+        self._respond(200, services, index=index)
+
+    def catalog_node(self, node):
+        cluster = self.server.cluster
+        with cluster.cond:
+            index = self._block(lambda: self.dc.health_index)
+            state = self.dc.nodes.get(node)
+            if state is None:
+                result = None
+            else:
+                result = {"Node": {"Node": node, "Address": "127.0.0.1", "Datacenter": self.dc.name},
+                          "Services": {k: dict(v) for k, v in state["services"].items()}}
+        self._respond(200, result, index=index)
+
+    # Health
+
+    def health_service(self, name):
+        cluster = self.server.cluster
+        with cluster.cond:
+            index = self._block(lambda: self.dc.health_index)
+            entries = self.dc.service_entries(name, passing="passing" in self.params, tag=self.params.get("tag"))
+        self._respond(200, self._filtered(entries), index=index)
+
+    def health_state(self, state):
+        cluster = self.server.cluster
+        with cluster.cond:
+            index = self._block(lambda: self.dc.health_index)
+            checks = [dict(c) for c in self.dc.all_checks() if state == "any" or c["Status"] == state]
+        self._respond(200, self._filtered(checks), index=index)
+
+    def health_checks(self, service):
+        cluster = self.server.cluster
+        with cluster.cond:
+            index = self._block(lambda: self.dc.health_index)
+            checks = [dict(c) for c in self.dc.all_checks() if c["ServiceName"] == service]
+        self._respond(200, self._filtered(checks), index=index)
+
+    def health_node(self, node):
+        cluster = self.server.cluster
+        with cluster.cond:
+            index = self._block(lambda: self.dc.health_index)
+            checks = [dict(c) for c in self.dc.all_checks() if c["Node"] == node]
+        self._respond(200, self._filtered(checks), index=index)
+
+
+_ROUTES = [
+    (r"^/v1/status/leader$", "GET", _Handler.status_leader),
+    (r"^/v1/status/peers$", "GET", _Handler.status_peers),
+    (r"^/v1/kv/(.*)$", "GET", _Handler.kv_get),
+    (r"^/v1/kv/(.*)$", "PUT", _Handler.kv_put),
+    (r"^/v1/kv/(.*)$", "DELETE", _Handler.kv_delete),
+    (r"^/v1/txn$", "PUT", _Handler.txn),
+    (r"^/v1/session/create$", "PUT", _Handler.session_create),
+    (r"^/v1/session/destroy/(.+)$", "PUT", _Handler.session_destroy),
+    (r"^/v1/session/renew/(.+)$", "PUT", _Handler.session_renew),
+    (r"^/v1/session/info/(.+)$", "GET", _Handler.session_info),
+    (r"^/v1/session/list$", "GET", _Handler.session_list),
+    (r"^/v1/agent/self$", "GET", _Handler.agent_self),
+    (r"^/v1/agent/services$", "GET", _Handler.agent_services),
+    (r"^/v1/agent/checks$", "GET", _Handler.agent_checks),
+    (r"^/v1/agent/service/register$", "PUT", _Handler.agent_service_register),
+    (r"^/v1/agent/service/deregister/(.+)$", "PUT", _Handler.agent_service_deregister),
+    (r"^/v1/agent/maintenance$", "PUT", _Handler.agent_maintenance),
+    (r"^/v1/agent/check/(pass|warn|fail)/(.+)$", "PUT", _Handler.agent_check_update),
+    (r"^/v1/catalog/datacenters$", "GET", _Handler.catalog_datacenters),
+    (r"^/v1/catalog/nodes$", "GET", _Handler.catalog_nodes),
+    (r"^/v1/catalog/services$", "GET", _Handler.catalog_services),
+    (r"^/v1/catalog/node/(.+)$", "GET", _Handler.catalog_node),
+    (r"^/v1/health/service/(.+)$", "GET", _Handler.health_service),
+    (r"^/v1/health/state/(.+)$", "GET", _Handler.health_state),
+    (r"^/v1/health/checks/(.+)$", "GET", _Handler.health_checks),
+    (r"^/v1/health/node/(.+)$", "GET", _Handler.health_node),
+]
@@ -1,25 +1,63 @@
+import asyncio
+import inspect
+import os
+
 import pytest
 import consul
 
+from fakeconsul import FakeConsul
+
+# With CONSUL_LIB_FAKE=1 the tests run against an in-process fake consul
+# cluster (see fakeconsul.py) instead of the docker-compose containers.
+FAKE = bool(os.environ.get("CONSUL_LIB_FAKE"))
+NODES = ["consul1", "consul2", "consul3", "consul4"]
+
+
+@pytest.fixture
+def fake_consul():
+    cluster = FakeConsul(nodes=NODES).start()
+    yield cluster
+    cluster.stop()
+
+
+def _address(request, node):
+    if FAKE:
+        cluster = request.getfixturevalue("fake_consul")
+        return {"host": cluster.host, "port": cluster.port(node)}
+    return {"host": node}
+
+
+@pytest.fixture
+def consul1(request):
+    return _wait_for_leader(consul.Consul(**_address(request, "consul1")))
+
 
 @pytest.fixture
-def consul1():
-    return _wait_for_leader(consul.Consul(host="consul1"))
+def consul2(request):
+    return _wait_for_leader(consul.Consul(**_address(request, "consul2")))
 
 
 @pytest.fixture
-def consul2():
-    return _wait_for_leader(consul.Consul(host="consul2"))
+def consul3(request):
+    return _wait_for_leader(consul.Consul(**_address(request, "consul3")))
 
 
 @pytest.fixture
-def consul3():
-    return _wait_for_leader(consul.Consul(host="consul3"))
+def consul4(request):
+    return _wait_for_leader(consul.Consul(**_address(request, "consul4")))
 
 
 @pytest.fixture
-def consul4():
-    return _wait_for_leader(consul.Consul(host="consul4"))
+def aio_consul1(request):
+    import consul.aio
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    con = consul.aio.Consul(loop=loop, **_address(request, "consul1"))
+    yield con
+    closed = con.close()
+    if inspect.isawaitable(closed):
+        loop.run_until_complete(closed)
+    loop.close()
 
 
 @pytest.fixture
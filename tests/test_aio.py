@@ -0,0 +1,131 @@
+import asyncio
+import json
+import threading
+import time
+
+from consul_lib import Semaphore
+from consul_lib.aio import AsyncLock, AsyncLockMonitor, AsyncSemaphore
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def test_async_lock(aio_consul1):
+    async def test():
+        async with AsyncLock(aio_consul1, "test/lock") as lock1:
+            assert await lock1.acquired
+            lock2 = AsyncLock(aio_consul1, "test/lock")
+            assert not await lock2.acquire(wait="100ms"), "lock2 and lock1 are held at the same time"
+            await lock2.close()
+        assert not await lock1.acquired
+    _run(test())
+
+
+def test_async_lock_waiters(aio_consul1):
+    async def worker(active, results):
+        lock = AsyncLock(aio_consul1, "test/lock")
+        async with lock:
+            active.append(lock)
+            results.append(len(active))
+            await asyncio.sleep(0.01)
+            active.remove(lock)
+
+    async def test():
+        active, results = [], []
+        await asyncio.gather(*[worker(active, results) for _ in range(10)])
+        assert results == [1] * 10
+    _run(test())
+
+
+def test_async_semaphore(aio_consul1):
+    async def test():
+        sem1 = AsyncSemaphore(aio_consul1, "test/semaphore", 1)
+        async with sem1:
+            assert await sem1.acquired()
+            sem2 = AsyncSemaphore(aio_consul1, "test/semaphore", 1)
+            assert not await sem2.acquire(blocking=False)
+            await sem2.close()
+        assert not await sem1.acquired()
+    _run(test())
+
+
+def test_async_semaphore_permits(consul1, aio_consul1):
+    big = Semaphore(consul1, "test/semaphore", 4)
+    assert big.acquire(permits=3)
+
+    async def admitted():
+        small = AsyncSemaphore(aio_consul1, "test/semaphore", 4)
+        assert await small.acquire(blocking=False)
+        # Three permits of big and one of small.
+        other = AsyncSemaphore(aio_consul1, "test/semaphore", 4)
+        assert not await other.acquire(blocking=False)
+        await other.close()
+        await small.release()
+    _run(admitted())
+
+    # A waiter for two permits comes first, although one is free.
+    waiter = Semaphore(consul1, "test/semaphore", 4)
+    thread = threading.Thread(target=waiter.acquire, kwargs={"permits": 2})
+    thread.start()
+    for _ in range(100):
+        _, data = consul1.kv.get("test/semaphore/.lock")
+        if waiter.session in json.loads(data["Value"].decode()).get("Waiting", []):
+            break
+        time.sleep(0.05)
+
+    async def queued():
+        small = AsyncSemaphore(aio_consul1, "test/semaphore", 4)
+        assert not await small.acquire(blocking=False)
+        await small.close()
+
+        big.release()
+        thread.join(10)
+        assert waiter.locked
+        weighted = AsyncSemaphore(aio_consul1, "test/semaphore", 4)
+        assert await weighted.acquire(blocking=False, permits=2)
+        assert await weighted.release(permits=1)
+        _, data = consul1.kv.get("test/semaphore/.lock")
+        assert json.loads(data["Value"].decode())["Weights"] == {waiter.session: 2, weighted.session: 1}
+        await weighted.release()
+    _run(queued())
+    waiter.release()
+
+
+def test_async_lockmonitor(aio_consul1):
+    async def test():
+        for lock in [AsyncLock(aio_consul1, "test/lock"), AsyncSemaphore(aio_consul1, "test/semaphore", 1)]:
+            assert await lock.acquire()
+            event = asyncio.Event()
+            monitor = AsyncLockMonitor(lock, retry_time=0.1, event=event)
+            monitor.start()
+            await aio_consul1.session.destroy(lock.session)
+            await asyncio.wait_for(event.wait(), 30)
+            monitor.finish()
+            lock.session = None
+            await lock.close()
+    _run(test())
+
+
+def test_async_lockmonitor_reads_lock_key(aio_consul1):
+    async def test():
+        lock = AsyncLock(aio_consul1, "test/lock")
+        assert await lock.acquire()
+        reads = []
+        get = aio_consul1.kv.get
+
+        async def recording(key, **kwargs):
+            reads.append((key, kwargs.get("recurse")))
+            return await get(key, **kwargs)
+
+        aio_consul1.kv.get = recording
+        monitor = AsyncLockMonitor(lock, retry_time=0.05)
+        monitor.start()
+        await asyncio.sleep(0.3)
+        monitor.finish()
+        aio_consul1.kv.get = get
+        # Only the .lock key, the keys of other users below the prefix are not read.
+        assert reads
+        assert all(x == ("test/lock/.lock", False) for x in reads)
+        await lock.release()
+    _run(test())
@@ -0,0 +1,29 @@
+import time
+
+import consul_lib
+from consul_lib import Lock, Semaphore
+from consul_lib.session import SessionRenewalHub
+
+
+def test_shutdown(consul1, consul2):
+    locks = [Lock(consul1, "test/lock%d" % i, lock_delay=0) for i in range(3)]
+    for lock in locks:
+        assert lock.acquire()
+    semaphore = Semaphore(consul2, "test/semaphore", 1)
+    assert semaphore.acquire()
+    kept = Lock(consul2, "test/kept")
+    assert kept.acquire()
+    kept.release(keep_session="exit")
+    sessions = [x.session for x in locks + [semaphore, kept]]
+
+    start = time.monotonic()
+    assert consul_lib.shutdown(timeout=10)
+    assert time.monotonic() - start < 5
+
+    alive = {x["ID"] for x in consul1.session.list()[1]}
+    assert not alive.intersection(sessions)
+    assert not any(x._session in sessions for x in SessionRenewalHub.default().renewers())
+    # The locks are free again.
+    other = Lock(consul2, "test/lock0")
+    assert other.acquire(blocking=False)
+    other.release()
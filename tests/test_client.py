@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+
+from consul_lib import Lock, MultiConsul, PooledConsul
+from consul_lib.client import _seconds
+from fixtures import FAKE
+
+
+def _pooled(con, **kwargs):
+    return PooledConsul(host=con.http.host, port=con.http.port, **kwargs)
+
+
+def test_seconds():
+    assert _seconds("30s") == 30
+    assert _seconds("1m30s") == 90
+    assert _seconds("100ms") == 0.1
+    assert _seconds(None) == 300
+
+
+def test_pooled_consul_lock(consul1, consul2):
+    con = _pooled(consul1)
+    lock = Lock(con, "test/lock")
+    assert lock.acquire()
+    assert lock.acquired
+    assert not Lock(consul2, "test/lock").acquire(blocking=False)
+    lock.release()
+
+
+def test_blocking_queries_do_not_starve_short_requests(consul1):
+    con = _pooled(consul1, blocking_pool_size=4, pool_size=2)
+    con.kv.put("test/blocking", "1")
+    idx, _ = con.kv.get("test/blocking")
+    threads = [threading.Thread(target=con.kv.get, args=("test/blocking",), kwargs={"index": idx, "wait": "2s"})
+               for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+
+    start = time.monotonic()
+    session = con.session.create(ttl=10)
+    con.session.renew(session)
+    con.session.destroy(session)
+    assert time.monotonic() - start < 1
+    assert all(thread.is_alive() for thread in threads)
+    for thread in threads:
+        thread.join()
+
+
+def _address(con):
+    return "%s:%s" % (con.http.host, con.http.port)
+
+
+def test_multi_consul_lock(consul1, consul2, consul3):
+    con = MultiConsul([_address(x) for x in (consul1, consul2, consul3)])
+    lock = Lock(con, "test/lock")
+    assert lock.acquire()
+    assert lock.acquired
+    assert not Lock(consul2, "test/lock").acquire(blocking=False)
+    lock.release()
+    assert all(x.latency is not None or x.errors == 0 for x in con.http.endpoints)
+
+
+@pytest.mark.skipif(not FAKE, reason="needs the fake consul to simulate slow and failing agents")
+def test_multi_consul_failover(fake_consul, consul1, consul2, consul3):
+    con = MultiConsul([_address(x) for x in (consul1, consul2, consul3)])
+    # Measure all agents.
+    for _ in range(6):
+        con.kv.get("test/key")
+
+    fake_consul.latency["consul1"] = 0.1
+    start = time.monotonic()
+    for _ in range(10):
+        con.kv.get("test/key")
+    # At most one request to the slow agent.
+    assert time.monotonic() - start < 0.19
+    assert con.http._ordered()[0].address != _address(consul1)
+
+    fake_consul.latency.clear()
+    fake_consul.unavailable.update(["consul2", "consul3"])
+    session = con.session.create(ttl=10)
+    fake_consul.unavailable.clear()
+    fake_consul.unavailable.add("consul1")
+    endpoints = {x.address: x for x in con.http.endpoints}
+    # Tried first, whatever the measurements so far.
+    endpoints[_address(consul1)].latency = 0
+    # Renewed through another agent.
+    assert con.session.renew(session)
+    assert endpoints[_address(consul1)].errors == 1
+    assert not endpoints[_address(consul1)].healthy
+    fake_consul.unavailable.clear()
+    con.session.destroy(session)
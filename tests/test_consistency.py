@@ -0,0 +1,38 @@
+import time
+
+import pytest
+from consul import Check
+
+from consul_lib import get_failed_cluster_checks
+from consul_lib.consistency import kv_get, read
+from fixtures import FAKE
+
+
+@pytest.mark.skipif(not FAKE, reason="needs the fake consul to simulate a lagging server")
+def test_read_last_contact(consul1, fake_consul):
+    consul1.kv.put("test/key", "value")
+    result = kv_get(consul1, "test/key", consistency="stale")
+    assert result.data["Value"] == b"value"
+    assert result.last_contact == 0
+    assert result.consistency == "stale"
+    index, data = result
+    assert index == result.index
+
+    # The answering server lost contact to the leader 10s ago.
+    fake_consul.last_contact = 10000
+    result = kv_get(consul1, "test/key", consistency="stale")
+    assert result.last_contact == 10
+    result = kv_get(consul1, "test/key", consistency="stale", max_stale="5s")
+    assert result.consistency == "default"
+    assert result.data["Value"] == b"value"
+
+    with pytest.raises(ValueError):
+        read(consul1, "/v1/kv/test/key", consistency="linearizable")
+
+
+@pytest.mark.parametrize("consistency", ["default", "stale", "consistent"])
+def test_failed_cluster_checks_consistency(consul1, consul_service, consistency):
+    consul_service.register(consul1, "A", check=Check.ttl("1ms"))  # failing
+    time.sleep(0.01)
+    failed = get_failed_cluster_checks(consul1, ["A"], consistency=consistency)
+    assert list(failed) == ["service:A"]
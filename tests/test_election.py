@@ -0,0 +1,85 @@
+import threading
+
+from consul_lib import LeaderElection, LeaderObserver
+from consul_lib.election import Leader
+
+
+def test_leader_election(consul1, consul2):
+    election1 = LeaderElection(consul1, "test/election", payload="host1:8080")
+    election2 = LeaderElection(consul2, "test/election", payload="host2:8080")
+    assert election2.current_leader(timeout=5) is None
+
+    changes = []
+    changed = threading.Event()
+    election2.add_callback(lambda old, new: (changes.append((old, new)), changed.set()))
+
+    assert election1.campaign()
+    assert election1.is_leader
+    assert changed.wait(5)
+    assert changes[-1][0] is None
+    assert changes[-1][1].session == election1.session
+    assert election2.current_leader().payload == "host1:8080"
+
+    assert not election2.campaign(blocking=False)
+    assert not election2.is_leader
+
+    changed.clear()
+    assert election1.publish("host1:9090")
+    assert changed.wait(5)
+    assert election2.current_leader().payload == "host1:9090"
+
+    changed.clear()
+    election1.resign()
+    assert changed.wait(5)
+    assert election2.current_leader() is None
+    assert election2.campaign(wait="5s")
+    assert election2.is_leader
+    assert not election1.publish("host1:8080")
+
+    election1.close()
+    election2.close()
+
+
+def test_leader_observer_shared(consul1):
+    election1 = LeaderElection(consul1, "test/election")
+    election2 = LeaderElection(consul1, "test/election")
+    assert election1.current_leader(timeout=5) is None
+    assert election1._observer is election2._observe()
+
+    observer = election1._observer
+    election1.close()
+    assert observer.is_alive()
+    assert LeaderObserver.shared(consul1, "test/election/.lock") is observer
+    observer.release()
+    election2.close()
+    # Stops after the running blocking query.
+    assert observer._finished
+    other = LeaderObserver.shared(consul1, "test/election/.lock")
+    assert other is not observer
+    other.release()
+    assert consul1 not in LeaderObserver._shared
+
+
+def test_leadership_lost(consul1, consul2):
+    election = LeaderElection(consul1, "test/election")
+    assert election.campaign()
+    while election.current_leader(timeout=5) is None:
+        # The observer has not seen the campaign yet.
+        assert election.wait_for_change(5)
+    assert election.current_leader().session == election.session
+
+    # Someone else removes the session, e.g. an operator.
+    consul2.session.destroy(election.session)
+    while election.is_leader:
+        assert election.wait_for_change(5)
+    assert election.current_leader() is None
+    election.close()
+
+
+def test_stale_loss_confirmed(consul1):
+    election = LeaderElection(consul1, "test/election")
+    assert election.campaign()
+    # A stale read of a follower does not show the leader yet.
+    election._changed(Leader(election.session, None, 1), None)
+    assert election.is_leader
+    election.close()
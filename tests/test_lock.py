@@ -1,4 +1,10 @@
+import threading
+import time
+
+import pytest
+
 from consul_lib import Lock
+from consul_lib.lock import _Arbiter
 
 
 def test_lock_success(consul1, consul2):
@@ -23,3 +29,135 @@ def test_lock_failing(consul1, consul2):
 
     lock1.close()
     lock2.close()
+
+
+def test_lock_fair(consul1):
+    holder = Lock(consul1, "test/lock", fair=True)
+    assert holder.acquire()
+
+    order = []
+    threads = []
+    for i in range(5):
+        def worker(i=i):
+            lock = Lock(consul1, "test/lock", fair=True)
+            assert lock.acquire()
+            order.append(i)
+            lock.release()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+        # Make sure the waiters queue up in order.
+        time.sleep(0.2)
+
+    holder.release()
+    for thread in threads:
+        thread.join()
+    assert order == list(range(5))
+
+
+def test_lock_fair_not_blocking(consul1, consul2):
+    lock1 = Lock(consul1, "test/lock", fair=True)
+    lock2 = Lock(consul2, "test/lock", fair=True)
+    assert lock1.acquire()
+    assert not lock2.acquire(blocking=False)
+    assert not lock2.acquire(wait="100ms")
+    _, keys = consul1.kv.get("test/lock/.queue", keys=True)
+    assert keys == ["test/lock/.queue/%s" % lock1.session]
+    lock1.release()
+    assert lock2.acquire(blocking=False)
+    lock2.release()
+
+
+def test_lock_track_lease(consul1, consul2):
+    lock = Lock(consul1, "test/lock", track_lease=True)
+    assert not lock.acquired
+    assert lock.acquire()
+    for _ in range(100):
+        assert lock.acquired
+    assert lock._lease.checks == 0
+
+    # Someone else breaks the lock, the watch notices.
+    consul2.session.destroy(lock.session)
+    for _ in range(50):
+        if not lock.acquired:
+            break
+        time.sleep(0.1)
+    assert not lock.acquired
+    lock.release()
+
+
+@pytest.mark.parametrize("hold_local", [False, True])
+def test_lock_coalesce(consul1, consul2, hold_local):
+    active = []
+    sessions = set()
+    mutex = threading.Lock()
+    start = threading.Barrier(6)
+
+    def worker():
+        lock = Lock(consul1, "test/lock", coalesce=True, hold_local=hold_local)
+        start.wait()
+        for _ in range(3):
+            assert lock.acquire()
+            with mutex:
+                active.append(lock)
+                sessions.add(lock.session)
+                assert len(active) == 1
+            time.sleep(0.01)
+            with mutex:
+                active.remove(lock)
+            lock.release()
+
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The session is kept while local contenders wait.
+    assert len(sessions) == 1
+    _, data = consul1.kv.get("test/lock/.lock")
+    assert "Session" not in data
+
+
+def test_lock_coalesce_excludes_others(consul1, consul2):
+    lock1 = Lock(consul1, "test/lock", coalesce=True)
+    lock2 = Lock(consul1, "test/lock", coalesce=True)
+    other = Lock(consul2, "test/lock")
+    assert lock1.acquire()
+    assert lock1.acquired
+    assert not lock2.acquire(blocking=False)
+    assert not lock2.acquire(wait="100ms")
+    assert not other.acquire(blocking=False)
+    lock1.release()
+    assert lock2.acquire(blocking=False)
+    lock2.release()
+    assert other.acquire(blocking=False)
+    other.release()
+    # Idle arbiters are forgotten, with their reference to consul1.
+    assert consul1 not in _Arbiter._shared
+
+
+def test_lock_coalesce_closes_kept_session(consul1, consul2):
+    lock1 = Lock(consul1, "test/lock", coalesce=True)
+    lock2 = Lock(consul1, "test/lock", coalesce=True)
+    assert lock1.acquire()
+    arbiter = lock1._arbiter
+    session = arbiter._lock.session
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(lock2.acquire(wait="500ms")))
+    waiter.start()
+    while not arbiter._queue:
+        time.sleep(0.01)
+    # Someone else takes the lock before the waiting contender gets it.
+    consul2.kv.put("test/lock/.lock", None, release=session)
+    other = Lock(consul2, "test/lock")
+    assert other.acquire(blocking=False)
+    lock1.release()
+    waiter.join()
+    assert result == [False]
+
+    # The session kept for lock2 is not left behind.
+    assert consul1 not in _Arbiter._shared
+    assert arbiter._lock.session is None
+    assert arbiter._lock.session_renewer is None or not arbiter._lock.session_renewer.is_alive()
+    assert session not in {x["ID"] for x in consul1.session.list()[1]}
+    other.release()
@@ -1,22 +1,24 @@
 import threading
+import time
 
 import pytest
 
 from consul_lib import Lock, Semaphore
-from consul_lib.session import LockMonitor
+from consul_lib.session import LockMonitor, MonitorHub
 
 
+@pytest.mark.parametrize("blocking", [False, True])
 @pytest.mark.parametrize("get_lock", [
     lambda con: Lock(con, "test/lock"),
     lambda con: Semaphore(con, "test/semaphore", 1),
 ])
-def test_lockmonitor(consul1, get_lock):
+def test_lockmonitor(consul1, get_lock, blocking):
     lock = get_lock(consul1)
 
     assert lock.acquire(), "Could not acquire lock"
 
     event = threading.Event()
-    mon = LockMonitor(lock, event=event)
+    mon = LockMonitor(lock, event=event, blocking=blocking)
     mon.start()
     assert not event.is_set()
 
@@ -27,3 +29,103 @@ def test_lockmonitor(consul1, get_lock):
     lock.release()
     lock.close()
     mon.finish()
+
+
+def test_lockmonitor_reads_lock_key(consul1):
+    lock = Lock(consul1, "test/lock")
+    assert lock.acquire()
+    paths = []
+    http = consul1.http
+
+    class Recording:
+        def get(self, callback, path, params=None):
+            paths.append((path, dict(params or [])))
+            return http.get(callback, path, params=params)
+
+    consul1.http = Recording()
+    mon = LockMonitor(lock, retry_time=0.1)
+    mon.start()
+    time.sleep(0.5)
+    mon.finish()
+    mon.join()
+    consul1.http = http
+    lock.close()
+
+    # Only the .lock key, the keys of other users below the prefix are not read.
+    assert paths
+    assert all(path == "/v1/kv/test/lock/.lock" and "recurse" not in params for path, params in paths)
+
+
+def test_lockmonitor_blocking_is_fast(consul1):
+    lock = Lock(consul1, "test/lock")
+    assert lock.acquire()
+    event = threading.Event()
+    mon = LockMonitor(lock, event=event, blocking=True)
+    mon.start()
+    time.sleep(0.5)
+
+    start = time.monotonic()
+    consul1.session.destroy(lock.session)
+    assert event.wait(timeout=30), "Event has not been set"
+    assert time.monotonic() - start < 1
+
+    mon.finish()
+    lock.close()
+
+
+def test_monitorhub(consul1):
+    hub = MonitorHub(consul1)
+    locks = [Lock(consul1, "test/hub/lock%d" % i) for i in range(3)]
+    locks.append(Semaphore(consul1, "test/hub/semaphore", 2))
+    events = []
+    lost = []
+    for lock in locks:
+        assert lock.acquire()
+        event = threading.Event()
+        hub.watch(lock, event=event, callback=lost.append)
+        events.append(event)
+    assert len(hub._watchers) == 1
+    time.sleep(0.5)
+
+    consul1.session.destroy(locks[1].session)
+    assert events[1].wait(timeout=30)
+    consul1.session.destroy(locks[3].session)
+    assert events[3].wait(timeout=30)
+    assert not events[0].is_set() and not events[2].is_set()
+    assert lost == [locks[1], locks[3]]
+
+    hub.finish()
+    for lock in locks:
+        lock.close()
+
+
+def test_lockmonitor_finish_is_fast(consul1):
+    lock = Lock(consul1, "test/lock")
+    assert lock.acquire()
+    mon = LockMonitor(lock, retry_time=60)
+    mon.start()
+    time.sleep(0.1)
+    mon.finish()
+    mon.join(5)
+    assert not mon.is_alive()
+    lock.release()
+
+
+def test_monitorhub_shared_is_dropped(consul1):
+    hub = MonitorHub.shared(consul1)
+    assert MonitorHub.shared(consul1) is hub
+    lock = Lock(consul1, "test/hub/lock")
+    assert lock.acquire()
+    event = threading.Event()
+    hub.watch(lock, event=event)
+    watcher = hub._watchers["test/hub"]
+    consul1.session.destroy(lock.session)
+    assert event.wait(timeout=30)
+    # Without locks to watch, the hub and its reference to consul1 are forgotten.
+    watcher.join(timeout=5)
+    assert consul1 not in MonitorHub._shared
+    other = MonitorHub.shared(consul1)
+    assert other is not hub
+    other.finish()
+    assert consul1 not in MonitorHub._shared
+    lock.close()
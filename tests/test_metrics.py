@@ -0,0 +1,59 @@
+import threading
+import time
+
+from consul_lib import Lock, Semaphore, metrics
+
+
+def test_metrics_disabled(consul1):
+    assert not metrics.enabled()
+    assert metrics.span("lock.acquire", consul1) is metrics.current()
+    lock = Lock(consul1, "test/lock")
+    assert lock.acquire()
+    lock.release()
+    assert not hasattr(consul1.http, "_http")
+
+
+def test_lock_spans(consul1, consul2):
+    events = []
+    recorder = metrics.add_callback(events.append)
+    try:
+        holder = Lock(consul1, "test/lock")
+        assert holder.acquire()
+
+        waiter = Lock(consul2, "test/lock")
+        thread = threading.Thread(target=waiter.acquire)
+        thread.start()
+        time.sleep(1)
+        holder.release()
+        thread.join(timeout=10)
+        waiter.release()
+    finally:
+        metrics.remove_recorder(recorder)
+
+    acquires = [x for x in events if isinstance(x, metrics.Span) and x.name == "lock.acquire"]
+    assert len(acquires) == 2
+    contended = max(acquires, key=lambda x: x.duration)
+    assert contended.attributes["acquired"] is True
+    assert contended.retries >= 1
+    assert contended.round_trips >= 4
+    assert 0.5 < contended.wait_time <= contended.duration
+    assert [x.name for x in events if isinstance(x, metrics.Span)].count("lock.release") == 2
+
+
+def test_semaphore_spans(consul1, consul2):
+    collector = metrics.add_recorder(metrics.PrometheusCollector())
+    events = []
+    recorder = metrics.add_callback(events.append)
+    try:
+        semaphore = Semaphore(consul1, "test/semaphore", 2)
+        assert semaphore.acquire()
+        semaphore.release()
+    finally:
+        metrics.remove_recorder(recorder)
+        metrics.remove_recorder(collector)
+
+    spans = {x.name: x for x in events if isinstance(x, metrics.Span)}
+    assert spans["semaphore.acquire"].round_trips == 2
+    assert spans["semaphore.acquire"].error is None
+    assert spans["semaphore.release"].round_trips >= 2
+    assert collector._operations[("semaphore.acquire", "ok")][:1] == [1]
@@ -0,0 +1,41 @@
+import threading
+import time
+
+from consul_lib import Lock, MultiLock
+
+
+def test_multilock(consul1, consul2):
+    with MultiLock(consul1, ["test/a", "test/b", "other/c"]) as multilock:
+        assert multilock.acquired
+        for prefix in ["test/a", "test/b", "other/c"]:
+            assert not Lock(consul2, prefix).acquire(blocking=False)
+    assert Lock(consul2, "test/a").acquire(blocking=False)
+
+
+def test_multilock_all_or_nothing(consul1, consul2):
+    lock = Lock(consul1, "test/b")
+    assert lock.acquire()
+
+    multilock = MultiLock(consul2, ["test/a", "test/b"])
+    assert not multilock.acquire(blocking=False)
+    _, data = consul1.kv.get("test/a/.lock")
+    assert not data or "Session" not in data
+
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(multilock.acquire()))
+    thread.start()
+    time.sleep(0.5)
+    assert not acquired
+    lock.release()
+    thread.join(timeout=10)
+    assert acquired == [True]
+    multilock.release()
+
+
+def test_multilock_wait(consul1, consul2):
+    lock = Lock(consul1, "test/a")
+    assert lock.acquire()
+    multilock = MultiLock(consul2, ["test/a", "test/b"])
+    assert not multilock.acquire(wait="100ms")
+    lock.release()
+    multilock.close()
@@ -0,0 +1,73 @@
+from consul_lib import Lock, Semaphore, SessionPool
+
+
+def _sessions(con):
+    return {x["ID"] for x in con.session.list()[1]}
+
+
+def test_session_pool_lock(consul1, consul2):
+    pool = SessionPool(consul1, size=2, ttl=10, lock_delay=0)
+    lock = Lock(consul1, "test/lock", pool=pool)
+    sessions = set()
+    for _ in range(5):
+        assert lock.acquire()
+        sessions.add(lock.session)
+        lock.release()
+        assert lock.session is None
+    assert len(sessions) == 1
+    assert (pool.created, pool.reused, len(pool)) == (1, 4, 1)
+    # Released, but not destroyed.
+    _, data = consul1.kv.get("test/lock/.lock")
+    assert "Session" not in data
+    assert sessions <= _sessions(consul1)
+
+    # Closed while holding: the lock is released, not the session.
+    assert lock.acquire()
+    lock.close()
+    other = Lock(consul2, "test/lock")
+    assert other.acquire(blocking=False)
+    other.release()
+
+    pool.close()
+    assert not sessions & _sessions(consul1)
+
+
+def test_session_pool_semaphore(consul1):
+    pool = SessionPool(consul1, warm=2, ttl=10)
+    assert len(pool) == 2
+    for _ in range(3):
+        semaphore = Semaphore(consul1, "test/semaphore", 1, pool=pool)
+        assert semaphore.acquire(blocking=False)
+        semaphore.release()
+    assert (pool.created, pool.reused) == (2, 3)
+    semaphore = Semaphore(consul1, "test/semaphore", 1, pool=pool)
+    assert semaphore.acquire(blocking=False)
+    # Without release, closing removes it from the holders.
+    semaphore.close()
+    other = Semaphore(consul1, "test/semaphore", 1)
+    assert other.acquire(blocking=False)
+    other.release()
+    pool.close()
+
+
+def test_session_pool_eviction(consul1):
+    pool = SessionPool(consul1, size=1, ttl=10)
+    first, second = pool.checkout(), pool.checkout()
+    pool.checkin(*first)
+    # Full.
+    pool.checkin(*second)
+    assert len(pool) == 1 and pool.destroyed == 1
+    # Too old.
+    pool.max_idle = 0
+    session, renewer = pool.checkout()
+    assert session != first[0]
+    assert pool.destroyed == 2
+    assert not {first[0], second[0]} & _sessions(consul1)
+
+    # Invalidated sessions are not given out again.
+    consul1.session.destroy(session)
+    renewer.invalidated = True
+    pool.max_idle = 300
+    pool.checkin(session, renewer)
+    assert len(pool) == 0
+    pool.close()
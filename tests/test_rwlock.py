@@ -0,0 +1,60 @@
+import threading
+import time
+
+from consul_lib import RWLock
+from consul_lib.session import LockMonitor
+
+
+def test_rwlock_readers_share(consul1, consul2):
+    readers = [RWLock(consul1, "test/rwlock"), RWLock(consul2, "test/rwlock")]
+    for reader in readers:
+        assert reader.acquire(shared=True, blocking=False)
+    writer = RWLock(consul1, "test/rwlock")
+    assert not writer.acquire(blocking=False)
+    # A failed writer does not keep readers out.
+    reader = RWLock(consul2, "test/rwlock")
+    assert reader.acquire(shared=True, blocking=False)
+    for reader in readers + [reader]:
+        reader.release()
+    assert writer.acquire(blocking=False)
+    writer.release()
+
+
+def test_rwlock_writer_excludes(consul1, consul2):
+    with RWLock(consul1, "test/rwlock").write() as writer:
+        assert writer.locked
+        assert not RWLock(consul2, "test/rwlock").acquire(shared=True, blocking=False)
+        assert not RWLock(consul2, "test/rwlock").acquire(blocking=False)
+
+
+def test_rwlock_writer_preference(consul1, consul2):
+    reader = RWLock(consul1, "test/rwlock")
+    assert reader.acquire(shared=True)
+
+    writer = RWLock(consul2, "test/rwlock")
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(writer.acquire()))
+    thread.start()
+    time.sleep(0.5)
+    assert not acquired
+    # The writer is waiting, so new readers have to wait, too.
+    assert not RWLock(consul1, "test/rwlock").acquire(shared=True, blocking=False)
+
+    reader.release()
+    thread.join(timeout=10)
+    assert acquired == [True]
+    writer.release()
+
+
+def test_rwlock_monitor(consul1, consul2):
+    event = threading.Event()
+    reader = RWLock(consul1, "test/rwlock")
+    assert reader.acquire(shared=True)
+    monitor = LockMonitor(reader, event=event, retry_time=0.1, daemon=True)
+    monitor.start()
+    time.sleep(0.3)
+    assert not event.is_set()
+    consul2.session.destroy(reader.session)
+    assert event.wait(5)
+    monitor.finish()
+    reader.release()
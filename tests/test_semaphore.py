@@ -1,4 +1,13 @@
-from consul_lib import Semaphore
+import json
+import threading
+import time
+
+import pytest
+from consul.base import CB
+
+from consul_lib import Semaphore, ShardedSemaphore
+from consul_lib.session import SessionRenewer
+from fixtures import FAKE
 
 
 def test_semaphore_success(consul1, consul2):
@@ -30,3 +39,228 @@ def test_semaphore_failing(consul1, consul2):
 
     sem1.close()
     sem2.close()
+
+
+@pytest.mark.parametrize("use_txn,fair", [(True, False), (False, False), (True, True)])
+def test_semaphore_contention(consul1, use_txn, fair):
+    active = []
+    results = []
+    mutex = threading.Lock()
+
+    def worker():
+        sem = Semaphore(consul1, "test/semaphore", 2, use_txn=use_txn, fair=fair)
+        assert sem.acquire()
+        with mutex:
+            active.append(sem)
+            results.append(len(active))
+        time.sleep(0.05)
+        with mutex:
+            active.remove(sem)
+        sem.release()
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 8
+    assert max(results) <= 2
+
+
+def test_semaphore_cleans_up_broken_holders(consul1, consul2):
+    sem1 = Semaphore(consul1, "test/semaphore", 1)
+    assert sem1.acquire()
+    # Simulate a crashed holder: its session is gone, the contender key stays.
+    consul1.session.destroy(sem1.session)
+
+    sem2 = Semaphore(consul2, "test/semaphore", 1)
+    assert sem2.acquire(blocking=False)
+    assert sem2.acquired()
+    _, keys = consul2.kv.get("test/semaphore", keys=True)
+    assert "test/semaphore/%s" % sem1.session not in keys
+    sem2.release()
+    sem1.session = None
+    sem1.close()
+
+
+def test_semaphore_fair(consul1):
+    holders = [Semaphore(consul1, "test/semaphore", 2, fair=True) for _ in range(2)]
+    for sem in holders:
+        assert sem.acquire()
+
+    order = []
+    threads = []
+    for i in range(4):
+        def worker(i=i):
+            sem = Semaphore(consul1, "test/semaphore", 2, fair=True)
+            assert sem.acquire()
+            order.append(i)
+            time.sleep(0.1)
+            sem.release()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.2)
+
+    for sem in holders:
+        sem.release()
+    for thread in threads:
+        thread.join()
+    assert sorted(order[:2]) == [0, 1] and sorted(order[2:]) == [2, 3]
+
+
+def test_semaphore_track_lease(consul1):
+    semaphore = Semaphore(consul1, "test/semaphore", 2, track_lease=True)
+    assert semaphore.acquire()
+    for _ in range(100):
+        assert semaphore.acquired()
+    assert semaphore._lease.checks == 0
+
+    # Close to the end of the ttl without renewal, consul is asked.
+    semaphore.session_renewer.stats.last_success -= 50
+    assert semaphore.acquired()
+    assert semaphore._lease.checks == 1
+    semaphore.release()
+    assert not semaphore.acquired()
+
+
+@pytest.mark.parametrize("use_txn", [True, False])
+def test_semaphore_permits(consul1, consul2, use_txn):
+    big = Semaphore(consul1, "test/semaphore", 4, use_txn=use_txn)
+    small = Semaphore(consul2, "test/semaphore", 4, use_txn=use_txn)
+    assert big.acquire(permits=3)
+    _, data = consul1.kv.get("test/semaphore/.lock")
+    assert json.loads(data["Value"].decode())["Weights"] == {big.session: 3}
+    assert small.acquire(blocking=False)
+    other = Semaphore(consul2, "test/semaphore", 4, use_txn=use_txn)
+    assert not other.acquire(blocking=False)
+
+    # Gives back two of three permits and keeps holding one.
+    assert big.release(permits=2)
+    assert big.locked and big.acquired()
+    # Neither none nor more than held, .lock stays as it is.
+    for permits in (0, -1, 2):
+        with pytest.raises(ValueError):
+            big.release(permits=permits)
+    _, data = consul1.kv.get("test/semaphore/.lock")
+    assert json.loads(data["Value"].decode())["Weights"] == {big.session: 1}
+    assert other.acquire(blocking=False, permits=2)
+    with pytest.raises(ValueError):
+        other.acquire(permits=5)
+
+    for sem in (big, small, other):
+        sem.release()
+    _, data = consul1.kv.get("test/semaphore/.lock")
+    assert json.loads(data["Value"].decode()) == {"Limit": 4, "Holders": []}
+
+
+@pytest.mark.parametrize("use_txn", [True, False])
+def test_semaphore_permits_not_starved(consul1, consul2, use_txn):
+    holder = Semaphore(consul1, "test/semaphore", 3, use_txn=use_txn)
+    assert holder.acquire()
+    big = Semaphore(consul2, "test/semaphore", 3, use_txn=use_txn)
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: big.acquire(permits=3) and acquired.set())
+    thread.start()
+    for _ in range(100):
+        _, data = consul1.kv.get("test/semaphore/.lock")
+        if big.session in json.loads(data["Value"].decode()).get("Waiting", []):
+            break
+        time.sleep(0.05)
+
+    # Two permits are free, but the waiter for three comes first.
+    small = Semaphore(consul1, "test/semaphore", 3, use_txn=use_txn)
+    assert not small.acquire(blocking=False)
+    holder.release()
+    assert acquired.wait(10)
+    thread.join()
+    assert not small.acquire(blocking=False)
+    big.release()
+    assert small.acquire(blocking=False)
+    small.release()
+
+
+@pytest.mark.parametrize("use_txn", [True, False])
+def test_sharded_semaphore(consul1, use_txn):
+    holders = [ShardedSemaphore(consul1, "test/sharded", 5, shards=2, use_txn=use_txn) for _ in range(5)]
+    for sem in holders:
+        assert sem.acquire(blocking=False)
+    # Shards of size 3 and 2, both full.
+    assert sorted(x._held.size for x in holders) == [2, 2, 3, 3, 3]
+
+    # All shards are full: the limit is global.
+    sem = ShardedSemaphore(consul1, "test/sharded", 5, shards=2, use_txn=use_txn)
+    assert not sem.acquire(blocking=False)
+
+    thread = threading.Thread(target=sem.acquire)
+    thread.start()
+    time.sleep(0.1)
+    assert thread.is_alive()
+    freed = holders[0]._held.lock_path
+    holders[0].release()
+    thread.join(5)
+    assert sem.acquired()
+    assert sem._held.lock_path == freed
+
+    for x in holders[1:] + [sem]:
+        x.release()
+
+
+def test_sharded_semaphore_acquire_twice(consul1):
+    sem = ShardedSemaphore(consul1, "test/sharded", 4, shards=2)
+    assert sem.acquire(blocking=False)
+    held = sem._held
+    # Even if another shard is tried first, no second slot is taken.
+    sem._order = lambda: sorted(sem._shards, key=lambda x: x is held)
+    assert sem.acquire(blocking=False)
+    assert sem._held is held
+    for shard in sem._shards:
+        _, data = consul1.kv.get(shard.lock_path)
+        holders = json.loads(data["Value"].decode())["Holders"] if data else []
+        assert holders == ([sem.session] if shard is held else [])
+    sem.release()
+
+
+def test_sharded_semaphore_contention(consul1):
+    active = []
+    results = []
+    mutex = threading.Lock()
+
+    def worker():
+        sem = ShardedSemaphore(consul1, "test/sharded", 4, shards=2)
+        assert sem.acquire()
+        with mutex:
+            active.append(sem)
+            results.append(len(active))
+        time.sleep(0.05)
+        with mutex:
+            active.remove(sem)
+        sem.release()
+
+    threads = [threading.Thread(target=worker) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 12
+    assert max(results) <= 4
+
+
+@pytest.mark.skipif(not FAKE, reason="needs the fake consul for a session ttl below 10s")
+@pytest.mark.parametrize("get_semaphore", [
+    lambda con, session: Semaphore(con, "test/semaphore", 2, session=session),
+    lambda con, session: ShardedSemaphore(con, "test/semaphore", 2, shards=2, session=session),
+])
+def test_semaphore_renews_short_session(consul1, monkeypatch, get_semaphore):
+    monkeypatch.setattr(SessionRenewer, "default_interval", 0.2)
+    session = consul1.http.put(CB.json(is_id=True), "/v1/session/create", data=json.dumps({"ttl": "1s"}))
+    # Semaphore's own ttl (60s) would renew it after 40s only.
+    semaphore = get_semaphore(consul1, session)
+    assert semaphore.acquire(blocking=False)
+    time.sleep(2)
+    _, data = consul1.session.info(session)
+    assert data, "Session expired although it is renewed"
+    assert semaphore.acquired()
+    semaphore.release()
+    semaphore.session_renewer.finish()
+    consul1.session.destroy(session)
@@ -1,8 +1,16 @@
+import logging
 import time
 
-from consul_lib import get_local_checks, get_failed_cluster_checks
+import consul
+import pytest
+
+from consul_lib import get_local_checks, get_failed_cluster_checks, get_failed_datacenter_checks, HealthWatcher
+from consul_lib.services import _UNHEALTHY_INSTANCES, _filtered_read, _Reader
 from consul import Check
 
+from fakeconsul import FakeConsul
+from fixtures import FAKE
+
 
 def test_get_local_checks(consul_service, consul1, consul2, consul3, consul4):
     consul_service.register(consul1, "A")
@@ -64,3 +72,120 @@ def test_ignore_maintenance_success(consul_service, consul_maint, consul1, consu
     consul_maint.enable(consul2, "This should be ignored for service1 and service2")
 
     assert len(get_failed_cluster_checks(consul1, ["service1", "service2"])) == 0
+
+
+@pytest.mark.parametrize("strategy", ["sequential", "concurrent", "bulk"])
+def test_get_failed_cluster_checks_strategies(strategy, consul_service, consul_maint, consul1, consul2, consul3):
+    consul_service.register(consul1, "service1", tags=["ignore_maintenance"])
+    consul_service.register(consul2, "service1", tags=["ignore_maintenance"])
+    consul_service.register(consul1, "service2")
+    consul_service.register(consul2, "service2", check=Check.ttl("1ms"))  # failing
+    consul_service.register(consul3, "service3", check=Check.ttl("1ms"))  # failing
+    consul_service.register(consul3, "service4")
+    consul_maint.enable(consul2, "Ignored for service1, but not for service2")
+
+    time.sleep(0.01)
+
+    service_names = ["service1", "service2", "service3", "service4", "nonexistent"]
+    expected = get_failed_cluster_checks(consul1, service_names, strategy="sequential")
+    assert set(expected) == {"_node_maintenance", "service:service2", "service:service3"}
+    assert get_failed_cluster_checks(consul1, service_names, strategy=strategy) == expected
+
+
+def test_unhealthy_filter(consul_service, consul1, consul2):
+    consul_service.register(consul1, "service1")
+    consul_service.register(consul2, "service1", check=Check.ttl("1ms"))  # failing
+
+    time.sleep(0.01)
+
+    # Accepted by consul, not read again without filter.
+    filtered = _filtered_read(consul1, "/v1/health/service/service1", _UNHEALTHY_INSTANCES).data
+    assert [x["Node"]["Node"] for x in filtered] == [consul2.agent.self()["Config"]["NodeName"]]
+    instances = _Reader(consul1, "default", None, unhealthy=True).service("service1")
+    assert instances == filtered
+    checks = _Reader(consul1, "default", None, unhealthy=True).state("any").data
+    assert {x["Status"] for x in checks} == {"critical"}
+
+
+def test_filter_fallback(consul_service, consul1, caplog):
+    consul_service.register(consul1, "A", tags=["tag1"])
+    consul_service.register(consul1, "B", tags=['with "quotes"'])
+
+    # Rejected expressions are read again without filter, with a warning once.
+    with caplog.at_level(logging.WARNING, logger="consul_lib.services"):
+        for _ in range(2):
+            assert set(_filtered_read(consul1, "/v1/agent/services", "Tags ~~ tag1").data) == {"A", "B"}
+    assert len([x for x in caplog.records if "rejected" in x.getMessage()]) == 1
+    assert set(get_local_checks(consul1, tags=['with "quotes"'])) == {"B"}
+
+
+def test_get_failed_datacenter_checks(consul_service, consul1, consul2):
+    consul_service.register(consul1, "service1")
+    consul_service.register(consul2, "service1", check=Check.ttl("1ms"))  # failing
+
+    time.sleep(0.01)
+
+    dc = consul1.agent.self()["Config"]["Datacenter"]
+    node = consul2.agent.self()["Config"]["NodeName"]
+    result = get_failed_datacenter_checks(consul1, ["service1"], [dc, "nonexistent"], timeout=10)
+    assert set(result.failed) == {dc}
+    assert set(result.failed[dc]["service1"]) == {node}
+    assert [x["CheckID"] for x in result.failed[dc]["service1"][node]] == ["service:service1"]
+    assert set(result.errors) == {"nonexistent"}
+    assert not result.complete
+    assert not result.healthy
+
+
+@pytest.mark.skipif(not FAKE, reason="needs the fake consul to simulate several datacenters")
+def test_get_failed_datacenter_checks_parallel():
+    cluster = FakeConsul(nodes=["consul1"], datacenter="dc1", datacenters={"dc2": ["consul2"], "dc3": ["consul3"]})
+    cluster.start()
+    try:
+        for node in ["consul1", "consul2", "consul3"]:
+            con = consul.Consul(host=cluster.host, port=cluster.port(node))
+            con.agent.service.register("service1", check=Check.ttl("1ms"))  # failing
+        con = consul.Consul(host=cluster.host, port=cluster.port("consul1"))
+        time.sleep(0.01)
+        cluster.dc_latency.update({"dc2": 0.3, "dc3": 0.3})
+
+        start = time.monotonic()
+        result = get_failed_datacenter_checks(con, ["service1"], ["dc1", "dc2", "dc3"], strategy="sequential")
+        # One WAN round trip, not one per datacenter.
+        assert time.monotonic() - start < 0.55
+        assert result.complete
+        assert set(result.failed["dc1"]["service1"]) == {"consul1"}
+        assert set(result.failed["dc2"]["service1"]) == {"consul2"}
+        assert set(result.failed["dc3"]["service1"]) == {"consul3"}
+
+        cluster.dc_latency["dc3"] = 2
+        result = get_failed_datacenter_checks(con, ["service1"], ["dc1", "dc2", "dc3"], timeout=1)
+        assert set(result.failed) == {"dc1", "dc2"}
+        assert isinstance(result.errors["dc3"], TimeoutError)
+    finally:
+        cluster.stop()
+
+
+def test_health_watcher(consul_service, consul_maint, consul1, consul2):
+    consul_service.register(consul1, "service1")
+    consul_service.register(consul2, "service1")
+    consul_service.register(consul2, "service2", tags=["ignore_maintenance"])
+
+    watcher = HealthWatcher(consul1)
+    changes = []
+    watcher.add_callback(changes.append)
+    watcher.start()
+    assert watcher.failed_checks(["service1", "service2"], timeout=10) == {}
+
+    consul_maint.enable(consul2, "Not ignored for service1")
+    while not watcher.failed_checks(["service1"]):
+        assert watcher.wait_for_change(timeout=10)
+    assert set(watcher.failed_checks(["service1", "service2"])) == {"_node_maintenance"}
+    assert watcher.failed_checks(["service2"]) == {}
+    assert ("consul2", "_node_maintenance") in changes[-1]
+    assert watcher.failed_checks(["service1"]) == get_failed_cluster_checks(consul1, ["service1"])
+
+    assert set(watcher.wait_until_healthy(["service1"], timeout=0.5)) == {"_node_maintenance"}
+    consul_maint.disable(consul2)
+    assert watcher.wait_until_healthy(["service1"], timeout=10) == {}
+
+    watcher.finish()
@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+
+from consul_lib import HostSession, Lock, Semaphore, metrics
+from consul_lib.client import _reconnect
+from consul_lib.session import SessionRenewalHub, SessionRenewer
+
+
+def test_session_renewer_keeps_session_alive(consul1):
+    hub = SessionRenewalHub()
+    session = consul1.session.create(ttl=10)
+    # Renewed every 0.5s instead of shortly before the ttl runs out.
+    renewer = SessionRenewer(session, consul1, ttl=10, renew_margin=9.5, hub=hub)
+    renewer.start()
+    assert renewer.is_alive()
+    assert renewer.interval == 0.5
+
+    time.sleep(1.2)
+    assert renewer.stats.renewals >= 2
+    assert renewer.stats.failures == 0
+    _, data = consul1.session.info(session)
+    assert data, "Session expired although it is renewed"
+
+    renewer.finish()
+    renewer.join(timeout=1)
+    assert not renewer.is_alive()
+    assert len(hub) == 0
+    consul1.session.destroy(session)
+
+
+def test_session_renewal_hub_is_shared(consul1):
+    locks = [Lock(consul1, "test/lock%d" % i) for i in range(10)]
+    semaphores = [Semaphore(consul1, "test/semaphore", 10) for _ in range(10)]
+    for lock in locks:
+        assert lock.acquire()
+    threads = threading.active_count()
+
+    for i in range(10, 20):
+        lock = Lock(consul1, "test/lock%d" % i)
+        assert lock.acquire()
+        locks.append(lock)
+    assert threading.active_count() == threads
+    assert len(SessionRenewalHub.default()) >= 30
+
+    for lock in locks:
+        lock.release()
+    for semaphore in semaphores:
+        semaphore.close()
+
+
+def test_session_renewer_schedule(consul1):
+    hub = SessionRenewalHub()
+    session = consul1.session.create(ttl=10)
+    renewer = SessionRenewer(session, consul1, ttl=10, renew_margin=8, hub=hub)
+    assert renewer.interval == 2
+    renewer.start()
+    time.sleep(5)
+    assert renewer.stats.renewals >= 2
+    assert renewer.stats.failures == 0
+    assert renewer.stats.mean_latency is not None
+    assert hub.stats.renewals == renewer.stats.renewals
+
+    # Failed renewals are retried more often than the regular interval.
+    consul1.session.destroy(session)
+    failures = renewer.stats.failures
+    time.sleep(3)
+    assert renewer.stats.failures > failures
+    assert renewer.stats.consecutive_failures == renewer.stats.failures
+    assert renewer._retry_delay() < renewer.interval
+
+    renewer.finish()
+    renewer.join(timeout=1)
+
+
+def test_session_renewal_hub_hung_renewals():
+    hung = threading.Event()
+
+    class Sessions:
+        def renew(self, session):
+            # Like a request without a timeout to an agent which does not answer.
+            if session.startswith("hung"):
+                hung.wait()
+
+    class Client:
+        session = Sessions()
+
+    hub = SessionRenewalHub(workers=2)
+    hub.idle_timeout = 0.5
+    renewers = [SessionRenewer(session, Client(), ttl=1, hub=hub) for session in ("hung1", "hung2", "healthy")]
+    for renewer in renewers:
+        renewer.start()
+    time.sleep(3)
+    assert renewers[2].stats.renewals >= 2
+
+    for renewer in renewers:
+        renewer.finish()
+    hung.set()
+    time.sleep(2)
+    assert len(hub._threads) == 2
+
+
+def test_session_options(consul1):
+    lock = Lock(consul1, "test/lock", ttl=15, lock_delay=0, behavior="delete")
+    assert lock.acquire()
+    _, data = consul1.session.info(lock.session)
+    assert data["TTL"] == "15s"
+    assert data["LockDelay"] == 0
+    assert data["Behavior"] == "delete"
+    assert lock.session_renewer.interval == 10
+    lock.release()
+
+
+def test_semaphore_behavior_delete(consul1, consul2):
+    holder = Semaphore(consul1, "test/semaphore", 1, behavior="delete", lock_delay=0)
+    assert holder.acquire()
+    # The holder crashes: its contender key is deleted with the session.
+    holder.session_renewer.finish()
+    consul1.session.destroy(holder.session)
+
+    waiter = Semaphore(consul2, "test/semaphore", 1)
+    assert waiter.acquire(blocking=False)
+    waiter.release()
+
+
+def test_session_renewed_after_fork(consul1):
+    lock = Lock(consul1, "test/lock", ttl=10, renew_margin=9.5)
+    assert lock.acquire()
+    pid = os.fork()
+    if pid == 0:
+        # The worker threads of the parent do not exist in the child.
+        renewals = lock.session_renewer.stats.renewals
+        deadline = time.monotonic() + 5
+        while lock.session_renewer.stats.renewals <= renewals and time.monotonic() < deadline:
+            time.sleep(0.1)
+        os._exit(0 if lock.session_renewer.stats.renewals > renewals else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    lock.release()
+
+
+def test_host_session(consul1, consul2):
+    host = HostSession(consul1, ttl=10, lock_delay=0)
+    worker1 = Lock(consul1, "test/lock", session=host)
+    worker2 = Lock(consul1, "test/lock", session=host)
+    assert worker1.session == worker2.session == host.id
+    assert worker1.acquire()
+    # Same session, but the file lock of the host excludes the other worker.
+    assert not worker2.acquire(blocking=False)
+    assert not worker2.acquired
+    assert worker1.acquired
+
+    worker1.release()
+    assert worker2.acquire(blocking=False)
+    _, data = consul1.session.info(host.id)
+    assert data, "Session destroyed by the release of a worker"
+    worker2.release()
+
+    # Closed while holding: released in consul, too.
+    assert worker1.acquire()
+    worker1.close()
+    other = Lock(consul2, "test/lock")
+    assert other.acquire(blocking=False)
+    other.release()
+
+    attached = HostSession.attach(consul1, host.id)
+    attached.close()
+    _, data = consul1.session.info(host.id)
+    assert data, "Session destroyed by a process which did not create it"
+    host.close()
+    _, data = consul1.session.info(host.id)
+    assert not data
+
+
+def test_host_session_track_lease(consul1):
+    host = HostSession(consul1, ttl=10, lock_delay=0)
+    # In the parent, which renews the session, and in a worker which does not.
+    parent = Lock(consul1, "test/lock1", session=host, track_lease=True)
+    worker = Lock(consul1, "test/lock2", session=HostSession.attach(consul1, host.id), track_lease=True)
+    for lock in (parent, worker):
+        assert lock.acquire()
+        assert lock.acquired
+    # Answered from the renewals in the parent, from consul in the worker.
+    assert parent._lease.checks == 0
+    assert worker._lease.checks == 1
+
+    consul1.session.destroy(host.id)
+    assert not worker.acquired
+    parent.release()
+    worker.release()
+    host.close()
+
+
+def test_reconnect_counted_client(consul1):
+    recorder = metrics.add_callback(lambda event: None)
+    try:
+        lock = Lock(consul1, "test/lock")
+        assert lock.acquire()
+        # Wrapped by metrics to count requests.
+        session = consul1.http._http.session
+        _reconnect(consul1)
+        assert consul1.http._http.session is not session
+        lock.release()
+    finally:
+        metrics.remove_recorder(recorder)